@@ -3,37 +3,47 @@ from phi.tools.hackernews import HackerNews
 from phi.tools.duckduckgo import DuckDuckGo
 from phi.tools.newspaper4k import Newspaper4k
 from phi.model.google import Gemini
-from phi.storage.agent.postgres import PgAgentStorage
-from tools.image_analyzer import analyze_image
-from tools.search import search
+from phi.memory.agent import AgentRun
+from phi.model.message import Message
+from agents.history import SessionHistory
+from agents.storage import RunStorage
+from agents.factory import AgentFactory
+from app.database.pool import engine
+from app.database.replicas import async_read_session, read_session, replica_router
 from config import settings
 from rich import print
 from log import logger
 from rich.console import Console
 from rich.json import JSON
-from tools.onchain import OnchainTool
 from rich.panel import Panel
 from rich.markdown import Markdown
 
-from phi.model.openai.like import OpenAILike
 from uuid import uuid4
-from app.services.wallet import WalletService
-from app.database.client import get_db
+from app.services.wallet import WalletScope, wallet_cache
 from sqlalchemy.orm import Session
-from prompt_engineering.deepsynth import DeepSynthPromptEngineering
 
+import asyncio
 import time
 from itertools import cycle
 import sys
 import threading
 
-db_url = settings.POSTGRES_URL
-storage = PgAgentStorage(
-    # store sessions in the ai.sessions table
+storage = RunStorage(
+    # store sessions in the ai.agent_sessions table
     table_name="agent_sessions",
-    # db_url: Postgres database URL
-    db_url=db_url,
+    # and their runs, one row each, in ai.agent_runs
+    runs_table_name="agent_runs",
+    num_runs=settings.AGENT_HISTORY_RUNS,
+    # share the process-wide connection pool
+    db_engine=engine,
+    # the user's next reads stay on the primary
+    on_write=replica_router.pin_soon,
 )
+# history is read from a replica when one is fresh enough
+session_history = SessionHistory(
+    storage, read_session=read_session, async_read_session=async_read_session
+)
+agent_factory = AgentFactory(storage)
 
 console = Console()
 
@@ -45,6 +55,9 @@ class BaseAgent:
     def __init__(self, user_id: str, session_id: str = None):
         self.user_id = user_id
         self.session_id = session_id
+        self.deepsynth_agent = None
+        self.message = None
+        self.cancel_event = threading.Event()
         logger.info(f"[AGENT] User ID: {self.user_id}")
         logger.info(f"[AGENT] Session ID: {self.session_id}")
 
@@ -52,68 +65,76 @@ class BaseAgent:
         logger.info(
             f"Getting history for session {self.session_id} and user {self.user_id}"
         )
-        sessions = storage.get_all_sessions(user_id=self.user_id)
-        history = []
         if self.session_id:
-            session = next(
-                (s for s in sessions if s.session_id == self.session_id), None
+            return session_history.get_session_history(self.user_id, self.session_id)
+        return session_history.get_all_histories(self.user_id)
+
+    def get_history_page(self, cursor: str = None, limit: int = None):
+        if self.session_id:
+            return session_history.get_runs(
+                self.user_id, self.session_id, cursor=cursor, limit=limit
+            )
+        return session_history.get_sessions(self.user_id, cursor=cursor, limit=limit)
+
+    async def aget_history(self):
+        if self.session_id:
+            return await session_history.aget_session_history(
+                self.user_id, self.session_id
             )
-            if session is None:
-                logger.info(
-                    f"No session found for {self.session_id} and user {self.user_id}"
-                )
-                return history
-            for run in session.memory.get("runs"):
-                user_message = run.get("message").get("content")
-                created_at = run.get("message").get("created_at")
-                images_message = [
-                    message.get("images")
-                    for message in run.get("response").get("messages")
-                    if message.get("role") == "user"
-                ][0]
-                agent_message = run.get("response").get("content")
-                result = [
-                    {
-                        "role": "user",
-                        "content": user_message,
-                        "images": images_message,
-                        "session_id": session.session_id,
-                        "created_at": created_at,
-                    },
-                    {
-                        "role": "assistant",
-                        "content": agent_message,
-                        "session_id": session.session_id,
-                    },
-                ]
-                history.extend(result)
-            return history
-        else:
-            all_sessions = []
-            for session in sessions:
-                history = []
-                session_id = session.session_id
-                for run in session.memory.get("runs"):
-                    user_message = run.get("message").get("content")
-                    created_at = run.get("message").get("created_at")
-                    agent_message = run.get("response").get("content")
-                    history.extend(
-                        [
-                            {
-                                "role": "user",
-                                "content": user_message,
-                                "session_id": session_id,
-                                "created_at": created_at,
-                            },
-                            {
-                                "role": "assistant",
-                                "content": agent_message,
-                                "session_id": session_id,
-                            },
-                        ]
-                    )
-                all_sessions.append(history)
-            return all_sessions
+        return await session_history.aget_all_histories(self.user_id)
+
+    async def aget_history_page(self, cursor: str = None, limit: int = None):
+        if self.session_id:
+            return await session_history.aget_runs(
+                self.user_id, self.session_id, cursor=cursor, limit=limit
+            )
+        return await session_history.aget_sessions(
+            self.user_id, cursor=cursor, limit=limit
+        )
+
+    def llm_tokens_used(self) -> int:
+        """LLM tokens (prompt and completion) used so far by the latest run."""
+        if self.deepsynth_agent is None:
+            return 0
+        tokens = self.deepsynth_agent.model.metrics.get("total_tokens", 0)
+        # Folding old runs into the session summary is part of the turn
+        summary_model = getattr(self.deepsynth_agent.memory, "summary_model", None)
+        if summary_model is not None:
+            tokens += summary_model.metrics.get("total_tokens", 0)
+        return tokens
+
+    def cancel(self):
+        """Stop the running stream, pending tool calls are skipped."""
+        self.cancel_event.set()
+
+    def save_cancelled_run(self, content: str):
+        """
+        Persist the part of the answer streamed before the client went away.
+
+        The run is stored like a finished one, with `cancelled` in its metrics,
+        so the history and the next turns of the session include it.
+        """
+        agent = self.deepsynth_agent
+        if agent is None or agent.run_response is None or self.message is None:
+            return
+        # Before the model was called the session may not be read yet, writing
+        # it then would replace the stored history
+        if not content and not agent.model.metrics:
+            return
+        user_message = Message(role="user", content=self.message)
+        run_response = agent.run_response
+        run_response.content = content
+        run_response.messages = [user_message, Message(role="assistant", content=content)]
+        run_response.metrics = {**(run_response.metrics or {}), "cancelled": True}
+        agent.memory.add_run(AgentRun(message=user_message, response=run_response))
+        agent.write_to_storage()
+        logger.info(f"[AGENT] Saved cancelled run {run_response.run_id}")
+
+    def _get_public_key(self, scope: WalletScope):
+        if not self.user_id:
+            return None
+        wallet = wallet_cache.get(self.user_id, scope)
+        return wallet.public_key if wallet else None
 
     def run(
         self,
@@ -122,44 +143,39 @@ class BaseAgent:
         stream: bool = False,
         db: Session = None,
     ):
-        if db is None:
-            db = next(get_db())
-
-        tools = [
-            search,
-            analyze_image,
-            OnchainTool(),
-        ]
-        deepsynth_agent = Agent(
-            name="DeepSynth",
-            model=OpenAILike(
-                id=settings.ATOMA_LLAMA_3_3_70B_INSTRUCT,
-                base_url=settings.ATOMA_BASE_URL,
-                api_key=settings.ATOMA_API_KEY,
-            ),
-            description=DeepSynthPromptEngineering().get_description(),
-            instructions=DeepSynthPromptEngineering().get_instructions(),
-            tools=tools,
-            # show_tool_calls=True,
-            markdown=True,
-            storage=storage,
-            read_chat_history=True,
-            session_id=self.session_id,
-            num_history_responses=10,
-            add_chat_history_to_messages=True,
+        wallet_scope = WalletScope()
+        public_key = self._get_public_key(wallet_scope)
+        deepsynth_agent = agent_factory.create(
             user_id=self.user_id,
-            info_mode=True,
-            add_datetime_to_instructions=True,
-            read_tool_call_history=True,
-            additional_context=f"You own the wallet with address: {WalletService(db).get_wallet_by_user_id(self.user_id).public_key if self.user_id else None}",
-            context={
-                "user_id": self.user_id,
-                "session_id": self.session_id,
-            },
+            session_id=self.session_id,
+            additional_context=f"You own the wallet with address: {public_key}",
+            wallet_scope=wallet_scope,
+            cancel_event=self.cancel_event,
         )
-        return deepsynth_agent.run(
-            message=message + " " + "\n".join(images), stream=stream
+        self.deepsynth_agent = deepsynth_agent
+        self.message = message + " " + "\n".join(images)
+        return deepsynth_agent.run(message=self.message, stream=stream)
+
+    async def arun(
+        self,
+        message: str,
+        images: list[str] = [],
+        stream: bool = False,
+        db: Session = None,
+    ):
+        wallet_scope = WalletScope()
+        public_key = await asyncio.to_thread(self._get_public_key, wallet_scope)
+        deepsynth_agent = agent_factory.create(
+            user_id=self.user_id,
+            session_id=self.session_id,
+            additional_context=f"You own the wallet with address: {public_key}",
+            asynchronous=True,
+            wallet_scope=wallet_scope,
+            cancel_event=self.cancel_event,
         )
+        self.deepsynth_agent = deepsynth_agent
+        self.message = message + " " + "\n".join(images)
+        return await deepsynth_agent.arun(message=self.message, stream=stream)
 
 
 def show_thinking_animation(stop_event):
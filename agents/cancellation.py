@@ -0,0 +1,56 @@
+import threading
+
+
+class RunCancelled(Exception):
+    """The client went away, the run stopped before the model was done."""
+
+
+class StreamMetrics:
+    """Agent streams in flight and the work given up when clients disconnect."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+        self.completed = 0
+        self.cancelled = 0
+        # Tokens spent on runs whose answer never reached the client
+        self.wasted_tokens = 0
+        # Upstream completions closed before the model finished
+        self.upstream_closed = 0
+        # Tool calls that never started because the run was cancelled
+        self.tool_calls_skipped = 0
+
+    def observe_start(self) -> None:
+        with self._lock:
+            self.active += 1
+
+    def observe_end(self, cancelled: bool, tokens: int) -> None:
+        with self._lock:
+            self.active = max(self.active - 1, 0)
+            if cancelled:
+                self.cancelled += 1
+                self.wasted_tokens += tokens
+            else:
+                self.completed += 1
+
+    def observe_upstream_closed(self) -> None:
+        with self._lock:
+            self.upstream_closed += 1
+
+    def observe_tool_calls_skipped(self, count: int) -> None:
+        with self._lock:
+            self.tool_calls_skipped += count
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "active": self.active,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "wasted_tokens": self.wasted_tokens,
+                "upstream_closed": self.upstream_closed,
+                "tool_calls_skipped": self.tool_calls_skipped,
+            }
+
+
+stream_metrics = StreamMetrics()
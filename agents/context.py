@@ -0,0 +1,288 @@
+import json
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+from phi.memory.agent import AgentMemory, AgentRun
+from phi.memory.summary import SessionSummary
+from phi.model.base import Model
+from phi.model.message import Message
+from pydantic import Field
+
+from log import logger
+
+# Pieces a BPE tokenizer rarely merges: words, numbers of up to three digits,
+# runs of punctuation and whitespace
+TOKEN_PIECES = re.compile(r"\s*[A-Za-z]+|\s*\d{1,3}|\s*[^\sA-Za-z\d]+|\s+")
+# A BPE token covers about 4 characters of a long word or identifier
+CHARS_PER_TOKEN = 4
+# Share of a token budget left free, as count_tokens only estimates the count
+ESTIMATE_MARGIN = 0.15
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a user and DeepSynth, "
+    "a crypto research assistant. Update the current summary with the new turns. "
+    "Keep the facts the user may refer to later: their goals, wallet addresses, "
+    "tokens, amounts, transactions and the conclusions reached. Drop greetings "
+    "and raw tool output. Reply with the updated summary only, in at most 200 words."
+)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate the tokens of a text without a tokenizer.
+
+    An approximation of Llama 3's BPE from `TOKEN_PIECES` and `CHARS_PER_TOKEN`,
+    it can be off either way, so budgets checked with it keep `ESTIMATE_MARGIN`
+    free.
+    """
+    if not text:
+        return 0
+    return sum(
+        max(1, -(-len(piece.strip() or piece) // CHARS_PER_TOKEN))
+        for piece in TOKEN_PIECES.findall(text)
+    )
+
+
+def count_message_tokens(message: Message) -> int:
+    tokens = count_tokens(message.get_content_string())
+    if message.tool_calls:
+        tokens += count_tokens(json.dumps(message.tool_calls))
+    return tokens
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """Keep the first `max_tokens` tokens of a text, noting how many were dropped."""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    kept, total = [], 0
+    for match in TOKEN_PIECES.finditer(text):
+        total += max(1, -(-len(match.group().strip() or match.group()) // CHARS_PER_TOKEN))
+        if total > max_tokens:
+            break
+        kept.append(match.group())
+    return f"{''.join(kept)}\n[... {tokens - max_tokens} more tokens elided]"
+
+
+class ContextMetrics:
+    """Tokens of history sent to the model, before and after the window was applied."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.windows = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.runs_dropped = 0
+        self.tool_outputs_elided = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    def observe_window(
+        self, before: int, after: int, runs_dropped: int, elided: int
+    ) -> None:
+        with self._lock:
+            self.windows += 1
+            self.tokens_before += before
+            self.tokens_after += after
+            self.runs_dropped += runs_dropped
+            self.tool_outputs_elided += elided
+
+    def observe_summary(self, failed: bool = False) -> None:
+        with self._lock:
+            if failed:
+                self.summary_failures += 1
+            else:
+                self.summaries += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "windows": self.windows,
+                "history_tokens_before": self.tokens_before,
+                "history_tokens_after": self.tokens_after,
+                "history_tokens_saved": self.tokens_before - self.tokens_after,
+                "history_tokens_before_avg": (
+                    round(self.tokens_before / self.windows, 1) if self.windows else 0.0
+                ),
+                "history_tokens_after_avg": (
+                    round(self.tokens_after / self.windows, 1) if self.windows else 0.0
+                ),
+                "runs_dropped": self.runs_dropped,
+                "tool_outputs_elided": self.tool_outputs_elided,
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+            }
+
+
+context_metrics = ContextMetrics()
+
+
+class RollingSummary(SessionSummary):
+    """A session summary that knows the newest run folded into it."""
+
+    last_run_id: Optional[str] = Field(None, exclude=True)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**super().to_dict(), "last_run_id": self.last_run_id}
+
+
+class WindowedMemory(AgentMemory):
+    """
+    Agent memory that fits the chat history in a token budget.
+
+    The history is built from the newest runs back, as long as they fit in
+    `token_budget`, less `ESTIMATE_MARGIN` since tokens are estimated. Tool
+    outputs longer than `tool_output_tokens` are cut, except in the latest run
+    when it fits whole. Runs left out of the window, or about to fall out of
+    the runs storage loads, are folded into a rolling summary after the run, at
+    most `summary_batch_runs` at a time, and the summary goes in the system
+    prompt instead. Runs over the batch are folded after the next turns, the
+    oldest first, before storage stops loading them.
+    """
+
+    token_budget: int = 6000
+    tool_output_tokens: int = 400
+    summary_batch_runs: int = 5
+    summary_model: Optional[Model] = None
+    # Index in `runs` of the oldest run in the last window, and the number of
+    # runs the agent asked for
+    window_start: int = 0
+    history_runs: Optional[int] = None
+
+    create_session_summary: bool = True
+    summary: Optional[RollingSummary] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        memory = super().to_dict()
+        for key in (
+            "token_budget",
+            "tool_output_tokens",
+            "summary_batch_runs",
+            "summary_model",
+            "window_start",
+            "history_runs",
+        ):
+            memory.pop(key, None)
+        return memory
+
+    def _run_messages(self, run: AgentRun, skip_role: Optional[str]) -> List[Message]:
+        if not run.response or not run.response.messages:
+            return []
+        return [m for m in run.response.messages if m.role != skip_role]
+
+    def _elide_tool_outputs(self, messages: List[Message]) -> tuple[List[Message], int]:
+        elided = 0
+        result = []
+        for message in messages:
+            if message.role == "tool":
+                content = message.get_content_string()
+                if count_tokens(content) > self.tool_output_tokens:
+                    message = message.model_copy(
+                        update={"content": truncate(content, self.tool_output_tokens)}
+                    )
+                    elided += 1
+            result.append(message)
+        return result, elided
+
+    def get_messages_from_last_n_runs(
+        self, last_n: Optional[int] = None, skip_role: Optional[str] = None
+    ) -> List[Message]:
+        runs = self.runs if last_n is None else self.runs[-last_n:]
+        self.history_runs = last_n
+        budget = int(self.token_budget * (1 - ESTIMATE_MARGIN))
+        window: List[List[Message]] = []
+        before = after = elided = 0
+        for index, run in enumerate(reversed(runs)):
+            messages = self._run_messages(run, skip_role)
+            tokens = sum(count_message_tokens(m) for m in messages)
+            before += tokens
+            if len(window) < index:
+                # A newer run did not fit, the older ones are left out too
+                continue
+            if index > 0 or after + tokens > budget:
+                messages, run_elided = self._elide_tool_outputs(messages)
+                tokens = sum(count_message_tokens(m) for m in messages)
+            else:
+                run_elided = 0
+            if window and after + tokens > budget:
+                continue
+            window.append(messages)
+            after += tokens
+            elided += run_elided
+
+        self.window_start = len(self.runs) - len(window)
+        context_metrics.observe_window(before, after, len(runs) - len(window), elided)
+        logger.debug(
+            f"History window: {len(window)} runs, {before} -> {after} tokens, "
+            f"{elided} tool outputs elided"
+        )
+        return [message for messages in reversed(window) for message in messages]
+
+    def _runs_to_summarize(self) -> List[AgentRun]:
+        # Runs before the window, or older than the ones storage loads next turn
+        end = self.window_start
+        if self.history_runs is not None:
+            end = max(end, len(self.runs) - self.history_runs)
+        start = 0
+        last_run_id = getattr(self.summary, "last_run_id", None)
+        if last_run_id:
+            for index, run in enumerate(self.runs):
+                if run.response and run.response.run_id == last_run_id:
+                    start = index + 1
+        # Bounds the summary prompt after a long session or a cold start
+        return self.runs[start:min(end, start + max(1, self.summary_batch_runs))]
+
+    def _summary_messages(self, runs: List[AgentRun]) -> List[Message]:
+        turns = []
+        for run in runs:
+            question = run.message.get_content_string() if run.message else ""
+            answer = run.response.get_content_as_string() if run.response else ""
+            turns.append(
+                f"User: {truncate(question, self.tool_output_tokens)}\n"
+                f"Assistant: {truncate(answer, self.tool_output_tokens)}"
+            )
+        current = self.summary.summary if self.summary else "(empty)"
+        return [
+            Message(role="system", content=SUMMARY_PROMPT),
+            Message(
+                role="user",
+                content=f"Current summary:\n{current}\n\nNew turns:\n" + "\n\n".join(turns),
+            ),
+        ]
+
+    def _set_summary(self, content: Optional[str], runs: List[AgentRun]) -> None:
+        if not content:
+            context_metrics.observe_summary(failed=True)
+            return
+        self.summary = RollingSummary(
+            summary=content.strip(), last_run_id=runs[-1].response.run_id
+        )
+        context_metrics.observe_summary()
+        logger.debug(f"Folded {len(runs)} runs into the session summary")
+
+    def update_summary(self) -> Optional[SessionSummary]:
+        runs = self._runs_to_summarize()
+        if not runs or self.summary_model is None:
+            return self.summary
+        try:
+            response = self.summary_model.response(self._summary_messages(runs))
+        except Exception as e:
+            logger.error(f"Could not update the session summary: {e}")
+            context_metrics.observe_summary(failed=True)
+            return self.summary
+        self._set_summary(response.content, runs)
+        return self.summary
+
+    async def aupdate_summary(self) -> Optional[SessionSummary]:
+        runs = self._runs_to_summarize()
+        if not runs or self.summary_model is None:
+            return self.summary
+        try:
+            response = await self.summary_model.aresponse(self._summary_messages(runs))
+        except Exception as e:
+            logger.error(f"Could not update the session summary: {e}")
+            context_metrics.observe_summary(failed=True)
+            return self.summary
+        self._set_summary(response.content, runs)
+        return self.summary
@@ -0,0 +1,263 @@
+import asyncio
+import threading
+from typing import Callable, List, Optional, Union
+
+import httpx
+from openai import OpenAI as OpenAIClient, AsyncOpenAI as AsyncOpenAIClient
+from phi.agent import Agent, AgentSession
+from phi.storage.agent.base import AgentStorage
+from phi.tools import Toolkit
+from phi.tools.function import Function
+
+from agents.context import RollingSummary, WindowedMemory
+from agents.models.llama import LlamaChat
+from app.services.wallet import WalletScope
+from config import settings
+from log import logger
+from prompt_engineering.deepsynth import DeepSynthPromptEngineering
+from tools.image_analyzer import analyze_image
+from tools.onchain import OnchainTool
+from tools.search import search
+
+
+class CompiledFunction(Function):
+    """
+    A Function whose entrypoint and JSON schema were processed once at startup.
+
+    phi calls `process_entrypoint` every time a tool is added to a model, which
+    re-parses the docstring and wraps the entrypoint in another `validate_call`.
+    Compiled functions skip that work and are copied per request so each agent
+    gets its own `_agent` binding.
+    """
+
+    # False for tools listed in their toolkit's `sequential_tools`, LlamaChat
+    # runs those one at a time, after the concurrent calls of their turn.
+    concurrent: bool = True
+
+    def process_entrypoint(self, strict: bool = False):
+        return
+
+    @classmethod
+    def from_function(
+        cls, function: Function, concurrent: bool = True
+    ) -> "CompiledFunction":
+        return cls(
+            **{name: getattr(function, name) for name in Function.model_fields},
+            concurrent=concurrent,
+        )
+
+
+class DeepSynthAgent(Agent):
+    # True while `_arun` runs, which does the storage I/O itself off the loop
+    _offload_storage: bool = False
+    _write_pending: bool = False
+
+    def read_from_storage(self) -> Optional[AgentSession]:
+        if self._offload_storage:
+            # Already read by `_arun` before the run started
+            return self._agent_session
+        return super().read_from_storage()
+
+    def write_to_storage(self) -> Optional[AgentSession]:
+        if self._offload_storage:
+            # Written by `_arun` before the next response is handed out
+            self._write_pending = True
+            return self._agent_session
+        return super().write_to_storage()
+
+    async def _awrite_to_storage(self) -> None:
+        self._write_pending = False
+        write = asyncio.ensure_future(asyncio.to_thread(Agent.write_to_storage, self))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # A cancelled run is saved once this write is over, not during it
+            await write
+            raise
+
+    async def _arun(self, *args, **kwargs):
+        """
+        phi's `_arun`, with the session read and written on a worker thread.
+
+        phi calls `read_from_storage` and `write_to_storage` inline, which
+        would block the event loop on the database and the pinning in Redis.
+        """
+        await asyncio.to_thread(Agent.read_from_storage, self)
+        self._offload_storage = True
+        try:
+            async for response in super()._arun(*args, **kwargs):
+                if self._write_pending:
+                    await self._awrite_to_storage()
+                yield response
+        finally:
+            self._offload_storage = False
+        if self._write_pending:
+            await self._awrite_to_storage()
+
+    def from_agent_session(self, session: AgentSession):
+        super().from_agent_session(session)
+        # phi loads the summary as a plain SessionSummary, which drops the run
+        # it was last updated with
+        summary = (session.memory or {}).get("summary")
+        if summary:
+            self.memory.summary = RollingSummary(**summary)
+
+
+def compile_tools(tools: List[Union[Toolkit, Callable]]) -> List[CompiledFunction]:
+    compiled: List[CompiledFunction] = []
+    for tool in tools:
+        if isinstance(tool, Toolkit):
+            sequential_tools = getattr(tool, "sequential_tools", [])
+            for name, function in tool.functions.items():
+                function.process_entrypoint()
+                compiled.append(
+                    CompiledFunction.from_function(
+                        function, concurrent=name not in sequential_tools
+                    )
+                )
+        else:
+            compiled.append(CompiledFunction.from_function(Function.from_callable(tool)))
+    return compiled
+
+
+class AgentFactory:
+    """
+    Builds the immutable parts of the DeepSynth agent once per process and binds
+    per-request state (user, session, wallet context) on top of them.
+    """
+
+    def __init__(self, storage: AgentStorage):
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._client: Optional[OpenAIClient] = None
+        self._async_client: Optional[AsyncOpenAIClient] = None
+        self._functions: Optional[List[CompiledFunction]] = None
+        prompt = DeepSynthPromptEngineering()
+        self.description = prompt.get_description()
+        self.instructions = prompt.get_instructions()
+
+    @property
+    def client(self) -> OpenAIClient:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = OpenAIClient(
+                        api_key=settings.ATOMA_API_KEY,
+                        base_url=settings.ATOMA_BASE_URL,
+                        http_client=httpx.Client(
+                            limits=httpx.Limits(
+                                max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                            ),
+                            timeout=settings.LLM_HTTP_TIMEOUT,
+                        ),
+                    )
+        return self._client
+
+    @property
+    def async_client(self) -> AsyncOpenAIClient:
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    self._async_client = AsyncOpenAIClient(
+                        api_key=settings.ATOMA_API_KEY,
+                        base_url=settings.ATOMA_BASE_URL,
+                        http_client=httpx.AsyncClient(
+                            limits=httpx.Limits(
+                                max_connections=settings.LLM_ASYNC_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                            ),
+                            timeout=settings.LLM_HTTP_TIMEOUT,
+                        ),
+                    )
+        return self._async_client
+
+    @property
+    def functions(self) -> List[CompiledFunction]:
+        if self._functions is None:
+            with self._lock:
+                if self._functions is None:
+                    self._functions = compile_tools(
+                        [search, analyze_image, OnchainTool()]
+                    )
+                    logger.info(
+                        f"[AGENT] Compiled {len(self._functions)} tool functions"
+                    )
+        return self._functions
+
+    def create_model(
+        self,
+        asynchronous: bool = False,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> LlamaChat:
+        return LlamaChat(
+            id=settings.ATOMA_LLAMA_3_3_70B_INSTRUCT,
+            name="LlamaChat",
+            provider="Atoma",
+            base_url=settings.ATOMA_BASE_URL,
+            api_key=settings.ATOMA_API_KEY,
+            client=None if asynchronous else self.client,
+            async_client=self.async_client if asynchronous else None,
+            tool_call_timeout=settings.TOOL_CALL_TIMEOUT,
+            tool_queue_timeout=settings.TOOL_QUEUE_TIMEOUT,
+            cancel_event=cancel_event,
+        )
+
+    def create(
+        self,
+        user_id: str,
+        session_id: Optional[str] = None,
+        additional_context: Optional[str] = None,
+        asynchronous: bool = False,
+        wallet_scope: Optional[WalletScope] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> Agent:
+        """
+        Create a DeepSynth agent bound to one user and session.
+
+        Args:
+            user_id (str): The user the agent acts for.
+            session_id (str, optional): The session to read and write history to.
+            additional_context (str, optional): Extra per-request context.
+            asynchronous (bool): Use a model built for `Agent.arun`, which streams on
+                the shared async client and runs tools off the event loop.
+            wallet_scope (WalletScope, optional): Wallets already looked up for this
+                request, shared with the onchain tools.
+            cancel_event (threading.Event, optional): Set to stop the run when the
+                client went away.
+
+        Returns:
+            Agent: A new agent sharing the process-wide client, tools and prompts.
+        """
+        return DeepSynthAgent(
+            name="DeepSynth",
+            model=self.create_model(
+                asynchronous=asynchronous, cancel_event=cancel_event
+            ),
+            description=self.description,
+            instructions=self.instructions,
+            tools=[function.model_copy() for function in self.functions],
+            # show_tool_calls=True,
+            markdown=True,
+            storage=self.storage,
+            memory=WindowedMemory(
+                token_budget=settings.AGENT_HISTORY_TOKEN_BUDGET,
+                tool_output_tokens=settings.AGENT_HISTORY_TOOL_OUTPUT_TOKENS,
+                summary_batch_runs=settings.AGENT_SUMMARY_BATCH_RUNS,
+                summary_model=self.create_model(asynchronous=asynchronous),
+            ),
+            read_chat_history=True,
+            session_id=session_id,
+            num_history_responses=settings.AGENT_HISTORY_RUNS,
+            add_chat_history_to_messages=True,
+            user_id=user_id,
+            info_mode=True,
+            add_datetime_to_instructions=True,
+            read_tool_call_history=True,
+            additional_context=additional_context,
+            context={
+                "user_id": user_id,
+                "session_id": session_id,
+                "wallet_scope": wallet_scope or WalletScope(),
+            },
+        )
@@ -0,0 +1,328 @@
+import base64
+from typing import Callable, Optional
+
+from sqlalchemy import text
+
+from agents.storage import RunStorage
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(*parts) -> str:
+    raw = ":".join(str(part) for part in parts)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str], size: int) -> Optional[list[str]]:
+    if not cursor:
+        return None
+    try:
+        parts = base64.urlsafe_b64decode(cursor.encode()).decode().split(":", size - 1)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if len(parts) != size:
+        raise ValueError("Invalid cursor")
+    return parts
+
+
+class SessionHistory:
+    """
+    Read-only view over the `agent_sessions` and `agent_runs` tables written
+    by RunStorage.
+
+    Every query is keyed on (user_id, updated_at) for sessions or
+    (session_id, seq) for runs so Postgres can answer it from an index, and
+    only the fields the history responses need are extracted from the run
+    JSONB columns.
+
+    Reads run in the sessions `read_session(user_id)` opens, the storage's
+    otherwise. Each has an `a`-prefixed async variant running in the sessions
+    of `async_read_session(user_id)`, for the async endpoints.
+    """
+
+    def __init__(
+        self,
+        storage: RunStorage,
+        read_session: Optional[Callable] = None,
+        async_read_session: Optional[Callable] = None,
+    ):
+        self.storage = storage
+        self.read_session = read_session or (lambda user_id: storage.Session())
+        self.async_read_session = async_read_session
+        self.table = f'"{storage.schema}"."{storage.table_name}"'
+        self.runs_table = f'"{storage.schema}"."{storage.runs_table_name}"'
+
+    # Every query is keyed on its user
+    def _execute(self, sql: str, params: dict) -> list:
+        with self.read_session(params["user_id"]) as session:
+            return session.execute(text(sql), params).mappings().all()
+
+    async def _aexecute(self, sql: str, params: dict) -> list:
+        async with self.async_read_session(params["user_id"]) as session:
+            result = await session.execute(text(sql), params)
+            return result.mappings().all()
+
+    @staticmethod
+    def _page_size(limit: Optional[int]) -> int:
+        return max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+
+    def _runs_query(
+        self,
+        user_id: str,
+        session_id: str,
+        before: Optional[int],
+        limit: Optional[int],
+    ) -> tuple[str, dict]:
+        # LIMIT NULL is LIMIT ALL in Postgres
+        return (
+            f"""
+            SELECT r.seq,
+                   r.message ->> 'content' AS user_message,
+                   r.message -> 'created_at' AS created_at,
+                   r.response ->> 'content' AS agent_message,
+                   COALESCE(
+                       CAST(r.response -> 'metrics' ->> 'cancelled' AS BOOLEAN),
+                       FALSE
+                   ) AS cancelled,
+                   (
+                       SELECT m -> 'images'
+                       FROM jsonb_array_elements(r.response -> 'messages') m
+                       WHERE m ->> 'role' = 'user'
+                       LIMIT 1
+                   ) AS images
+            FROM {self.runs_table} r
+            WHERE r.session_id = :session_id
+              AND r.user_id = :user_id
+              AND (CAST(:before AS BIGINT) IS NULL OR r.seq < CAST(:before AS BIGINT))
+            ORDER BY r.seq DESC
+            LIMIT :limit
+            """,
+            {
+                "session_id": session_id,
+                "user_id": user_id,
+                "before": before,
+                "limit": limit,
+            },
+        )
+
+    @staticmethod
+    def _format_runs(session_id: str, rows: list) -> list[dict]:
+        history = []
+        for row in rows:
+            history.extend(
+                [
+                    {
+                        "role": "user",
+                        "content": row["user_message"],
+                        "images": row["images"],
+                        "session_id": session_id,
+                        "created_at": row["created_at"],
+                    },
+                    {
+                        "role": "assistant",
+                        "content": row["agent_message"],
+                        "session_id": session_id,
+                        "cancelled": row["cancelled"],
+                    },
+                ]
+            )
+        return history
+
+    def _runs_page(self, session_id: str, rows: list, limit: int) -> dict:
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        return {
+            "data": self._format_runs(session_id, rows),
+            "next_cursor": encode_cursor(rows[0]["seq"]) if has_more else None,
+        }
+
+    def get_runs(
+        self,
+        user_id: str,
+        session_id: str,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> dict:
+        """
+        Get a page of runs for one session, newest page first.
+
+        Args:
+            user_id (str): Owner of the session.
+            session_id (str): Session to read.
+            cursor (str, optional): `next_cursor` from the previous page.
+            limit (int, optional): Number of runs per page.
+
+        Returns:
+            dict: `data` holds the messages of the page in chronological order,
+                `next_cursor` points to older runs or is None.
+        """
+        limit = self._page_size(limit)
+        before = decode_cursor(cursor, 1)
+        rows = self._execute(
+            *self._runs_query(
+                user_id, session_id, int(before[0]) if before else None, limit + 1
+            )
+        )
+        return self._runs_page(session_id, rows, limit)
+
+    async def aget_runs(
+        self,
+        user_id: str,
+        session_id: str,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> dict:
+        limit = self._page_size(limit)
+        before = decode_cursor(cursor, 1)
+        rows = await self._aexecute(
+            *self._runs_query(
+                user_id, session_id, int(before[0]) if before else None, limit + 1
+            )
+        )
+        return self._runs_page(session_id, rows, limit)
+
+    def _sessions_query(
+        self, user_id: str, after: Optional[list[str]], limit: int
+    ) -> tuple[str, dict]:
+        return (
+            f"""
+            SELECT s.session_id,
+                   r.message ->> 'content' AS last_message,
+                   COALESCE(r.seq, 0) AS total_runs,
+                   s.created_at,
+                   COALESCE(s.updated_at, s.created_at) AS updated_at
+            FROM {self.table} s
+            -- runs are numbered from 1 without gaps, the last seq is their count
+            LEFT JOIN LATERAL (
+                SELECT seq, message
+                FROM {self.runs_table}
+                WHERE session_id = s.session_id
+                ORDER BY seq DESC
+                LIMIT 1
+            ) r ON TRUE
+            WHERE s.user_id = :user_id
+              AND (
+                  CAST(:updated_at AS BIGINT) IS NULL
+                  OR (COALESCE(s.updated_at, s.created_at), s.session_id)
+                     < (CAST(:updated_at AS BIGINT), :session_id)
+              )
+            ORDER BY COALESCE(s.updated_at, s.created_at) DESC, s.session_id DESC
+            LIMIT :limit
+            """,
+            {
+                "user_id": user_id,
+                "updated_at": int(after[0]) if after else None,
+                "session_id": after[1] if after else None,
+                "limit": limit,
+            },
+        )
+
+    @staticmethod
+    def _sessions_page(rows: list, limit: int) -> dict:
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "data": [dict(row) for row in rows],
+            "next_cursor": (
+                encode_cursor(rows[-1]["updated_at"], rows[-1]["session_id"])
+                if has_more
+                else None
+            ),
+        }
+
+    def get_sessions(
+        self,
+        user_id: str,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> dict:
+        """
+        Get a page of session summaries for a user, most recently updated first.
+
+        Args:
+            user_id (str): Owner of the sessions.
+            cursor (str, optional): `next_cursor` from the previous page.
+            limit (int, optional): Number of sessions per page.
+
+        Returns:
+            dict: `data` holds the session summaries, `next_cursor` points to
+                older sessions or is None.
+        """
+        limit = self._page_size(limit)
+        after = decode_cursor(cursor, 2)
+        rows = self._execute(*self._sessions_query(user_id, after, limit + 1))
+        return self._sessions_page(rows, limit)
+
+    async def aget_sessions(
+        self,
+        user_id: str,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> dict:
+        limit = self._page_size(limit)
+        after = decode_cursor(cursor, 2)
+        rows = await self._aexecute(*self._sessions_query(user_id, after, limit + 1))
+        return self._sessions_page(rows, limit)
+
+    def get_session_history(self, user_id: str, session_id: str) -> list[dict]:
+        """Get every message of one session in chronological order."""
+        rows = self._execute(*self._runs_query(user_id, session_id, None, None))
+        return self._format_runs(session_id, list(reversed(rows)))
+
+    async def aget_session_history(self, user_id: str, session_id: str) -> list[dict]:
+        rows = await self._aexecute(*self._runs_query(user_id, session_id, None, None))
+        return self._format_runs(session_id, list(reversed(rows)))
+
+    def _all_histories_query(self, user_id: str) -> tuple[str, dict]:
+        return (
+            f"""
+            SELECT s.session_id,
+                   r.seq,
+                   r.message ->> 'content' AS user_message,
+                   r.message -> 'created_at' AS created_at,
+                   r.response ->> 'content' AS agent_message
+            FROM {self.table} s
+            LEFT JOIN {self.runs_table} r ON r.session_id = s.session_id
+            WHERE s.user_id = :user_id
+            ORDER BY s.created_at, s.session_id, r.seq
+            """,
+            {"user_id": user_id},
+        )
+
+    @staticmethod
+    def _group_histories(rows: list) -> list[list[dict]]:
+        sessions: dict[str, list[dict]] = {}
+        for row in rows:
+            session_id = row["session_id"]
+            history = sessions.setdefault(session_id, [])
+            if row["seq"] is None:
+                continue
+            history.extend(
+                [
+                    {
+                        "role": "user",
+                        "content": row["user_message"],
+                        "session_id": session_id,
+                        "created_at": row["created_at"],
+                    },
+                    {
+                        "role": "assistant",
+                        "content": row["agent_message"],
+                        "session_id": session_id,
+                    },
+                ]
+            )
+        return list(sessions.values())
+
+    def get_all_histories(self, user_id: str) -> list[list[dict]]:
+        """Get the messages of every session of a user, grouped by session."""
+        return self._group_histories(
+            self._execute(*self._all_histories_query(user_id))
+        )
+
+    async def aget_all_histories(self, user_id: str) -> list[list[dict]]:
+        return self._group_histories(
+            await self._aexecute(*self._all_histories_query(user_id))
+        )
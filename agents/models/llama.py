@@ -1,18 +1,27 @@
+import asyncio
+import collections.abc
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from os import getenv
 from dataclasses import dataclass, field
-from typing import Optional, List, Iterator, Dict, Any, Union
+from types import GeneratorType
+from typing import Optional, List, Iterator, AsyncIterator, Callable, Dict, Any, Tuple, Union
 
 import httpx
 from pydantic import BaseModel
 
 from phi.model.base import Model
 from phi.model.message import Message
-from phi.model.response import ModelResponse
-from phi.tools.function import FunctionCall
+from phi.model.response import ModelResponse, ModelResponseEvent
+from phi.tools.function import FunctionCall, ToolCallException
 from phi.utils.log import logger
 from phi.utils.timer import Timer
 from phi.utils.tools import get_function_call_for_tool_call
 
+from agents.cancellation import RunCancelled, stream_metrics
+from config import settings
+
 
 try:
     MIN_OPENAI_VERSION = (1, 52, 0)  # v1.52.0
@@ -48,6 +57,54 @@ except ModuleNotFoundError:
     )
 
 
+# Shared by every LlamaChat so concurrent tool calls stay bounded per process
+tool_executor = ThreadPoolExecutor(
+    max_workers=settings.TOOL_MAX_WORKERS, thread_name_prefix="tool"
+)
+
+
+class _ToolCallFuture:
+    """A tool call submitted to `tool_executor`, timed from when it starts running."""
+
+    def __init__(self, run: Callable[[FunctionCall], Any], function_call: FunctionCall):
+        self.started = threading.Event()
+        self.started_at: Optional[float] = None
+        self.submitted_at = time.monotonic()
+        self.future = tool_executor.submit(self._run, run, function_call)
+
+    def _run(self, run: Callable[[FunctionCall], Any], function_call: FunctionCall):
+        self.started_at = time.monotonic()
+        self.started.set()
+        return run(function_call)
+
+    def cancel(self) -> bool:
+        return self.future.cancel()
+
+    def result(
+        self, timeout: Optional[float] = None, queue_timeout: Optional[float] = None
+    ):
+        """
+        Wait for the call to return, up to `timeout` seconds after it started.
+
+        The time spent queued behind other turns' tools does not count against
+        `timeout`. The call is dropped when it did not start `queue_timeout`
+        seconds after it was submitted.
+
+        Raises:
+            concurrent.futures.TimeoutError: If the call did not start within
+                `queue_timeout` or ran longer than `timeout`, see `started`.
+        """
+        if queue_timeout is not None:
+            queue_timeout = max(0.0, self.submitted_at + queue_timeout - time.monotonic())
+        if not self.started.wait(queue_timeout) and self.future.cancel():
+            raise FuturesTimeoutError()
+        # Too late to drop it, it is starting
+        self.started.wait()
+        if timeout is None:
+            return self.future.result()
+        return self.future.result(max(0.0, self.started_at + timeout - time.monotonic()))
+
+
 @dataclass
 class Metrics:
     input_tokens: int = 0
@@ -90,7 +147,8 @@ class Metrics:
 
 @dataclass
 class StreamData:
-    response_content: str = ""
+    # Joined once the stream is over, `+=` on a str copies the whole answer per token
+    response_content: List[str] = field(default_factory=list)
     response_audio: Optional[dict] = None
     response_tool_calls: Optional[List[ChoiceDeltaToolCall]] = None
 
@@ -148,6 +206,30 @@ class LlamaChat(Model):
     structured_outputs: bool = False
     # Whether the Model supports structured outputs.
     supports_structured_outputs: bool = True
+    # Run the independent tool calls of one turn concurrently on `tool_executor`.
+    # Functions with `concurrent=False` still run one at a time, in order, once
+    # the concurrent calls of the turn have settled.
+    concurrent_tool_calls: bool = True
+    # Seconds each tool call may run, from when it starts, before reporting a
+    # timeout.
+    tool_call_timeout: Optional[float] = None
+    # Seconds a tool call may wait for a free worker of `tool_executor`.
+    tool_queue_timeout: Optional[float] = None
+    # Set when the client went away, the stream and pending tool calls stop.
+    cancel_event: Optional[threading.Event] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def _skip_tool_calls(self, count: int) -> None:
+        stream_metrics.observe_tool_calls_skipped(count)
+        raise RunCancelled()
+
+    def _add_partial_usage(self, chunks: int) -> None:
+        # A closed stream never gets its usage chunk, count one token per chunk
+        self.metrics["completion_tokens"] = self.metrics.get("completion_tokens", 0) + chunks
+        self.metrics["total_tokens"] = self.metrics.get("total_tokens", 0) + chunks
 
     def get_client_params(self) -> Dict[str, Any]:
         client_params: Dict[str, Any] = {}
@@ -353,7 +435,7 @@ class LlamaChat(Model):
             # message.content = "Tool call"
         if message.audio is not None:
             message = self.add_audio_to_message(message=message, audio=message.audio)
-        logger.info(message.to_dict())
+        logger.debug(message.to_dict())
         return message.to_dict()
 
     def invoke(
@@ -374,9 +456,9 @@ class LlamaChat(Model):
                     self.response_format, BaseModel
                 ):
                     formated_messages = [self.format_message(m) for m in messages]  # type: ignore
-                    logger.info("START FORMATED MESSAGES")
-                    logger.info(formated_messages)
-                    logger.info("END FORMATED MESSAGES")
+                    logger.debug("START FORMATED MESSAGES")
+                    logger.debug(formated_messages)
+                    logger.debug("END FORMATED MESSAGES")
                     return self.get_client().beta.chat.completions.parse(
                         model=self.id,
                         messages=formated_messages,
@@ -441,16 +523,31 @@ class LlamaChat(Model):
             Iterator[ChatCompletionChunk]: An iterator of chat completion chunks.
         """
         formated_messages = [self.format_message(m) for m in messages]  # type: ignore
-        logger.info("START FORMATED MESSAGES")
-        logger.info(formated_messages)
-        logger.info("END FORMATED MESSAGES")
-        yield from self.get_client().chat.completions.create(
+        logger.debug("START FORMATED MESSAGES")
+        logger.debug(formated_messages)
+        logger.debug("END FORMATED MESSAGES")
+        stream = self.get_client().chat.completions.create(
             model=self.id,
             messages=formated_messages,
             stream=True,
             stream_options={"include_usage": True},
             **self.request_kwargs,
         )  # type: ignore
+        chunks = 0
+        finished = False
+        try:
+            for chunk in stream:
+                if self.cancelled:
+                    raise RunCancelled()
+                chunks += 1
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                # Closing the response stops the generation upstream
+                stream.close()
+                stream_metrics.observe_upstream_closed()
+                self._add_partial_usage(chunks)
 
     async def ainvoke_stream(self, messages: List[Message]) -> Any:
         """
@@ -469,8 +566,21 @@ class LlamaChat(Model):
             stream_options={"include_usage": True},
             **self.request_kwargs,
         )
-        async for chunk in async_stream:  # type: ignore
-            yield chunk
+        chunks = 0
+        finished = False
+        try:
+            async for chunk in async_stream:  # type: ignore
+                if self.cancelled:
+                    raise RunCancelled()
+                chunks += 1
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                # Closing the response stops the generation upstream
+                await async_stream.close()
+                stream_metrics.observe_upstream_closed()
+                self._add_partial_usage(chunks)
 
     def handle_tool_calls(
         self,
@@ -544,6 +654,246 @@ class LlamaChat(Model):
             return model_response
         return None
 
+    def execute_function_call(
+        self, function_call: FunctionCall
+    ) -> Tuple[bool, List[Message], bool, float]:
+        """
+        Run a function call.
+
+        Args:
+            function_call (FunctionCall): The function call to run.
+
+        Returns:
+            Tuple[bool, List[Message], bool, float]: Whether the call succeeded, the
+                additional messages it produced, whether execution should stop after
+                it and the time it took.
+        """
+        if self.cancelled:
+            self._skip_tool_calls(1)
+        function_call_timer = Timer()
+        function_call_timer.start()
+        function_call_success = False
+        stop_execution_after_tool_call = False
+        additional_messages_from_function_call: List[Message] = []
+        try:
+            function_call_success = function_call.execute()
+        except ToolCallException as tce:
+            if tce.user_message is not None:
+                if isinstance(tce.user_message, str):
+                    additional_messages_from_function_call.append(
+                        Message(role="user", content=tce.user_message)
+                    )
+                else:
+                    additional_messages_from_function_call.append(tce.user_message)
+            if tce.agent_message is not None:
+                if isinstance(tce.agent_message, str):
+                    additional_messages_from_function_call.append(
+                        Message(role="assistant", content=tce.agent_message)
+                    )
+                else:
+                    additional_messages_from_function_call.append(tce.agent_message)
+            if tce.messages is not None and len(tce.messages) > 0:
+                for m in tce.messages:
+                    if isinstance(m, Message):
+                        additional_messages_from_function_call.append(m)
+                    elif isinstance(m, dict):
+                        try:
+                            additional_messages_from_function_call.append(
+                                Message(**m)
+                            )
+                        except Exception as e:
+                            logger.warning(f"Failed to convert dict to Message: {e}")
+            if tce.stop_execution:
+                stop_execution_after_tool_call = True
+                for m in additional_messages_from_function_call:
+                    m.stop_after_tool_call = True
+        function_call_timer.stop()
+        return (
+            function_call_success,
+            additional_messages_from_function_call,
+            stop_execution_after_tool_call,
+            function_call_timer.elapsed,
+        )
+
+    def run_function_calls(
+        self,
+        function_calls: List[FunctionCall],
+        function_call_results: List[Message],
+        tool_role: str = "tool",
+    ) -> Iterator[ModelResponse]:
+        """
+        Run the function calls of one turn, concurrently where allowed.
+
+        Results are yielded and appended in the order of `function_calls`, so they
+        line up with the tool_call ids of the assistant message. Sequential calls
+        run only after every concurrent call returned or timed out. Every call
+        runs on `tool_executor`, bounded by `tool_queue_timeout` and
+        `tool_call_timeout`.
+
+        Args:
+            function_calls (List[FunctionCall]): The function calls to run.
+            function_call_results (List[Message]): Receives the result messages.
+            tool_role (str): The role of the tool call. Defaults to "tool".
+
+        Returns:
+            Iterator[ModelResponse]: The tool call started and completed events.
+        """
+        concurrent_calls = [
+            function_call
+            for function_call in function_calls
+            if getattr(function_call.function, "concurrent", True)
+        ]
+        if not self.concurrent_tool_calls or len(concurrent_calls) < 2:
+            # Nothing to overlap, every call runs in turn
+            concurrent_calls = []
+
+        if self.function_call_stack is None:
+            self.function_call_stack = []
+
+        # Start every concurrent call up front, sequential ones when reached below
+        futures = {
+            id(function_call): _ToolCallFuture(
+                self.execute_function_call, function_call
+            )
+            for function_call in concurrent_calls
+        }
+        outcomes: Dict[int, Tuple[bool, List[Message], bool, float]] = {}
+
+        def settle(function_call: FunctionCall) -> None:
+            if id(function_call) in outcomes:
+                return
+            future = futures[id(function_call)]
+            try:
+                outcomes[id(function_call)] = future.result(
+                    self.tool_call_timeout, self.tool_queue_timeout
+                )
+            except FuturesTimeoutError:
+                if future.started.is_set():
+                    logger.warning(
+                        f"Tool call {function_call.get_call_str()} timed out after {self.tool_call_timeout}s"
+                    )
+                    function_call.error = (
+                        f"Tool call timed out after {self.tool_call_timeout} seconds."
+                    )
+                    elapsed = self.tool_call_timeout
+                else:
+                    logger.warning(
+                        f"Tool call {function_call.get_call_str()} not started after {self.tool_queue_timeout}s"
+                    )
+                    function_call.error = "Tool call not run, the tools are busy."
+                    elapsed = 0.0
+                outcomes[id(function_call)] = (False, [], False, elapsed)
+
+        for index, function_call in enumerate(function_calls):
+            if self.cancelled:
+                # Calls already running on the executor are left to finish
+                skipped = sum(1 for future in futures.values() if future.cancel())
+                skipped += sum(
+                    1 for pending in function_calls[index:] if id(pending) not in futures
+                )
+                self._skip_tool_calls(skipped)
+
+            # -*- Start function call
+            yield ModelResponse(
+                content=function_call.get_call_str(),
+                tool_call={
+                    "role": tool_role,
+                    "tool_call_id": function_call.call_id,
+                    "tool_name": function_call.function.name,
+                    "tool_args": function_call.arguments,
+                },
+                event=ModelResponseEvent.tool_call_started.value,
+            )
+
+            # -*- Run or wait for function call
+            if id(function_call) in futures:
+                settle(function_call)
+                outcome = outcomes[id(function_call)]
+            else:
+                # A sequential call, e.g. one moving funds, never overlaps the
+                # reads of its turn
+                for concurrent_call in concurrent_calls:
+                    settle(concurrent_call)
+                futures[id(function_call)] = _ToolCallFuture(
+                    self.execute_function_call, function_call
+                )
+                settle(function_call)
+                outcome = outcomes[id(function_call)]
+            (
+                function_call_success,
+                additional_messages_from_function_call,
+                stop_execution_after_tool_call,
+                elapsed,
+            ) = outcome
+
+            function_call_output: Optional[Union[List[Any], str]] = ""
+            if isinstance(
+                function_call.result, (GeneratorType, collections.abc.Iterator)
+            ):
+                for item in function_call.result:
+                    function_call_output += item
+                    if function_call.function.show_result:
+                        yield ModelResponse(content=item)
+            else:
+                function_call_output = function_call.result
+                if function_call.function.show_result:
+                    yield ModelResponse(content=function_call_output)
+
+            # -*- Create function call result message
+            function_call_result = Message(
+                role=tool_role,
+                content=(
+                    function_call_output
+                    if function_call_success
+                    else function_call.error
+                ),
+                tool_call_id=function_call.call_id,
+                tool_name=function_call.function.name,
+                tool_args=function_call.arguments,
+                tool_call_error=not function_call_success,
+                stop_after_tool_call=function_call.function.stop_after_tool_call
+                or stop_execution_after_tool_call,
+                metrics={"time": elapsed},
+            )
+
+            # -*- Yield function call result
+            yield ModelResponse(
+                content=f"{function_call.get_call_str()} completed in {elapsed:.4f}s.",
+                tool_call=function_call_result.model_dump(
+                    include={
+                        "content",
+                        "tool_call_id",
+                        "tool_name",
+                        "tool_args",
+                        "tool_call_error",
+                        "metrics",
+                        "created_at",
+                    }
+                ),
+                event=ModelResponseEvent.tool_call_completed.value,
+            )
+
+            # Add metrics to the model
+            self.metrics.setdefault("tool_call_times", {}).setdefault(
+                function_call.function.name, []
+            ).append(elapsed)
+
+            # Add the function call result to the function call results
+            function_call_results.append(function_call_result)
+            if len(additional_messages_from_function_call) > 0:
+                function_call_results.extend(additional_messages_from_function_call)
+            self.function_call_stack.append(function_call)
+
+            # -*- Check function call limit
+            if (
+                self.tool_call_limit
+                and len(self.function_call_stack) >= self.tool_call_limit
+            ):
+                self.deactivate_function_calls()
+                for pending in futures.values():
+                    pending.cancel()
+                break  # Exit early if we reach the function call limit
+
     def update_usage_metrics(
         self,
         assistant_message: Message,
@@ -822,9 +1172,11 @@ class LlamaChat(Model):
             model_response.audio = assistant_message.audio
 
         # -*- Handle tool calls
+        # Tools are blocking, run them off the event loop
         tool_role = "tool"
         if (
-            self.handle_tool_calls(
+            await asyncio.to_thread(
+                self.handle_tool_calls,
                 assistant_message=assistant_message,
                 messages=messages,
                 model_response=model_response,
@@ -991,6 +1343,39 @@ class LlamaChat(Model):
             if len(function_call_results) > 0:
                 messages.extend(function_call_results)
 
+    async def ahandle_stream_tool_calls(
+        self,
+        assistant_message: Message,
+        messages: List[Message],
+        tool_role: str = "tool",
+    ) -> AsyncIterator[ModelResponse]:
+        """
+        Handle tool calls for the asynchronous response stream.
+
+        Each step of `handle_stream_tool_calls` runs in a worker thread so blocking
+        tools do not stall the event loop.
+
+        Args:
+            assistant_message (Message): The assistant message.
+            messages (List[Message]): The list of messages.
+            tool_role (str): The role of the tool call. Defaults to "tool".
+
+        Returns:
+            AsyncIterator[ModelResponse]: An asynchronous iterator of the model response.
+        """
+        tool_call_responses = self.handle_stream_tool_calls(
+            assistant_message=assistant_message,
+            messages=messages,
+            tool_role=tool_role,
+        )
+        while True:
+            tool_call_response = await asyncio.to_thread(
+                next, tool_call_responses, None
+            )
+            if tool_call_response is None:
+                break
+            yield tool_call_response
+
     def response_stream(self, messages: List[Message]) -> Iterator[ModelResponse]:
         """
         Generate a streaming response from OpenAI.
@@ -1017,7 +1402,7 @@ class LlamaChat(Model):
                 response_delta: ChoiceDelta = response.choices[0].delta
 
                 if response_delta.content is not None:
-                    stream_data.response_content += response_delta.content
+                    stream_data.response_content.append(response_delta.content)
                     yield ModelResponse(content=response_delta.content)
 
                 if hasattr(response_delta, "audio"):
@@ -1038,8 +1423,9 @@ class LlamaChat(Model):
 
         # -*- Create assistant message
         assistant_message = Message(role="assistant")
-        if stream_data.response_content != "":
-            assistant_message.content = stream_data.response_content
+        response_content = "".join(stream_data.response_content)
+        if response_content != "":
+            assistant_message.content = response_content
 
         if stream_data.response_audio is not None:
             assistant_message.audio = stream_data.response_audio
@@ -1100,7 +1486,7 @@ class LlamaChat(Model):
                 response_delta: ChoiceDelta = response.choices[0].delta
 
                 if response_delta.content is not None:
-                    stream_data.response_content += response_delta.content
+                    stream_data.response_content.append(response_delta.content)
                     yield ModelResponse(content=response_delta.content)
 
                 if hasattr(response_delta, "audio"):
@@ -1121,8 +1507,9 @@ class LlamaChat(Model):
 
         # -*- Create assistant message
         assistant_message = Message(role="assistant")
-        if stream_data.response_content != "":
-            assistant_message.content = stream_data.response_content
+        response_content = "".join(stream_data.response_content)
+        if response_content != "":
+            assistant_message.content = response_content
 
         if stream_data.response_audio is not None:
             assistant_message.audio = stream_data.response_audio
@@ -1148,7 +1535,7 @@ class LlamaChat(Model):
             and self.run_tools
         ):
             tool_role = "tool"
-            for tool_call_response in self.handle_stream_tool_calls(
+            async for tool_call_response in self.ahandle_stream_tool_calls(
                 assistant_message=assistant_message,
                 messages=messages,
                 tool_role=tool_role,
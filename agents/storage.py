@@ -0,0 +1,234 @@
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from phi.agent.session import AgentSession
+from phi.storage.agent.postgres import PgAgentStorage
+from phi.utils.log import logger
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import Column, Index, Table
+from sqlalchemy.sql.expression import func, select, text
+from sqlalchemy.types import BigInteger, Integer, String
+
+# Keys of the session memory that live in the runs table instead
+RUN_MEMORY_KEYS = ("runs", "messages")
+
+
+class RunStorage(PgAgentStorage):
+    """
+    Agent sessions with their runs kept one row per run.
+
+    The sessions table only holds the session itself, its summary and user
+    memories. Each run is appended to `runs_table_name` once, numbered by `seq`
+    within its session, and reading a session loads only its last `num_runs`
+    runs, which is all the agent puts in its prompt.
+
+    `on_write` is called with the user id of every session written.
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        runs_table_name: str,
+        num_runs: int,
+        schema: Optional[str] = "ai",
+        db_engine: Optional[Engine] = None,
+        on_write: Optional[Callable[[Optional[str]], None]] = None,
+    ):
+        self.runs_table_name = runs_table_name
+        self.num_runs = num_runs
+        self.on_write = on_write
+        super().__init__(table_name=table_name, schema=schema, db_engine=db_engine)
+        self.runs_table = self.get_runs_table()
+
+    def get_runs_table(self) -> Table:
+        table = Table(
+            self.runs_table_name,
+            self.metadata,
+            Column("run_id", String, primary_key=True),
+            Column("session_id", String, nullable=False),
+            Column("user_id", String),
+            # Position of the run in its session, from 1
+            Column("seq", Integer, nullable=False),
+            # The user message and the run response, tool calls included
+            Column("message", postgresql.JSONB),
+            Column("response", postgresql.JSONB),
+            Column(
+                "created_at",
+                BigInteger,
+                server_default=text("(extract(epoch from now()))::bigint"),
+            ),
+            extend_existing=True,
+        )
+        Index(
+            f"ix_{self.runs_table_name}_session_id_seq",
+            table.c.session_id,
+            table.c.seq,
+            unique=True,
+        )
+        return table
+
+    def table_exists(self) -> bool:
+        if not super().table_exists():
+            return False
+        try:
+            return self.inspector.has_table(self.runs_table_name, schema=self.schema)
+        except Exception as e:
+            logger.error(f"Error checking if table exists: {e}")
+            return False
+
+    def create(self) -> None:
+        super().create()
+        try:
+            self.runs_table.create(self.db_engine, checkfirst=True)
+        except Exception as e:
+            logger.error(f"Could not create table: '{self.runs_table.fullname}': {e}")
+
+    def read(
+        self, session_id: str, user_id: Optional[str] = None
+    ) -> Optional[AgentSession]:
+        try:
+            with self.Session() as sess:
+                stmt = select(self.table).where(self.table.c.session_id == session_id)
+                if user_id:
+                    stmt = stmt.where(self.table.c.user_id == user_id)
+                row = sess.execute(stmt).fetchone()
+                if row is None:
+                    return None
+                runs = sess.execute(
+                    select(self.runs_table.c.message, self.runs_table.c.response)
+                    .where(self.runs_table.c.session_id == session_id)
+                    .order_by(self.runs_table.c.seq.desc())
+                    .limit(self.num_runs)
+                ).fetchall()
+        except Exception as e:
+            logger.debug(f"Exception reading from table: {e}")
+            self.create()
+            return None
+
+        session = AgentSession.model_validate(row)
+        memory = dict(session.memory or {})
+        memory["runs"] = [
+            {"message": message, "response": response}
+            for message, response in reversed(runs)
+        ]
+        # Tool call history is read from the messages of these runs
+        memory["messages"] = [
+            message
+            for run in memory["runs"]
+            for message in (run["response"] or {}).get("messages") or []
+            if message.get("role") != "system"
+        ]
+        session.memory = memory
+        return session
+
+    def _new_runs(self, sess, session_id: str, runs: List[Dict[str, Any]]) -> list:
+        run_ids = [
+            run["response"]["run_id"]
+            for run in runs
+            if (run.get("response") or {}).get("run_id")
+        ]
+        if not run_ids:
+            return []
+        stored = set(
+            sess.execute(
+                select(self.runs_table.c.run_id).where(
+                    self.runs_table.c.session_id == session_id,
+                    self.runs_table.c.run_id.in_(run_ids),
+                )
+            ).scalars()
+        )
+        return [
+            run
+            for run in runs
+            if (run.get("response") or {}).get("run_id") not in (stored | {None})
+        ]
+
+    def upsert(
+        self, session: AgentSession, create_and_retry: bool = True
+    ) -> Optional[AgentSession]:
+        """
+        Write the session row and append the runs not stored yet.
+
+        Runs already in the table are never rewritten, so a turn writes its own
+        run and the small session row whatever the length of the session.
+        """
+        memory = {
+            key: value
+            for key, value in (session.memory or {}).items()
+            if key not in RUN_MEMORY_KEYS
+        }
+        runs = (session.memory or {}).get("runs") or []
+        try:
+            with self.Session() as sess, sess.begin():
+                # Concurrent turns of one session take their seq in turn. The
+                # session row may not exist yet, so it cannot be the lock.
+                sess.execute(
+                    select(func.pg_advisory_xact_lock(func.hashtext(session.session_id)))
+                )
+                new_runs = self._new_runs(sess, session.session_id, runs)
+                if new_runs:
+                    last_seq = sess.execute(
+                        select(func.coalesce(func.max(self.runs_table.c.seq), 0)).where(
+                            self.runs_table.c.session_id == session.session_id
+                        )
+                    ).scalar()
+                    sess.execute(
+                        postgresql.insert(self.runs_table)
+                        .values(
+                            [
+                                {
+                                    "run_id": run["response"]["run_id"],
+                                    "session_id": session.session_id,
+                                    "user_id": session.user_id,
+                                    "seq": last_seq + index,
+                                    "message": run.get("message"),
+                                    "response": run["response"],
+                                }
+                                for index, run in enumerate(new_runs, start=1)
+                            ]
+                        )
+                        .on_conflict_do_nothing(index_elements=["run_id"])
+                    )
+
+                values = dict(
+                    agent_id=session.agent_id,
+                    user_id=session.user_id,
+                    memory=memory,
+                    agent_data=session.agent_data,
+                    user_data=session.user_data,
+                    session_data=session.session_data,
+                )
+                sess.execute(
+                    postgresql.insert(self.table)
+                    .values(session_id=session.session_id, **values)
+                    .on_conflict_do_update(
+                        index_elements=["session_id"],
+                        set_=dict(values, updated_at=int(time.time())),
+                    )
+                )
+        except Exception as e:
+            if create_and_retry and not self.table_exists():
+                logger.debug(f"Exception upserting into table: {e}")
+                self.create()
+                return self.upsert(session, create_and_retry=False)
+            logger.error(f"Could not write session {session.session_id}: {e}")
+            return None
+        if self.on_write is not None:
+            self.on_write(session.user_id)
+        # The caller's session already holds the runs it needs, no read back
+        return session
+
+    def delete_session(self, session_id: Optional[str] = None):
+        if session_id is None:
+            return
+        super().delete_session(session_id)
+        try:
+            with self.Session() as sess, sess.begin():
+                sess.execute(
+                    self.runs_table.delete().where(
+                        self.runs_table.c.session_id == session_id
+                    )
+                )
+        except Exception as e:
+            logger.error(f"Error deleting runs of session {session_id}: {e}")
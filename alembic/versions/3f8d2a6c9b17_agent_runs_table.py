@@ -0,0 +1,91 @@
+"""agent runs table
+
+Revision ID: 3f8d2a6c9b17
+Revises: 7e2b9c4d1a05
+Create Date: 2025-02-17 09:41:05.532194
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3f8d2a6c9b17"
+down_revision: Union[str, None] = "7e2b9c4d1a05"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Same table RunStorage creates on first use. Existing sessions have their
+    # runs moved out of the memory JSONB, keeping their order as seq.
+    op.execute(
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('ai.agent_sessions') IS NOT NULL THEN
+                CREATE TABLE IF NOT EXISTS ai.agent_runs (
+                    run_id VARCHAR NOT NULL PRIMARY KEY,
+                    session_id VARCHAR NOT NULL,
+                    user_id VARCHAR,
+                    seq INTEGER NOT NULL,
+                    message JSONB,
+                    response JSONB,
+                    created_at BIGINT DEFAULT (extract(epoch from now()))::bigint
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS ix_agent_runs_session_id_seq
+                ON ai.agent_runs (session_id, seq);
+
+                INSERT INTO ai.agent_runs
+                    (run_id, session_id, user_id, seq, message, response, created_at)
+                SELECT COALESCE(r.run -> 'response' ->> 'run_id', md5(s.session_id || ':' || r.seq)),
+                       s.session_id,
+                       s.user_id,
+                       r.seq,
+                       r.run -> 'message',
+                       r.run -> 'response',
+                       COALESCE(
+                           CAST(r.run -> 'response' ->> 'created_at' AS BIGINT),
+                           s.created_at
+                       )
+                FROM ai.agent_sessions s,
+                     jsonb_array_elements(s.memory -> 'runs') WITH ORDINALITY AS r(run, seq)
+                ON CONFLICT DO NOTHING;
+
+                UPDATE ai.agent_sessions
+                SET memory = memory - 'runs' - 'messages'
+                WHERE memory ?| ARRAY['runs', 'messages'];
+            END IF;
+        END $$;
+        """
+    )
+
+
+def downgrade() -> None:
+    # Only the runs come back, the flat message list phi reads tool calls
+    # from is not restored
+    op.execute(
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('ai.agent_runs') IS NOT NULL THEN
+                UPDATE ai.agent_sessions s
+                SET memory = COALESCE(s.memory, '{}'::jsonb) || jsonb_build_object('runs', r.runs)
+                FROM (
+                    SELECT session_id,
+                           jsonb_agg(
+                               jsonb_build_object('message', message, 'response', response)
+                               ORDER BY seq
+                           ) AS runs
+                    FROM ai.agent_runs
+                    GROUP BY session_id
+                ) r
+                WHERE s.session_id = r.session_id;
+                DROP TABLE ai.agent_runs;
+            END IF;
+        END $$;
+        """
+    )
@@ -0,0 +1,42 @@
+"""index agent sessions history
+
+Revision ID: 7e2b9c4d1a05
+Revises: 1c3a6f33fd6a
+Create Date: 2025-02-10 10:12:31.418207
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7e2b9c4d1a05"
+down_revision: Union[str, None] = "1c3a6f33fd6a"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # ai.agent_sessions is created by PgAgentStorage on first use, so it may not
+    # exist yet on a fresh database.
+    op.execute(
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('ai.agent_sessions') IS NOT NULL THEN
+                CREATE INDEX IF NOT EXISTS ix_agent_sessions_user_id_updated_at
+                ON ai.agent_sessions (user_id, (COALESCE(updated_at, created_at)) DESC, session_id DESC);
+                CREATE INDEX IF NOT EXISTS ix_agent_sessions_user_id_session_id
+                ON ai.agent_sessions (user_id, session_id);
+            END IF;
+        END $$;
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ai.ix_agent_sessions_user_id_updated_at")
+    op.execute("DROP INDEX IF EXISTS ai.ix_agent_sessions_user_id_session_id")
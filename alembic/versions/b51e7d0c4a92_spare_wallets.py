@@ -0,0 +1,48 @@
+"""spare wallets
+
+Revision ID: b51e7d0c4a92
+Revises: 3f8d2a6c9b17
+Create Date: 2025-02-19 14:22:47.106385
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b51e7d0c4a92"
+down_revision: Union[str, None] = "3f8d2a6c9b17"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # pgp_sym_encrypt / pgp_sym_decrypt for the spare private keys
+    op.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto")
+    op.create_table(
+        "spare_wallets",
+        sa.Column("id", sa.String(), nullable=False),
+        sa.Column("public_key", sa.String(), nullable=False),
+        sa.Column("private_key", sa.LargeBinary(), nullable=False),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_spare_wallets_created_at"),
+        "spare_wallets",
+        ["created_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_spare_wallets_created_at"), table_name="spare_wallets")
+    op.drop_table("spare_wallets")
@@ -0,0 +1,101 @@
+"""referral uses
+
+Revision ID: e9a4c27f1d38
+Revises: b51e7d0c4a92
+Create Date: 2025-02-21 16:05:12.874301
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "e9a4c27f1d38"
+down_revision: Union[str, None] = "b51e7d0c4a92"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "referral_uses",
+        sa.Column("referral_id", sa.String(), nullable=False),
+        sa.Column("user_id", sa.String(), nullable=False),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+        sa.ForeignKeyConstraint(["referral_id"], ["referrals.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("referral_id", "user_id"),
+    )
+    op.add_column(
+        "referrals",
+        sa.Column("total_used", sa.Integer(), server_default=sa.text("0"), nullable=False),
+    )
+
+    # One row per referred user still in users, dated by their signup. Ids
+    # listed twice or of deleted users are not carried over.
+    op.execute(
+        """
+        INSERT INTO referral_uses (referral_id, user_id, created_at)
+        SELECT r.id, u.id, u.created_at
+        FROM referrals r
+        CROSS JOIN LATERAL jsonb_array_elements_text(
+            COALESCE(r.referred_user_ids, '[]'::jsonb)
+        ) AS referred(user_id)
+        JOIN users u ON u.id = referred.user_id
+        ON CONFLICT DO NOTHING
+        """
+    )
+    op.execute(
+        """
+        UPDATE referrals r
+        SET total_used = used.total
+        FROM (
+            SELECT referral_id, count(*) AS total
+            FROM referral_uses
+            GROUP BY referral_id
+        ) used
+        WHERE r.id = used.referral_id
+        """
+    )
+    op.create_index(
+        "ix_referrals_total_used",
+        "referrals",
+        [sa.text("total_used DESC"), "id"],
+        unique=False,
+    )
+    op.drop_column("referrals", "referred_user_ids")
+
+
+def downgrade() -> None:
+    op.add_column(
+        "referrals",
+        sa.Column(
+            "referred_user_ids",
+            postgresql.JSONB(astext_type=sa.Text()),
+            nullable=True,
+        ),
+    )
+    op.execute(
+        """
+        UPDATE referrals r
+        SET referred_user_ids = COALESCE(
+            (
+                SELECT jsonb_agg(user_id ORDER BY created_at)
+                FROM referral_uses
+                WHERE referral_id = r.id
+            ),
+            '[]'::jsonb
+        )
+        """
+    )
+    op.drop_index("ix_referrals_total_used", table_name="referrals")
+    op.drop_column("referrals", "total_used")
+    op.drop_table("referral_uses")
@@ -1,16 +1,110 @@
+import asyncio
+from typing import Optional
+
+import anyio
+
 from app.services.agent import AgentService
+from config import settings
 from log import logger
 
+# Returned by next() once the sync agent's stream is over
+_END = object()
+
 
 class AgentController:
     def __init__(self, user_id: str, session_id: str = None):
         self.user_id = user_id
         self.session_id = session_id
         self.agent_service = AgentService(user_id, session_id)
+        # Cleared while the agent runs a stream, set once it stopped for good
+        self._stopped = asyncio.Event()
+        self._stopped.set()
 
     def call_agent(self, message: str, images: list[str] = []):
         return self.agent_service.call_agent(message, images)
 
+    async def acall_agent(self, message: str, images: list[str] = []):
+        return await self.agent_service.acall_agent(message, images)
+
+    async def stream_tokens(self, message: str, images: list[str] = []):
+        """
+        Answer tokens as they come, from the async or the threadpool agent.
+
+        Closing or cancelling this generator early cancels the run. The agent
+        may still be busy then, on a worker thread or closing the upstream
+        completion; `wait_stopped` tells when it is done.
+        """
+        self._stopped.clear()
+        try:
+            if settings.AGENT_ASYNC_MODE:
+                async for token in self._astream(message, images):
+                    yield token
+            else:
+                async for token in self._stream_in_threadpool(message, images):
+                    yield token
+        finally:
+            self._stopped.set()
+
+    async def _astream(self, message: str, images: list[str]):
+        response = await self.acall_agent(message, images)
+        try:
+            async for chunk in response:
+                yield chunk.content
+        finally:
+            # Runs the agent's own finally blocks now rather than when the
+            # generator is collected, e.g. counting a closed stream's tokens
+            await response.aclose()
+
+    async def _stream_in_threadpool(self, message: str, images: list[str]):
+        def tokens():
+            for chunk in self.call_agent(message, images):
+                yield chunk.content
+
+        # The sync agent holds a worker thread for each step of the LLM turn.
+        # A step is shielded so that a cancelled stream still waits for it, a
+        # cancelled thread would otherwise keep changing the agent unseen.
+        iterator = tokens()
+        step = None
+        try:
+            while True:
+                step = asyncio.ensure_future(
+                    anyio.to_thread.run_sync(next, iterator, _END)
+                )
+                token = await asyncio.shield(step)
+                if token is _END:
+                    return
+                yield token
+        finally:
+            if step is not None and not step.done():
+                self.cancel()
+                try:
+                    await step
+                except BaseException:
+                    pass
+            await anyio.to_thread.run_sync(iterator.close)
+
+    async def wait_stopped(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the agent to be done with its stream, after a cancel.
+
+        Returns:
+            bool: False if it still runs after `timeout` seconds.
+        """
+        try:
+            await asyncio.wait_for(self._stopped.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def llm_tokens_used(self) -> int:
+        return self.agent_service.llm_tokens_used()
+
+    def cancel(self):
+        self.agent_service.cancel()
+
+    def save_cancelled_run(self, content: str):
+        self.agent_service.save_cancelled_run(content)
+
     def get_agent_history(self):
         try:
             return self.agent_service.get_history()
@@ -20,3 +114,16 @@ class AgentController:
             traceback.print_exc()
             logger.error(f"[AGENT] Failed to get history: {e}")
             return []
+
+    def get_agent_history_page(self, cursor: str = None, limit: int = None):
+        return self.agent_service.get_history_page(cursor=cursor, limit=limit)
+
+    async def aget_agent_history(self):
+        try:
+            return await self.agent_service.aget_history()
+        except Exception as e:
+            logger.error(f"[AGENT] Failed to get history: {e}")
+            return []
+
+    async def aget_agent_history_page(self, cursor: str = None, limit: int = None):
+        return await self.agent_service.aget_history_page(cursor=cursor, limit=limit)
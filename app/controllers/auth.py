@@ -1,30 +1,30 @@
 from app.dto import LoginRequest, SignupRequest
-from sqlalchemy.orm import Session
-from app.services.user import UserService
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services.user import AsyncUserService, LoginRecord
 from fastapi import HTTPException
 from datetime import datetime, timedelta
 import jwt
 from config import settings
-from app.services.wallet import WalletService
+from app.services.wallet import AsyncWalletService, wallet_reservoir
+from app.database.replicas import replica_router
 from app.dto import SocialCallbackRequest
-from app.services.referral import ReferralService
+from app.services.referral import AsyncReferralService
 from log import logger
 from app.utils.functions import generate_uuid
 from app.services.auth import auth_service
 from config import settings
 from app.utils.functions import verify_jwt_token, create_jwt_token
-from app.middleware.redis import get_redis_client
-from app.dto import UserRequestDTO
+from app.middleware.redis import get_async_redis_client
+from fastapi.concurrency import run_in_threadpool
 
 
 class AuthController:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
-        self.redis_client = get_redis_client()
 
-    def login(self, body: LoginRequest):
-        user_service = UserService(self.db)
-        user = user_service.get_user_by_email(body.email)
+    async def login(self, body: LoginRequest):
+        user_service = AsyncUserService(self.db)
+        user = await user_service.get_user_by_email(body.email)
         if not user:
             raise HTTPException(status_code=401, detail="Invalid username or password")
         if not user.password == body.password:
@@ -47,19 +47,19 @@ class AuthController:
             "refresh_token": refresh_token,
         }
 
-    def signup(self, body: SignupRequest):
-        user_service = UserService(self.db)
-        user = user_service.get_user_by_email(body.email)
+    async def signup(self, body: SignupRequest):
+        user_service = AsyncUserService(self.db)
+        user = await user_service.get_user_by_email(body.email)
         if user:
             raise HTTPException(status_code=401, detail="User already exists")
         body.avatar = (
             body.avatar
             or f"https://avatar.iran.liara.run/username?username={body.username}"
         )
-        user = user_service.create_user(body)
+        user = await user_service.create_user(body)
         # Create wallet
-        wallet_service = WalletService(self.db)
-        wallet = wallet_service.create_wallet(user.id)
+        wallet_service = AsyncWalletService(self.db)
+        wallet = await wallet_service.create_wallet(user.id)
 
         return {
             "message": "Signup successful",
@@ -74,10 +74,24 @@ class AuthController:
             },
         }
 
-    def callback_social(self, body: SocialCallbackRequest):
-        user_service = UserService(self.db)
-        wallet_service = WalletService(self.db)
-        referral_service = ReferralService(self.db)
+    async def _complete_login(self, login: LoginRecord) -> LoginRecord:
+        """Create the wallet or referral the login statement could not."""
+        if login.wallet_claimed:
+            wallet_reservoir.metrics.observe_claim(True)
+        updates = {}
+        if login.public_key is None:
+            wallet = await AsyncWalletService(self.db).create_wallet(login.id)
+            updates["public_key"] = wallet.public_key
+        if login.referral_code is None:
+            referral = AsyncReferralService(self.db).create_referral(login.id)
+            updates.update(referral_code=referral.referral_code, total_used=0)
+        if login.created or login.wallet_claimed or updates:
+            # The user is read right after, by verify_token and the agent tools
+            await replica_router.apin(login.id)
+        return login._replace(**updates)
+
+    async def callback_social(self, body: SocialCallbackRequest):
+        user_service = AsyncUserService(self.db)
 
         # Set default avatar if not provided
         body.avatar = (
@@ -85,68 +99,52 @@ class AuthController:
             or f"https://avatar.iran.liara.run/username?username={body.username}"
         )
 
-        # Get or create user
         try:
-            # Start transaction
-            self.db.begin()
-            # Get or create user
-            user = user_service.get_user_by_email(body.email)
-            if not user:
-
-                user = user_service.create_user(
-                    body,
-                    body.ref_code,
-                )
-
-                wallet = wallet_service.create_wallet(user.id)
-            else:
-                wallet = wallet_service.get_wallet_by_user_id(user.id)
-
-            # Get or create referral
-            referral = referral_service.get_referral_by_user_id(user.id)
-            if not referral:
-                referral = referral_service.create_referral(user.id)
-
-            self.db.commit()
+            # Get or create the user, their wallet and referral
+            login = await user_service.login_or_register(
+                body.email, body.username, body.avatar, body.ref_code
+            )
+            login = await self._complete_login(login)
+            await self.db.commit()
             # Generate JWT token
             token = jwt.encode(
-                {"sub": str(user.id), "exp": datetime.now() + timedelta(hours=1)},
+                {"sub": str(login.id), "exp": datetime.now() + timedelta(hours=1)},
                 settings.JWT_SECRET_KEY,
                 algorithm=settings.JWT_ALGORITHM,
             )
-            # Commit transaction
 
             return {
                 "message": "Social callback successful",
                 "access_token": token,
-                "wallet": {"public_key": wallet.public_key},
+                "wallet": {"public_key": login.public_key},
                 "user": {
-                    "id": user.id,
-                    "email": user.email,
-                    "username": user.username,
-                    "avatar": user.avatar,
+                    "id": login.id,
+                    "email": login.email,
+                    "username": login.username,
+                    "avatar": login.avatar,
                 },
                 "referral": {
-                    "code": referral.referral_code,
-                    "total_used": referral.total_used,
+                    "code": login.referral_code,
+                    "total_used": login.total_used,
                 },
             }
         except Exception as e:
             # Rollback transaction in case of any error
-            self.db.rollback()
+            await self.db.rollback()
             logger.error(f"Error during social callback: {str(e)}")
             raise HTTPException(
                 status_code=500, detail=f"Error during social callback: {str(e)}"
             )
 
-    def auth_x(self) -> str:
+    async def auth_x(self) -> str:
         """Initiate X OAuth2 flow"""
         # Generate OAuth parameters
         oauth_params = auth_service.generate_x_oauth_params()
 
         # Store state and verifier
-        self.redis_client.set(oauth_params["state"], oauth_params["code_verifier"])
-        self.redis_client.expire(oauth_params["state"], 60 * 5)
+        await get_async_redis_client().set(
+            oauth_params["state"], oauth_params["code_verifier"], ex=60 * 5
+        )
         # Construct X OAuth URL
         x_auth_url = (
             "https://x.com/i/oauth2/authorize"
@@ -160,14 +158,16 @@ class AuthController:
         )
         return x_auth_url
 
-    def callback_x(self, code: str, state: str):
-        code_verifier = self.redis_client.get(state)
+    async def callback_x(self, code: str, state: str):
+        code_verifier = await get_async_redis_client().get(state)
 
         if not code_verifier:
             raise HTTPException(status_code=400, detail="Invalid state")
 
         try:
-            result = auth_service.handle_x_callback(code, code_verifier)
+            result = await run_in_threadpool(
+                auth_service.handle_x_callback, code, code_verifier
+            )
             # Redirect to frontend with token
             frontend_url = f"{settings.FRONTEND_URL}/login?token={result['token']}"
             logger.debug(f"Frontend URL: {frontend_url}")
@@ -178,7 +178,7 @@ class AuthController:
                 status_code=500, detail=f"Error during X callback: {str(e)}"
             )
 
-    def login_x(self, token: str, ref_code: str = None):
+    async def login_x(self, token: str, ref_code: str = None):
         """Handle direct X token login"""
         try:
             # TODO: implement X token login using the access token
@@ -188,36 +188,14 @@ class AuthController:
             user_id = idinfo["sub"]
             username = idinfo.get("username")
             name = idinfo.get("name")
-            address = idinfo.get("address", "")
-            # Create user
-            user_service = UserService(self.db)
-            user = user_service.get_user_by_email(username)
-            logger.debug(f"User Exists: {user}")
-            if not user:
-                user_data = UserRequestDTO(
-                    email=username,
-                    username=username,
-                )
-                user = user_service.create_user(user_data, ref_code, user_id)
-                logger.debug(f"User created: {user}")
-            # Create wallet
-            # wallet_service = WalletService(self.db)
-            # wallet = wallet_service.get_wallet_by_user_id(user.id)
-            # if not wallet:
-            #     wallet = wallet_service.create_wallet(user.id)
-            # Create referral
-            referral_service = ReferralService(self.db)
-            referral = referral_service.get_referral_by_user_id(user.id)
-            if not referral:
-                referral = referral_service.create_referral(user.id)
-            # Commit transaction
-
-            # Get wallet
-            wallet_service = WalletService(self.db)
-            wallet = wallet_service.get_wallet_by_user_id(user.id)
-            if not wallet:
-                wallet = wallet_service.create_wallet(user.id)
-            self.db.commit()
+            # Get or create the user, their wallet and referral
+            user_service = AsyncUserService(self.db)
+            login = await user_service.login_or_register(
+                username, username, ref_code=ref_code, id=user_id
+            )
+            logger.debug(f"Login: {login}")
+            login = await self._complete_login(login)
+            await self.db.commit()
             # TODO: create JWT token for our system
             jwt_token = create_jwt_token(
                 {"sub": user_id, "username": username, "name": name}
@@ -229,11 +207,11 @@ class AuthController:
                     "id": user_id,
                     "username": username,
                     "name": name,
-                    "avatar": user.avatar,
-                    "wallet": {"public_key": wallet.public_key},
+                    "avatar": login.avatar,
+                    "wallet": {"public_key": login.public_key},
                     "referral": {
-                        "code": referral.referral_code,
-                        "total_used": referral.total_used,
+                        "code": login.referral_code,
+                        "total_used": login.total_used,
                     },
                 },
             }
@@ -1,21 +1,21 @@
 from app.dto import UseRefCodeRequest
-from sqlalchemy.orm import Session
-from app.services.referral import ReferralService
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services.referral import AsyncReferralService
 from fastapi import HTTPException
-from app.models.user import User
-from app.core.exceptions import AppException
+from app.middleware.auth import Principal
+from app.core.exceptions import AppException, ErrorCode
 from app.core.response import ResponseHandler
 
 
 class ReferralController:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
-        self.referral_service = ReferralService(db)
+        self.referral_service = AsyncReferralService(db)
 
-    def use_ref(self, body: UseRefCodeRequest, user: User):
+    async def use_ref(self, body: UseRefCodeRequest, user: Principal):
         user_id = user.id
         try:
-            self.referral_service.use_ref_code(user_id, body.ref_code)
+            await self.referral_service.use_ref_code(user_id, body.ref_code)
             return ResponseHandler.success(message="Referral code used successfully")
         except AppException as e:
             raise HTTPException(
@@ -25,3 +25,23 @@ class ReferralController:
                     "code": e.error_code,
                 },
             )
+
+    async def get_leaderboard(self, limit: int):
+        leaderboard = await self.referral_service.get_leaderboard(limit)
+        return ResponseHandler.success(
+            message="Referral leaderboard retrieved successfully", data=leaderboard
+        )
+
+    async def get_stats(self, user: Principal):
+        stats = await self.referral_service.get_stats(user.id)
+        if stats is None:
+            raise HTTPException(
+                status_code=404,
+                detail={
+                    "message": ErrorCode.REFERRAL_NOT_FOUND.name,
+                    "code": ErrorCode.REFERRAL_NOT_FOUND.value,
+                },
+            )
+        return ResponseHandler.success(
+            message="Referral stats retrieved successfully", data=stats
+        )
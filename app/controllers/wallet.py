@@ -12,5 +12,5 @@ class WalletController:
         return self.wallet_service.generate_wallet()
 
     def create_wallet(self, wallet: WalletRequestDTO) -> WalletResponseDTO:
-        wallet = self.wallet_service.create_wallet(wallet)
+        wallet = self.wallet_service.create_wallet(wallet.user_id)
         return WalletResponseDTO.model_validate(wallet)
@@ -1,10 +1,12 @@
-from sqlalchemy import create_engine
-from config import settings
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-
-engine = create_engine(settings.POSTGRES_URL)
+from app.database.pool import async_engine, engine
 Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Objects stay loaded after a commit, an async session cannot lazy load them
+AsyncSession = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
 Base = declarative_base()
 
 
@@ -14,3 +16,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSession() as db:
+        yield db
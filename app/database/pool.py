@@ -1,6 +1,157 @@
-from psycopg_pool import ConnectionPool
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
 from config import settings
 
-pool = ConnectionPool(
-    settings.POSTGRES_URL,
-)
+
+class PoolMetrics:
+    """Counters for how long and how often callers wait for a connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe_wait(self, elapsed: float, timed_out: bool = False) -> None:
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+
+    def observe_connect(self) -> None:
+        with self._lock:
+            self.connects += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            waits = self.checkouts + self.timeouts
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "wait_avg_ms": round(self.wait_total / waits * 1000, 3) if waits else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    metrics: PoolMetrics
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            self.metrics.observe_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.observe_wait(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """InstrumentedQueuePool for the async engine, waits do not block the event loop."""
+
+
+class RawConnectionPool:
+    """
+    DBAPI connections checked out of the shared engine pool, for code that
+    runs plain SQL without an ORM session.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    @contextmanager
+    def connection(self):
+        """Yield a connection, commit on success and roll back on error."""
+        connection = self.engine.raw_connection()
+        try:
+            yield connection
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            # Returns the connection to the pool
+            connection.close()
+
+
+def _instrument(engine: Engine) -> None:
+    metrics = PoolMetrics()
+    engine.pool.metrics = metrics
+    event.listen(engine, "connect", lambda *args: metrics.observe_connect())
+
+
+def create_pooled_engine(url: str) -> Engine:
+    engine = create_engine(
+        url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+    _instrument(engine)
+    return engine
+
+
+def create_async_pooled_engine(url: str) -> AsyncEngine:
+    """An engine on the async psycopg driver, whatever driver `url` names."""
+    engine = create_async_engine(
+        make_url(url).set(drivername="postgresql+psycopg"),
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_size=settings.DB_ASYNC_POOL_SIZE,
+        max_overflow=settings.DB_ASYNC_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+    _instrument(engine.sync_engine)
+    return engine
+
+
+# The connection pool shared by the ORM, agent storage, workers and raw SQL
+engine = create_pooled_engine(settings.POSTGRES_URL)
+pool = RawConnectionPool(engine)
+# The pool of the async sessions the API endpoints use, so they query the
+# database without holding a worker thread
+async_engine = create_async_pooled_engine(settings.POSTGRES_URL)
+
+
+def _pool_metrics(current, max_overflow: int) -> dict:
+    return {
+        "size": current.size(),
+        "max_overflow": max_overflow,
+        "checked_out": current.checkedout(),
+        "checked_in": current.checkedin(),
+        "overflow": max(current.overflow(), 0),
+        **current.metrics.snapshot(),
+    }
+
+
+def pool_metrics() -> dict:
+    """Current size and usage of the sync connection pool, and of the async one."""
+    return {
+        **_pool_metrics(engine.pool, settings.DB_MAX_OVERFLOW),
+        "async": _pool_metrics(async_engine.pool, settings.DB_ASYNC_MAX_OVERFLOW),
+    }
@@ -0,0 +1,354 @@
+"""
+Routing of read-only queries to Postgres read replicas.
+
+Reads that can tolerate a little staleness (agent history, principal and
+wallet lookups) open their session with `read_session` or
+`async_read_session`. It is bound to a replica when one is close enough to the
+primary, and to the primary otherwise:
+
+- Each replica's replication lag is measured every
+  DB_REPLICA_LAG_CHECK_INTERVAL seconds by a background thread. A replica is
+  read from while its lag, plus the time since it was measured, stays under
+  DB_REPLICA_MAX_LAG, so a replica that stops answering drops out too.
+- After a user's own writes (an agent turn, a signup, a profile change) the
+  writer calls `replica_router.pin(user_id)`, and that user's reads stay on
+  the primary for DB_READ_YOUR_WRITES_WINDOW seconds. Pins are shared across
+  processes through Redis, as turns may be written by the agent workers.
+  `pin` and the reads of `read_session` wait for Redis and are for threadpool
+  code. The event loop uses `apin` and `async_read_session`, and writers that
+  must not wait, like SQLAlchemy events or the agent storage, `pin_soon`.
+
+Without POSTGRES_REPLICA_URLS every read goes to the primary and nothing is
+checked. To try it locally, either list the primary itself as a replica (a
+primary never lags, so every unpinned read is routed to it), or start a
+streaming replica of a local Postgres:
+
+    pg_basebackup -h localhost -p 5432 -U postgres -D /tmp/replica -R
+    pg_ctl -D /tmp/replica -o "-p 5433" start
+    POSTGRES_REPLICA_URLS=postgresql://postgres@localhost:5433/pluton
+
+and run `SELECT pg_wal_replay_pause()` on it to watch reads fall back to the
+primary once it lags, `pg_wal_replay_resume()` to bring them back.
+"""
+
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database.client import AsyncSession, Session
+from app.database.pool import (
+    RawConnectionPool,
+    async_engine,
+    create_async_pooled_engine,
+    create_pooled_engine,
+    engine,
+    pool,
+)
+from app.middleware.redis import (
+    get_async_redis_client,
+    get_redis_client,
+    redis_manager,
+)
+from app.utils.cache import TTLCache
+from config import settings
+from log import logger
+
+# Seconds the replica is behind the primary. A primary, or a stand-in for a
+# replica, is never behind, and a streaming replica that has replayed all it
+# received is up to date even when the primary has been idle since.
+REPLICATION_LAG = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+            AND EXISTS (
+                SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'
+            ) THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+# Users pinned to the primary, held in the process in front of Redis
+PINS_MAX_SIZE = 10000
+
+
+class Replica:
+    """A read replica, its engines and the replication lag last measured on it."""
+
+    def __init__(self, url: str):
+        self.name = make_url(url).render_as_string(hide_password=True)
+        self.engine = create_pooled_engine(url)
+        self.pool = RawConnectionPool(self.engine)
+        self.async_engine = create_async_pooled_engine(url)
+        self.lag: Optional[float] = None
+        self.checked_at: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def check(self) -> None:
+        try:
+            with self.engine.connect() as connection:
+                lag = connection.execute(REPLICATION_LAG).scalar()
+            self.lag = float(lag) if lag is not None else None
+            self.error = None
+        except Exception as e:
+            if self.error is None:
+                logger.warning(f"[REPLICAS] Could not check {self.name}: {e}")
+            self.lag = None
+            self.error = str(e)
+        self.checked_at = time.monotonic()
+
+    @property
+    def available(self) -> bool:
+        """Whether the replica is surely less than DB_REPLICA_MAX_LAG behind."""
+        if self.lag is None:
+            return False
+        # The lag may have grown by as much as the time since it was measured
+        return self.lag + time.monotonic() - self.checked_at <= settings.DB_REPLICA_MAX_LAG
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "available": self.available,
+            "lag": round(self.lag, 3) if self.lag is not None else None,
+            "checked_ago": (
+                round(time.monotonic() - self.checked_at, 3)
+                if self.checked_at is not None
+                else None
+            ),
+            "error": self.error,
+            "pool": self.engine.pool.metrics.snapshot(),
+            "async_pool": self.async_engine.pool.metrics.snapshot(),
+        }
+
+
+class RoutingMetrics:
+    """Where reads were routed, and why they went to the primary."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.replica = 0
+        self.primary = 0
+        # Reads of users who just wrote
+        self.pinned = 0
+        # Reads that found no replica fresh enough
+        self.lagging = 0
+
+    def observe(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "replica": self.replica,
+                "primary": self.primary,
+                "pinned": self.pinned,
+                "lagging": self.lagging,
+            }
+
+
+class ReplicaRouter:
+    """
+    Picks the engine a read-only query runs on, see the module docstring.
+
+    Fresh replicas take reads in turn. The lag monitor starts with the first
+    routed read.
+    """
+
+    def __init__(self, urls: list[str]):
+        self.replicas = [Replica(url) for url in urls]
+        self.metrics = RoutingMetrics()
+        self.pins = TTLCache(
+            maxsize=PINS_MAX_SIZE, ttl=settings.DB_READ_YOUR_WRITES_WINDOW
+        )
+        self.use_redis = settings.DB_READ_YOUR_WRITES_USE_REDIS
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._monitor: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    @staticmethod
+    def _pin_key(user_id: str) -> str:
+        return f"db:pin:{user_id}"
+
+    def _ensure_monitor(self) -> None:
+        if self._monitor is not None:
+            return
+        with self._lock:
+            if self._monitor is None:
+                self._monitor = threading.Thread(
+                    target=self._monitor_lag, name="replica-lag", daemon=True
+                )
+                self._monitor.start()
+
+    def _monitor_lag(self) -> None:
+        while not self._stopping.is_set():
+            for replica in self.replicas:
+                replica.check()
+            self._stopping.wait(settings.DB_REPLICA_LAG_CHECK_INTERVAL)
+
+    def pin(self, user_id: Optional[str]) -> None:
+        """Keep the reads of a user on the primary, after they wrote."""
+        if not self.enabled or not user_id:
+            return
+        self.pins.set(user_id, True)
+        if self.use_redis:
+            try:
+                get_redis_client().set(
+                    self._pin_key(user_id),
+                    1,
+                    ex=max(1, int(settings.DB_READ_YOUR_WRITES_WINDOW)),
+                )
+            except Exception as e:
+                logger.warning(f"[REPLICAS] Could not pin {user_id}: {e}")
+
+    def pin_soon(self, user_id: Optional[str]) -> None:
+        """
+        `pin` that does not wait for Redis.
+
+        The process pins the user at once, other processes once the async
+        client has sent the pin. Without a running app loop it falls back to
+        `pin`.
+        """
+        if not self.enabled or not user_id:
+            return
+        if not self.use_redis:
+            self.pins.set(user_id, True)
+            return
+        sent = redis_manager.send_soon(
+            "set",
+            self._pin_key(user_id),
+            1,
+            ex=max(1, int(settings.DB_READ_YOUR_WRITES_WINDOW)),
+        )
+        if sent:
+            self.pins.set(user_id, True)
+        else:
+            self.pin(user_id)
+
+    async def apin(self, user_id: Optional[str]) -> None:
+        """Async variant of `pin`."""
+        if not self.enabled or not user_id:
+            return
+        self.pins.set(user_id, True)
+        if self.use_redis:
+            try:
+                await get_async_redis_client().set(
+                    self._pin_key(user_id),
+                    1,
+                    ex=max(1, int(settings.DB_READ_YOUR_WRITES_WINDOW)),
+                )
+            except Exception as e:
+                logger.warning(f"[REPLICAS] Could not pin {user_id}: {e}")
+
+    def _pinned(self, user_id: Optional[str]) -> bool:
+        if not user_id:
+            return False
+        if self.pins.get(user_id):
+            return True
+        if not self.use_redis:
+            return False
+        try:
+            return bool(get_redis_client().exists(self._pin_key(user_id)))
+        except Exception as e:
+            logger.warning(f"[REPLICAS] Could not read the pin of {user_id}: {e}")
+            # Unknown, the primary is always up to date
+            return True
+
+    async def _apinned(self, user_id: Optional[str]) -> bool:
+        if not user_id:
+            return False
+        if self.pins.get(user_id):
+            return True
+        if not self.use_redis:
+            return False
+        try:
+            return bool(await get_async_redis_client().exists(self._pin_key(user_id)))
+        except Exception as e:
+            logger.warning(f"[REPLICAS] Could not read the pin of {user_id}: {e}")
+            return True
+
+    def _route(self, pinned: bool) -> Optional[Replica]:
+        if pinned:
+            self.metrics.observe("pinned")
+            return None
+        self._ensure_monitor()
+        fresh = [replica for replica in self.replicas if replica.available]
+        if not fresh:
+            self.metrics.observe("lagging")
+            return None
+        self.metrics.observe("replica")
+        return fresh[next(self._turn) % len(fresh)]
+
+    def read_replica(self, user_id: Optional[str] = None) -> Optional[Replica]:
+        """The replica to read from for `user_id`, or None for the primary."""
+        if not self.enabled:
+            self.metrics.observe("primary")
+            return None
+        return self._route(self._pinned(user_id))
+
+    async def aread_replica(self, user_id: Optional[str] = None) -> Optional[Replica]:
+        """Async variant of `read_replica`."""
+        if not self.enabled:
+            self.metrics.observe("primary")
+            return None
+        return self._route(await self._apinned(user_id))
+
+    def read_engine(self, user_id: Optional[str] = None) -> Engine:
+        replica = self.read_replica(user_id)
+        return replica.engine if replica else engine
+
+    def read_pool(self, user_id: Optional[str] = None) -> RawConnectionPool:
+        replica = self.read_replica(user_id)
+        return replica.pool if replica else pool
+
+    async def aread_engine(self, user_id: Optional[str] = None) -> AsyncEngine:
+        replica = await self.aread_replica(user_id)
+        return replica.async_engine if replica else async_engine
+
+    def snapshot(self) -> dict:
+        return {
+            "reads": self.metrics.snapshot(),
+            "replicas": [replica.snapshot() for replica in self.replicas],
+        }
+
+    async def dispose(self) -> None:
+        self._stopping.set()
+        for replica in self.replicas:
+            replica.engine.dispose()
+            await replica.async_engine.dispose()
+
+
+replica_router = ReplicaRouter(settings.POSTGRES_REPLICA_URLS)
+
+
+@contextmanager
+def read_session(user_id: Optional[str] = None):
+    """
+    A session for read-only queries, on a replica when one is fresh enough.
+
+    Args:
+        user_id (str, optional): The user the data belongs to, their reads stay
+            on the primary right after they wrote.
+    """
+    with Session(bind=replica_router.read_engine(user_id)) as session:
+        yield session
+
+
+@asynccontextmanager
+async def async_read_session(user_id: Optional[str] = None):
+    """Async variant of `read_session`."""
+    async with AsyncSession(bind=await replica_router.aread_engine(user_id)) as session:
+        yield session
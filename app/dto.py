@@ -35,6 +35,20 @@ class AgentCallRequest(BaseModel):
             ]
         ],
     )
+    stream_interval_ms: Optional[int] = Field(
+        None,
+        ge=0,
+        le=1000,
+        description="Longest time tokens are held to be sent together, 0 sends every token as it comes",
+        example=30,
+    )
+    stream_max_chars: Optional[int] = Field(
+        None,
+        ge=1,
+        le=65536,
+        description="Characters after which held tokens are sent right away",
+        example=256,
+    )
 
 
 class AgentHistoryRequest(BaseModel):
@@ -43,6 +57,16 @@ class AgentHistoryRequest(BaseModel):
     )
 
 
+class AgentHistoryPageRequest(BaseModel):
+    session_id: Optional[str] = Field(
+        None, description="The session id", example="s-1234567890"
+    )
+    cursor: Optional[str] = Field(
+        None, description="The next_cursor returned by the previous page"
+    )
+    limit: int = Field(20, ge=1, le=100, description="The page size", example=20)
+
+
 class FileResponse(BaseModel):
     id: str
     filename: str
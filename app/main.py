@@ -5,8 +5,8 @@ from app.controllers.wallet import WalletController
 import uvicorn
 from fastapi.responses import StreamingResponse
 from config import settings
-from app.middleware.limiter import RedisRateLimiterMiddleware
-from app.middleware.redis import get_redis_client
+from app.middleware.asgi import APIMiddleware
+from app.middleware.redis import redis_manager
 from app.routes.agent import router as agent_router
 from app.routes.wallet import router as wallet_router
 from app.routes.file import router as file_router
@@ -18,8 +18,31 @@ from app.core.error_handlers import app_exception_handler, integrity_error_handl
 from app.core.exceptions import AppException
 from sqlalchemy.exc import IntegrityError
 from app.routes.auth import router as auth_router
+from app.utils.requests import close_clients
+from app.database.pool import async_engine, engine, pool_metrics
+from app.database.replicas import replica_router
+from app.services.wallet import wallet_reservoir
+from agents.cancellation import stream_metrics
+from agents.context import context_metrics
+from app.middleware.admission import admission
+from app.middleware.quota import request_buckets
+from contextlib import asynccontextmanager
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await redis_manager.startup()
+    yield
+    await request_buckets.aclose()
+    await redis_manager.shutdown()
+    await close_clients()
+    engine.dispose()
+    await async_engine.dispose()
+    await replica_router.dispose()
+
 
 app = FastAPI(
+    lifespan=lifespan,
     title="DeepSynth API",
     description="API for DeepSynth",
     version="v0.1.8",
@@ -29,26 +52,7 @@ app.add_exception_handler(AppException, app_exception_handler)
 app.add_exception_handler(IntegrityError, integrity_error_handler)
 
 
-@app.middleware("http")
-async def cors_handler(request: Request, call_next):
-    if request.method == "OPTIONS":
-        response = Response(
-            status_code=204,
-            headers={
-                "Access-Control-Allow-Credentials": "true",
-                "Access-Control-Allow-Origin": settings.origins,
-                "Access-Control-Allow-Methods": "*",
-                "Access-Control-Allow-Headers": "*",
-            },
-        )
-    else:
-        response = await call_next(request)
-        response.headers["Access-Control-Allow-Credentials"] = "true"
-        response.headers["Access-Control-Allow-Origin"] = settings.origins
-        response.headers["Access-Control-Allow-Methods"] = "*"
-        response.headers["Access-Control-Allow-Headers"] = "*"
-
-    return response
+app.add_middleware(APIMiddleware)
 
 
 PREFIX = "/api"
@@ -59,7 +63,7 @@ app.include_router(file_router, prefix=PREFIX)
 app.include_router(user_router, prefix=PREFIX)
 app.include_router(wallet_router, prefix=PREFIX)
 app.include_router(auth_router, prefix=PREFIX)
-# app.include_router(referral_router, prefix=PREFIX)
+app.include_router(referral_router, prefix=PREFIX)
 
 
 @app.get(f"{PREFIX}/healthz")
@@ -72,9 +76,51 @@ def healthz():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get(f"{PREFIX}/metrics/db")
+def db_metrics():
+    return pool_metrics()
+
+
+@app.get(f"{PREFIX}/metrics/replicas")
+def replica_metrics():
+    return replica_router.snapshot()
+
+
+@app.get(f"{PREFIX}/metrics/redis")
+def redis_metrics():
+    return redis_manager.metrics()
+
+
+@app.get(f"{PREFIX}/metrics/wallets")
+def wallet_reservoir_metrics():
+    if wallet_reservoir.enabled:
+        wallet_reservoir.depth()
+    return wallet_reservoir.metrics.snapshot()
+
+
+@app.get(f"{PREFIX}/metrics/streams")
+def agent_stream_metrics():
+    return stream_metrics.snapshot()
+
+
+@app.get(f"{PREFIX}/metrics/context")
+def agent_context_metrics():
+    return context_metrics.snapshot()
+
+
+@app.get(f"{PREFIX}/metrics/admission")
+async def admission_metrics():
+    # Read on the event loop that owns the controller
+    return admission.snapshot()
+
+
 @app.exception_handler(HTTPException)
 def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers=exc.headers,
+    )
 
 
 if __name__ == "__main__":
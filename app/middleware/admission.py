@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+from app.middleware.auth import Principal
+from config import settings
+
+
+class Ticket:
+    """The place of one run in the admission controller, admitted or queued."""
+
+    __slots__ = ("user_id", "priority", "seq", "enqueued_at", "admitted", "released")
+
+    def __init__(self, user_id: str, priority: int, seq: int):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted = asyncio.Event()
+        self.released = False
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """
+    Bounds the agent runs executing in this process.
+
+    At most `max_active` runs execute at once, the next ones wait in a queue
+    ordered by tier priority, then arrival. A user over their tier's run cap
+    is rejected with 429 and a full queue with 503, both before any work is
+    done. Lives on the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_active: int, max_queued: int):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.active = 0
+        self.per_user: dict[str, int] = {}
+        self._queue: list[Ticket] = []
+        self._seq = itertools.count()
+        # Gauges and counters for /metrics/admission
+        self.admitted = 0
+        self.rejected_user = 0
+        self.rejected_full = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @staticmethod
+    def _tier(user: Principal) -> str:
+        return user.tier or "free"
+
+    def _user_cap(self, user: Principal) -> int:
+        caps = settings.AGENT_TIER_MAX_CONCURRENT_RUNS
+        return caps.get(self._tier(user), caps["free"])
+
+    def _priority(self, user: Principal) -> int:
+        priorities = settings.AGENT_TIER_PRIORITY
+        return priorities.get(self._tier(user), priorities["free"])
+
+    def _retry_after(self) -> dict[str, str]:
+        return {"Retry-After": str(max(1, int(settings.AGENT_QUEUE_TIMEOUT // 4)))}
+
+    def _admit(self, ticket: Ticket) -> None:
+        self.active += 1
+        self.admitted += 1
+        waited = time.monotonic() - ticket.enqueued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        ticket.admitted.set()
+
+    def _dispatch(self) -> None:
+        while self._queue and self.active < self.max_active:
+            self._admit(heapq.heappop(self._queue))
+
+    def acquire(self, user: Principal) -> Ticket:
+        """
+        Admit a run, or queue it behind the runs of higher tiers.
+
+        Raises:
+            HTTPException: 429 when the user already has their tier's number of
+                runs, 503 when the queue is full
+        """
+        user_id = str(user.id)
+        if self.per_user.get(user_id, 0) >= self._user_cap(user):
+            self.rejected_user += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many agent runs in progress",
+                headers=self._retry_after(),
+            )
+        if self.active >= self.max_active and len(self._queue) >= self.max_queued:
+            self.rejected_full += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="The agent is busy, try again later",
+                headers=self._retry_after(),
+            )
+        ticket = Ticket(user_id, self._priority(user), next(self._seq))
+        self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+        heapq.heappush(self._queue, ticket)
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """Runs admitted before this one, 0 once it is admitted."""
+        if ticket.admitted.is_set():
+            return 0
+        return 1 + sum(1 for other in self._queue if other < ticket)
+
+    async def wait(self, ticket: Ticket, timeout: float) -> Optional[int]:
+        """
+        Wait up to `timeout` seconds for the ticket to be admitted.
+
+        Returns:
+            Optional[int]: None once admitted, else the current queue position
+        """
+        try:
+            await asyncio.wait_for(ticket.admitted.wait(), timeout)
+            return None
+        except asyncio.TimeoutError:
+            return self.position(ticket)
+
+    def release(self, ticket: Ticket, timed_out: bool = False) -> None:
+        if ticket.released:
+            return
+        ticket.released = True
+        if timed_out:
+            self.timeouts += 1
+        remaining = self.per_user[ticket.user_id] - 1
+        if remaining:
+            self.per_user[ticket.user_id] = remaining
+        else:
+            del self.per_user[ticket.user_id]
+        if ticket.admitted.is_set():
+            self.active -= 1
+        else:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+        self._dispatch()
+
+    def snapshot(self) -> dict:
+        oldest = min((ticket.enqueued_at for ticket in self._queue), default=None)
+        return {
+            "max_active": self.max_active,
+            "active": self.active,
+            "queued": len(self._queue),
+            "oldest_wait_ms": (
+                round((time.monotonic() - oldest) * 1000, 3)
+                if oldest is not None
+                else 0.0
+            ),
+            "admitted": self.admitted,
+            "rejected_user": self.rejected_user,
+            "rejected_full": self.rejected_full,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": (
+                round(self.wait_total / self.admitted * 1000, 3) if self.admitted else 0.0
+            ),
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+
+admission = AdmissionController(
+    settings.AGENT_MAX_CONCURRENT_RUNS, settings.AGENT_MAX_QUEUED_RUNS
+)
@@ -0,0 +1,72 @@
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import settings
+from log import logger
+
+
+class APIMiddleware:
+    """
+    CORS, rate-limit headers and request timing as one pure ASGI middleware.
+
+    Only the `http.response.start` message is touched, body messages (SSE
+    chunks included) are passed to the server as they are, without the
+    per-chunk queue and task hops of `BaseHTTPMiddleware`.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        cors_headers = [
+            (b"access-control-allow-credentials", b"true"),
+            (b"access-control-allow-origin", settings.origins.encode()),
+            (b"access-control-allow-methods", b"*"),
+            (b"access-control-allow-headers", b"*"),
+        ]
+        self.cors_headers = cors_headers
+        # Built once and cached by browsers for CORS_PREFLIGHT_MAX_AGE seconds
+        self.preflight_start: Message = {
+            "type": "http.response.start",
+            "status": 204,
+            "headers": cors_headers
+            + [(b"access-control-max-age", str(settings.CORS_PREFLIGHT_MAX_AGE).encode())],
+        }
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS":
+            await send(self.preflight_start)
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = list(message.get("headers", ()))
+                headers.extend(self.cors_headers)
+                # Set by the rate limiters while handling the request
+                rate_limit = scope.get("state", {}).get("rate_limit")
+                if rate_limit is not None:
+                    headers.extend(
+                        (name.lower().encode(), value.encode())
+                        for name, value in rate_limit.headers.items()
+                    )
+                elapsed = (time.perf_counter() - start) * 1000
+                headers.append((b"server-timing", f"app;dur={elapsed:.1f}".encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            logger.debug(
+                f"[HTTP] {scope['method']} {scope['path']} {status_code} "
+                f"{(time.perf_counter() - start) * 1000:.1f}ms"
+            )
@@ -1,42 +1,171 @@
-from typing import Optional
+import asyncio
+import hashlib
+import json
+import time
+from typing import NamedTuple, Optional
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 from config import settings
 import jwt
 from log import logger
-from app.database import get_db
-from app.models.user import User
-from sqlalchemy.orm import Session
+from app.database.replicas import read_session, replica_router
+from app.models import User
+from app.utils.cache import ReadThroughCache, TTLCache
 
 security = HTTPBearer()
 
 
-async def verify_token(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db),
-) -> dict:
-    try:
-        token = credentials.credentials
-        logger.info(f"Token: {token}")
-        # Verify token
-        payload = jwt.decode(
+class Principal(NamedTuple):
+    """The authenticated user, detached from any database session."""
+
+    id: str
+    email: Optional[str]
+    username: Optional[str]
+    tier: Optional[str]
+
+
+class UserNotFound(LookupError):
+    pass
+
+
+# Decoded claims by token hash, each entry lives until its token expires
+claims_cache = TTLCache(maxsize=settings.AUTH_CLAIMS_CACHE_MAX_SIZE)
+# Principals by user id, shared across processes through Redis
+principal_cache = ReadThroughCache(
+    namespace="auth",
+    maxsize=settings.AUTH_USER_CACHE_MAX_SIZE,
+    use_redis=settings.AUTH_USER_CACHE_USE_REDIS,
+)
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def decode_claims(token: str) -> dict:
+    """Verify a token, or reuse the claims of an earlier verification."""
+    key = _token_key(token)
+    claims = claims_cache.get(key)
+    if claims is None:
+        claims = jwt.decode(
             token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM]
         )
+        exp = claims.get("exp")
+        ttl = exp - time.time() if exp is not None else settings.JWT_EXPIRATION
+        if ttl > 0:
+            claims_cache.set(key, claims, ttl)
+    return claims
 
-        logger.debug(f"Payload: {payload}")
-        user = db.query(User).filter(User.id == payload["sub"]).first()
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found"
-            )
-        return user
-    except jwt.PyJWTError as e:
-        import traceback
 
-        traceback.print_exc()
+def _load_principal(user_id: str) -> str:
+    with read_session(user_id) as db:
+        row = (
+            db.query(User.id, User.email, User.username, User.tier)
+            .filter(User.id == user_id)
+            .first()
+        )
+    if row is None:
+        raise UserNotFound(user_id)
+    return json.dumps(Principal(*row)._asdict())
+
+
+def get_principal(user_id: str) -> Principal:
+    data = principal_cache.get_or_load(
+        "principal",
+        user_id,
+        lambda: _load_principal(user_id),
+        ttl=settings.AUTH_USER_CACHE_TTL,
+    )
+    return Principal(**json.loads(data))
+
+
+def invalidate_user(user_id: str) -> None:
+    """Drop a cached principal so the next request reloads the user."""
+    principal_cache.invalidate("principal", user_id)
+
+
+async def ainvalidate_user(user_id: str) -> None:
+    """Async variant of `invalidate_user`."""
+    await principal_cache.ainvalidate("principal", user_id)
+
+
+def revoke_token(token: str) -> None:
+    """Forget the cached claims of a token."""
+    claims_cache.delete(_token_key(token))
+
+
+# Key of the ids of the users changed in a session's transaction, in Session.info
+CHANGED_USERS = "changed_users"
+# Tasks forgetting changed users in Redis, held until they are done
+_forgetting: set = set()
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _record_changed_user(mapper, connection, target: User) -> None:
+    # Runs inside the flush, which for an AsyncSession is on the event loop.
+    # The user is forgotten once the change is committed.
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(CHANGED_USERS, set()).add(target.id)
+
+
+async def _ainvalidate_users(user_ids: set) -> None:
+    for user_id in user_ids:
+        await ainvalidate_user(user_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_changed_users(session: Session) -> None:
+    user_ids = session.info.pop(CHANGED_USERS, None)
+    if not user_ids:
+        return
+    for user_id in user_ids:
+        # Reload the principal from the primary, a replica may not have the
+        # change yet
+        replica_router.pin_soon(user_id)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Threadpool code, it can wait for Redis
+        for user_id in user_ids:
+            invalidate_user(user_id)
+        return
+    # An AsyncSession commits on the event loop. The local principals go now,
+    # the Redis work runs after the commit without blocking the loop.
+    for user_id in user_ids:
+        principal_cache.invalidate_local("principal", user_id)
+    task = loop.create_task(_ainvalidate_users(user_ids))
+    _forgetting.add(task)
+    task.add_done_callback(_forgetting.discard)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _keep_unchanged_users(session: Session, previous_transaction) -> None:
+    # A rolled back savepoint may leave changes of the transaction around it
+    if previous_transaction.parent is None:
+        session.info.pop(CHANGED_USERS, None)
+
+
+async def verify_token(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+) -> Principal:
+    try:
+        claims = decode_claims(credentials.credentials)
+        user_id = claims["sub"]
+        cached = principal_cache.peek("principal", user_id)
+        if cached is not None:
+            return Principal(**json.loads(cached))
+        return await run_in_threadpool(get_principal, user_id)
+    except jwt.PyJWTError as e:
         logger.error(f"Error decoding token: {e}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
         )
-    finally:
-        db.close()
+    except UserNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found"
+        )
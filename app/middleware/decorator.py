@@ -1,16 +1,90 @@
-from .redis import get_redis_client
+from .redis import get_async_redis_client, get_redis_client
 from redis import RedisError
 from fastapi import HTTPException
 from fastapi import status
-from datetime import datetime as time
 from functools import wraps
 from fastapi import Request
+from typing import NamedTuple
+import inspect
+import math
+import uuid
+
+# Sliding-window log: prune the window, then admit and record the request in
+# the same script so concurrent callers cannot both take the last slot.
+# Timestamps come from the Redis clock so every API process agrees on them.
+SLIDING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local member = ARGV[3]
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+if count < limit then
+    redis.call('ZADD', key, now, member)
+    redis.call('PEXPIRE', key, window)
+    return {1, limit - count - 1, 0}
+end
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+return {0, 0, window - (now - tonumber(oldest[2]))}
+"""
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    # Milliseconds until the oldest request leaves the window, 0 when allowed
+    retry_after_ms: int
+
+    @property
+    def headers(self) -> dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after_ms / 1000)))
+        return headers
 
 
 class RateLimiter:
-    def is_rate_limited(self, key: str, max_requests: int, window: int) -> bool:
+    def __init__(self):
+        self._script = None
+        self._async_script = None
+
+    def _sliding_window(self):
+        if self._script is None:
+            # EVALSHA with a fallback to EVAL when the script cache was flushed
+            self._script = get_redis_client().register_script(SLIDING_WINDOW_SCRIPT)
+        return self._script
+
+    def _async_sliding_window(self):
+        if self._async_script is None:
+            self._async_script = get_async_redis_client().register_script(
+                SLIDING_WINDOW_SCRIPT
+            )
+        return self._async_script
+
+    @staticmethod
+    def _result(max_requests: int, reply: list) -> RateLimitResult:
+        allowed, remaining, retry_after_ms = reply
+        return RateLimitResult(
+            bool(allowed), max_requests, int(remaining), int(retry_after_ms)
+        )
+
+    @staticmethod
+    def _redis_error(e: RedisError) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Redis error: {str(e)}",
+        )
+
+    def hit(self, key: str, max_requests: int, window: int) -> RateLimitResult:
         """
-        Check if a request should be rate limited.
+        Record a request and tell whether it is within the limit, in one round trip.
 
         Args:
             key: The unique identifier for the rate limit bucket
@@ -18,38 +92,45 @@ class RateLimiter:
             window: Time window in seconds
 
         Returns:
-            bool: True if request should be rate limited, False otherwise
+            RateLimitResult: The decision, the remaining quota and when to retry
 
         Raises:
             HTTPException: If Redis operations fail
         """
-        current = int(time.now().timestamp())
-        window_start = current - window
-        redis_conn = get_redis_client()
-
-        with redis_conn.pipeline() as pipe:
-            try:
-                # First pipeline: Check current state
-                pipe.zremrangebyscore(key, 0, window_start)
-                pipe.zcard(key)
-                results = pipe.execute()
+        try:
+            reply = self._sliding_window()(
+                keys=[key], args=[window * 1000, max_requests, uuid.uuid4().hex]
+            )
+        except RedisError as e:
+            raise self._redis_error(e) from e
+        return self._result(max_requests, reply)
+
+    async def ahit(self, key: str, max_requests: int, window: int) -> RateLimitResult:
+        """Async variant of `hit`, runs the script on the shared async client."""
+        try:
+            reply = await self._async_sliding_window()(
+                keys=[key], args=[window * 1000, max_requests, uuid.uuid4().hex]
+            )
+        except RedisError as e:
+            raise self._redis_error(e) from e
+        return self._result(max_requests, reply)
 
-                current_count = results[1]
+    def is_rate_limited(self, key: str, max_requests: int, window: int) -> bool:
+        """
+        Check if a request should be rate limited.
 
-                # If not rate limited, add the new request
-                if current_count < max_requests:
-                    pipe.zadd(key, {current: current})
-                    pipe.expire(key, window)
-                    pipe.execute()
-                    return False
+        Args:
+            key: The unique identifier for the rate limit bucket
+            max_requests: Maximum number of requests allowed in the window
+            window: Time window in seconds
 
-                return True
+        Returns:
+            bool: True if request should be rate limited, False otherwise
 
-            except RedisError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Redis error: {str(e)}",
-                ) from e
+        Raises:
+            HTTPException: If Redis operations fail
+        """
+        return not self.hit(key, max_requests, window).allowed
 
 
 rate_limiter = RateLimiter()
@@ -58,14 +139,33 @@ rate_limiter = RateLimiter()
 # decorator to check if the user is rate limited
 def rate_limit(max_requests: int, window: int):
     def decorator(func):
-        @wraps(func)
-        def wrapper(request: Request, *args, **kwargs):
-            key = f"rate_limit:{request.client.host}:{request.url.path}"
-            if rate_limiter.is_rate_limited(key, max_requests, window):
+        def key_for(request: Request) -> str:
+            return f"rate_limit:{request.client.host}:{request.url.path}"
+
+        def enforce(request: Request, result: RateLimitResult):
+            if not result.allowed:
                 raise HTTPException(
                     status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                     detail="Too many requests",
+                    headers=result.headers,
                 )
+            # Added to the response by APIMiddleware
+            request.state.rate_limit = result
+
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(request: Request, *args, **kwargs):
+                result = await rate_limiter.ahit(key_for(request), max_requests, window)
+                enforce(request, result)
+                return await func(request, *args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(request: Request, *args, **kwargs):
+            result = rate_limiter.hit(key_for(request), max_requests, window)
+            enforce(request, result)
             return func(request, *args, **kwargs)
 
         return wrapper
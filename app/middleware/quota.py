@@ -0,0 +1,387 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request, status
+from redis import RedisError
+
+from app.middleware.auth import Principal, verify_token
+from app.middleware.decorator import RateLimitResult
+from app.middleware.redis import get_async_redis_client, get_redis_client
+from config import settings
+from log import logger
+
+# Token bucket shared by every worker. Refills continuously at capacity/window,
+# hands out up to ARGV[3] tokens and, with ARGV[4] = 1, debits the full amount
+# even below zero so usage measured after the fact is always charged. A
+# negative amount gives tokens back, up to the capacity.
+TOKEN_BUCKET_SCRIPT = """
+local key = KEYS[1]
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local force = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local state = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+
+local granted = requested
+if force == 0 then
+    granted = math.min(requested, math.max(0, math.floor(tokens)))
+end
+tokens = math.min(capacity, tokens - granted)
+
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', key, math.ceil((capacity - tokens) / rate) + 1000)
+local wait = 0
+if tokens < 1 then
+    wait = math.ceil((1 - tokens) / rate)
+end
+return {granted, math.floor(math.max(tokens, 0)), wait}
+"""
+
+
+class Quota(NamedTuple):
+    capacity: int
+    # Seconds to refill an empty bucket
+    window: int
+
+    @property
+    def lease_size(self) -> int:
+        return max(1, int(self.capacity * settings.RATE_LIMIT_LEASE_FRACTION))
+
+
+class _Lease:
+    __slots__ = ("quota", "tokens", "remote_remaining", "empty_until", "expires_at")
+
+    def __init__(self, quota: Quota):
+        self.quota = quota
+        self.tokens = 0
+        self.remote_remaining = 0
+        # Monotonic time before which the shared bucket is known to be empty
+        self.empty_until = 0.0
+        self.expires_at = time.monotonic() + settings.RATE_LIMIT_LEASE_TTL
+
+
+class TokenBucket:
+    """
+    Token buckets kept in Redis, for usage known only after the fact.
+
+    A run reserves an estimate of its usage up front with `reserve` and
+    `settle`s it to the actual amount once it is over, which charges or gives
+    back the difference.
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self._script = None
+        self._async_script = None
+
+    def _bucket_key(self, key: str) -> str:
+        return f"quota:{self.namespace}:{key}"
+
+    def _remote(self):
+        if self._script is None:
+            self._script = get_redis_client().register_script(TOKEN_BUCKET_SCRIPT)
+        return self._script
+
+    def _async_remote(self):
+        if self._async_script is None:
+            self._async_script = get_async_redis_client().register_script(
+                TOKEN_BUCKET_SCRIPT
+            )
+        return self._async_script
+
+    @staticmethod
+    def _args(quota: Quota, requested: int, force: bool) -> list:
+        return [quota.capacity, quota.capacity / (quota.window * 1000), requested, int(force)]
+
+    @staticmethod
+    def _redis_error(e: RedisError) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Redis error: {str(e)}",
+        )
+
+    @staticmethod
+    def _reserved(quota: Quota, reply: list) -> Tuple[RateLimitResult, int]:
+        granted, remote_remaining, wait_ms = (int(value) for value in reply)
+        if granted > 0:
+            return RateLimitResult(True, quota.capacity, remote_remaining, 0), granted
+        return RateLimitResult(False, quota.capacity, remote_remaining, wait_ms), 0
+
+    async def areserve(
+        self, key: str, quota: Quota, estimate: int
+    ) -> Tuple[RateLimitResult, int]:
+        """
+        Hold up to `estimate` tokens, allowed while any are left.
+
+        Returns:
+            Tuple[RateLimitResult, int]: The decision and the tokens held, to be
+                passed to `settle`.
+
+        Raises:
+            HTTPException: If Redis operations fail
+        """
+        try:
+            reply = await self._async_remote()(
+                keys=[self._bucket_key(key)], args=self._args(quota, estimate, False)
+            )
+        except RedisError as e:
+            raise self._redis_error(e) from e
+        return self._reserved(quota, reply)
+
+    def settle(self, key: str, quota: Quota, reserved: int, used: int) -> None:
+        """Charge the usage of a run that held `reserved` tokens, may go negative."""
+        if used == reserved:
+            return
+        try:
+            self._remote()(
+                keys=[self._bucket_key(key)],
+                args=self._args(quota, used - reserved, True),
+            )
+        except RedisError as e:
+            logger.error(
+                f"[QUOTA] Failed to settle {used}/{reserved} {self.namespace} of {key}: {e}"
+            )
+
+    async def asettle(self, key: str, quota: Quota, reserved: int, used: int) -> None:
+        """Async variant of `settle`."""
+        if used == reserved:
+            return
+        try:
+            await self._async_remote()(
+                keys=[self._bucket_key(key)],
+                args=self._args(quota, used - reserved, True),
+            )
+        except RedisError as e:
+            logger.error(
+                f"[QUOTA] Failed to settle {used}/{reserved} {self.namespace} of {key}: {e}"
+            )
+
+
+class HybridTokenBucket(TokenBucket):
+    """
+    Token buckets kept in Redis, spent from per-worker leases.
+
+    A worker takes a lease of several tokens from the shared bucket and spends
+    it locally, so most decisions never leave the process. Leases expire after
+    RATE_LIMIT_LEASE_TTL seconds, which bounds how far the workers together can
+    overshoot a quota, and their unused tokens go back to the shared bucket
+    then, when they are evicted, and on shutdown. An empty bucket is remembered
+    until it refills so rejected requests stay local as well.
+    """
+
+    def __init__(self, namespace: str):
+        super().__init__(namespace)
+        # Oldest top-up first, a lease lives RATE_LIMIT_LEASE_TTL seconds
+        # after it was last topped up
+        self._leases: "OrderedDict[str, _Lease]" = OrderedDict()
+        # Leases taken out, whose unused tokens are not given back yet
+        self._returns: List[Tuple[str, _Lease]] = []
+        self._lock = threading.Lock()
+
+    def _retire(self, key: str) -> None:
+        lease = self._leases.pop(key)
+        if lease.tokens > 0:
+            self._returns.append((key, lease))
+
+    def _lease(self, key: str, quota: Quota) -> _Lease:
+        lease = self._leases.get(key)
+        if lease is not None and lease.expires_at <= time.monotonic():
+            self._retire(key)
+            lease = None
+        if lease is None:
+            lease = self._leases[key] = _Lease(quota)
+        return lease
+
+    def _expired(self) -> List[Tuple[str, _Lease]]:
+        """Take out the leases past their TTL or over RATE_LIMIT_MAX_LEASES."""
+        now = time.monotonic()
+        with self._lock:
+            while self._leases:
+                key, lease = next(iter(self._leases.items()))
+                if (
+                    lease.expires_at > now
+                    and len(self._leases) <= settings.RATE_LIMIT_MAX_LEASES
+                ):
+                    break
+                self._retire(key)
+            returns, self._returns = self._returns, []
+        return returns
+
+    def _give_back(self, leases: List[Tuple[str, _Lease]]) -> None:
+        for key, lease in leases:
+            self.settle(key, lease.quota, lease.tokens, 0)
+
+    async def _agive_back(self, leases: List[Tuple[str, _Lease]]) -> None:
+        for key, lease in leases:
+            await self.asettle(key, lease.quota, lease.tokens, 0)
+
+    def _take_local(self, key: str, quota: Quota, cost: int) -> Optional[RateLimitResult]:
+        """Decide from the local lease, or return None when Redis must be asked."""
+        with self._lock:
+            lease = self._lease(key, quota)
+            if lease.tokens < cost:
+                wait = lease.empty_until - time.monotonic()
+                if wait > 0:
+                    return RateLimitResult(
+                        False, quota.capacity, lease.tokens, math.ceil(wait * 1000)
+                    )
+                return None
+            lease.tokens -= cost
+            return RateLimitResult(
+                True, quota.capacity, lease.tokens + lease.remote_remaining, 0
+            )
+
+    def _to_request(self, key: str, quota: Quota, cost: int) -> int:
+        with self._lock:
+            return max(quota.lease_size, cost - self._lease(key, quota).tokens)
+
+    def _merge(self, key: str, quota: Quota, cost: int, reply: list) -> RateLimitResult:
+        granted, remote_remaining, wait_ms = (int(value) for value in reply)
+        with self._lock:
+            lease = self._lease(key, quota)
+            lease.tokens += granted
+            lease.remote_remaining = remote_remaining
+            lease.expires_at = time.monotonic() + settings.RATE_LIMIT_LEASE_TTL
+            self._leases.move_to_end(key)
+            if lease.tokens >= cost:
+                lease.tokens -= cost
+                return RateLimitResult(
+                    True, quota.capacity, lease.tokens + remote_remaining, 0
+                )
+            lease.empty_until = time.monotonic() + wait_ms / 1000
+            return RateLimitResult(
+                False, quota.capacity, lease.tokens + remote_remaining, wait_ms
+            )
+
+    def acquire(self, key: str, quota: Quota, cost: int = 1) -> RateLimitResult:
+        """
+        Spend `cost` tokens, leasing more from Redis when the local lease is short.
+
+        Raises:
+            HTTPException: If Redis operations fail
+        """
+        self._give_back(self._expired())
+        result = self._take_local(key, quota, cost)
+        if result is not None:
+            return result
+        requested = self._to_request(key, quota, cost)
+        try:
+            reply = self._remote()(
+                keys=[self._bucket_key(key)], args=self._args(quota, requested, False)
+            )
+        except RedisError as e:
+            raise self._redis_error(e) from e
+        return self._merge(key, quota, cost, reply)
+
+    async def aacquire(self, key: str, quota: Quota, cost: int = 1) -> RateLimitResult:
+        """Async variant of `acquire`."""
+        await self._agive_back(self._expired())
+        result = self._take_local(key, quota, cost)
+        if result is not None:
+            return result
+        requested = self._to_request(key, quota, cost)
+        try:
+            reply = await self._async_remote()(
+                keys=[self._bucket_key(key)], args=self._args(quota, requested, False)
+            )
+        except RedisError as e:
+            raise self._redis_error(e) from e
+        return self._merge(key, quota, cost, reply)
+
+    async def aclose(self) -> None:
+        """Give every lease back, when the process shuts down."""
+        with self._lock:
+            for key in list(self._leases):
+                self._retire(key)
+            returns, self._returns = self._returns, []
+        await self._agive_back(returns)
+
+
+request_buckets = HybridTokenBucket("requests")
+# Usage is known once a run is over, so runs reserve and settle instead of leasing
+llm_token_buckets = TokenBucket("llm_tokens")
+
+
+def _tier(user: Principal) -> str:
+    return user.tier or "free"
+
+
+def request_quota(user: Principal, extra_requests: int = 0) -> Quota:
+    quotas = settings.RATE_LIMIT_TIER_REQUESTS
+    return Quota(
+        quotas.get(_tier(user), quotas["free"]) + extra_requests,
+        settings.RATE_LIMIT_WINDOW,
+    )
+
+
+def llm_token_quota(user: Principal) -> Quota:
+    quotas = settings.LLM_TOKEN_TIER_QUOTAS
+    return Quota(quotas.get(_tier(user), quotas["free"]), settings.LLM_TOKEN_QUOTA_WINDOW)
+
+
+def _enforce(result: RateLimitResult, detail: str) -> None:
+    if not result.allowed:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers=result.headers,
+        )
+
+
+def limit_requests(scope: str, extra_requests: int = 0):
+    """
+    Dependency limiting requests per authenticated user according to their tier.
+
+    Args:
+        scope (str): Name of the bucket, one per endpoint.
+        extra_requests (int): Requests allowed on top of the tier quota.
+    """
+
+    async def dependency(
+        request: Request, user: Principal = Depends(verify_token)
+    ) -> Principal:
+        result = await request_buckets.aacquire(
+            f"{scope}:{user.id}", request_quota(user, extra_requests)
+        )
+        _enforce(result, "Too many requests")
+        # Added to the response by APIMiddleware
+        request.state.rate_limit = result
+        return user
+
+    return dependency
+
+
+async def limit_llm_tokens(
+    request: Request, user: Principal = Depends(verify_token)
+) -> Principal:
+    """
+    Dependency admitting a request only while the user has LLM tokens left.
+
+    Up to LLM_TOKEN_RESERVATION tokens are reserved here, kept in
+    `request.state.llm_tokens_reserved`. The run must settle them with
+    `charge_llm_tokens` once it is over, or with 0 if it never started.
+    """
+    result, reserved = await llm_token_buckets.areserve(
+        user.id, llm_token_quota(user), settings.LLM_TOKEN_RESERVATION
+    )
+    _enforce(result, "LLM token quota exceeded")
+    request.state.llm_tokens_reserved = reserved
+    return user
+
+
+def charge_llm_tokens(user: Principal, tokens: int, reserved: int = 0) -> None:
+    """Charge the tokens a run used, less the `reserved` ones already taken."""
+    llm_token_buckets.settle(user.id, llm_token_quota(user), reserved, tokens)
+
+
+async def acharge_llm_tokens(user: Principal, tokens: int, reserved: int = 0) -> None:
+    await llm_token_buckets.asettle(user.id, llm_token_quota(user), reserved, tokens)
@@ -1,7 +1,261 @@
+import asyncio
+import threading
+import time
+from typing import Any, Iterable, Optional
+
 import redis
+import redis.asyncio
 from config import settings
+from log import logger
+
+
+class RedisPoolMetrics:
+    """Connections in use and how long callers waited for one."""
+
+    def __init__(self, max_connections: int):
+        self._lock = threading.Lock()
+        self.max_connections = max_connections
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.failed_checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe_checkout(self, elapsed: float) -> None:
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+
+    def observe_failure(self, elapsed: float) -> None:
+        with self._lock:
+            self.failed_checkouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+
+    def observe_release(self) -> None:
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            waits = self.checkouts + self.failed_checkouts
+            return {
+                "max_connections": self.max_connections,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "failed_checkouts": self.failed_checkouts,
+                "wait_avg_ms": round(self.wait_total / waits * 1000, 3) if waits else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+
+class InstrumentedBlockingConnectionPool(redis.BlockingConnectionPool):
+    """Bounded pool that waits up to `timeout` seconds for a free connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = RedisPoolMetrics(self.max_connections)
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except redis.ConnectionError:
+            self.metrics.observe_failure(time.perf_counter() - start)
+            raise
+        self.metrics.observe_checkout(time.perf_counter() - start)
+        return connection
+
+    def release(self, connection) -> None:
+        super().release(connection)
+        self.metrics.observe_release()
+
+
+class InstrumentedAsyncBlockingConnectionPool(redis.asyncio.BlockingConnectionPool):
+    """Async counterpart of `InstrumentedBlockingConnectionPool`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = RedisPoolMetrics(self.max_connections)
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except redis.ConnectionError:
+            self.metrics.observe_failure(time.perf_counter() - start)
+            raise
+        self.metrics.observe_checkout(time.perf_counter() - start)
+        return connection
+
+    async def release(self, connection) -> None:
+        await super().release(connection)
+        self.metrics.observe_release()
+
+
+class RedisManager:
+    """
+    Owns the process-wide Redis clients.
+
+    The sync client (threadpool code) and the async client (event loop code)
+    each draw from one bounded pool, created on first use. The async pool is
+    bound to the event loop that first used it, so it is opened in the app
+    lifespan and closed there as well.
+
+    Commands whose reply nobody waits for can be handed to that loop with
+    `send_soon`, from the loop or from any thread.
+    """
+
+    def __init__(self, url: Optional[str]):
+        self.url = url
+        self._lock = threading.Lock()
+        self._client: Optional[redis.Redis] = None
+        self._async_client: Optional[redis.asyncio.Redis] = None
+        # The loop of the lifespan, set from startup to shutdown
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Commands sent by send_soon, held until they are done
+        self._sending: set[asyncio.Task] = set()
+
+    def _pool_options(self) -> dict:
+        return {
+            "max_connections": settings.REDIS_MAX_CONNECTIONS,
+            "timeout": settings.REDIS_POOL_TIMEOUT,
+            "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+            "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+        }
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    pool = InstrumentedBlockingConnectionPool.from_url(
+                        self.url, **self._pool_options()
+                    )
+                    self._client = redis.Redis(connection_pool=pool)
+        return self._client
+
+    @property
+    def async_client(self) -> redis.asyncio.Redis:
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    pool = InstrumentedAsyncBlockingConnectionPool.from_url(
+                        self.url, **self._pool_options()
+                    )
+                    self._async_client = redis.asyncio.Redis(connection_pool=pool)
+        return self._async_client
+
+    def pipeline(self, commands: Iterable[tuple], transaction: bool = False) -> list[Any]:
+        """
+        Send several commands in one round trip.
+
+        Args:
+            commands: `(command, *args)` tuples, e.g. `("get", key)`
+            transaction: Wrap the commands in MULTI/EXEC
+
+        Returns:
+            list: One result per command, in order
+        """
+        with self.client.pipeline(transaction=transaction) as pipe:
+            for command, *args in commands:
+                getattr(pipe, command)(*args)
+            return pipe.execute()
+
+    async def apipeline(
+        self, commands: Iterable[tuple], transaction: bool = False
+    ) -> list[Any]:
+        """Async variant of `pipeline`."""
+        async with self.async_client.pipeline(transaction=transaction) as pipe:
+            for command, *args in commands:
+                getattr(pipe, command)(*args)
+            return await pipe.execute()
+
+    def send_soon(self, command: str, *args, **kwargs) -> bool:
+        """
+        Send a command on the async client without waiting for it.
+
+        Errors are logged, not raised. Safe to call from sync code running on
+        the event loop, e.g. SQLAlchemy events of an AsyncSession, and from
+        other threads.
+
+        Returns:
+            bool: False when no lifespan loop is running, the caller should
+                send the command itself.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return False
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._send(command, args, kwargs)
+        else:
+            loop.call_soon_threadsafe(self._send, command, args, kwargs)
+        return True
+
+    def _send(self, command: str, args: tuple, kwargs: dict) -> None:
+        async def send():
+            try:
+                await getattr(self.async_client, command)(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"[REDIS] Could not send {command.upper()}: {e}")
+
+        task = asyncio.ensure_future(send())
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def startup(self) -> None:
+        """Open the async pool on the running loop and check that Redis answers."""
+        if not self.url:
+            logger.warning("[REDIS] REDIS_URI is not set")
+            return
+        self._loop = asyncio.get_running_loop()
+        try:
+            await self.async_client.ping()
+        except redis.RedisError as e:
+            logger.warning(f"[REDIS] Redis is not reachable at startup: {e}")
+
+    async def shutdown(self) -> None:
+        self._loop = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        with self._lock:
+            client, async_client = self._client, self._async_client
+            self._client = self._async_client = None
+        if async_client is not None:
+            await async_client.aclose()
+            await async_client.connection_pool.disconnect()
+        if client is not None:
+            client.connection_pool.disconnect()
+
+    def metrics(self) -> dict:
+        return {
+            "sync": self._client.connection_pool.metrics.snapshot()
+            if self._client is not None
+            else None,
+            "async": self._async_client.connection_pool.metrics.snapshot()
+            if self._async_client is not None
+            else None,
+        }
+
+
+redis_manager = RedisManager(settings.REDIS_URI)
+
+
+def get_redis_client() -> redis.Redis:
+    """Get the process-wide sync client, its connection pool is shared by every caller."""
+    return redis_manager.client
 
 
-def get_redis_client():
-    redis_client = redis.Redis.from_url(settings.REDIS_URI)
-    return redis_client
+def get_async_redis_client() -> redis.asyncio.Redis:
+    """Get the process-wide async client, for use on the app's event loop."""
+    return redis_manager.async_client
@@ -1,4 +1,4 @@
 from .user import User
 from .file import File
-from .wallet import Wallet
-from .referral import Referral
\ No newline at end of file
+from .wallet import Wallet, SpareWallet
+from .referral import Referral, ReferralUse
\ No newline at end of file
@@ -1,10 +1,9 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, text
 from sqlalchemy.orm import relationship
 from app.database.client import Base
 from sqlalchemy import func
 import uuid
 from app.utils.functions import generate_referral_code
-from sqlalchemy.dialects.postgresql import JSONB
 
 
 class Referral(Base):
@@ -16,11 +15,30 @@ class Referral(Base):
     referral_code = Column(
         String, index=True, default=generate_referral_code, unique=True
     )
-    referred_user_ids = Column(JSONB, default=list)
+    # Rows in referral_uses for this referral, only ever changed by
+    # ReferralService.record_use in the statement that adds the row
+    total_used = Column(Integer, nullable=False, default=0, server_default=text("0"))
+
+    # The leaderboard reads this index in order
+    __table_args__ = (
+        Index("ix_referrals_total_used", total_used.desc(), "id"),
+    )
 
     def __repr__(self):
         return f"<Referral(id={self.id}, created_at={self.created_at}, total_used={self.total_used}), referral_code={self.referral_code}>"
 
-    @property
-    def total_used(self):
-        return len(self.referred_user_ids) if self.referred_user_ids else 0
+
+class ReferralUse(Base):
+    """A user who signed up with, or used, a referral code."""
+
+    __tablename__ = "referral_uses"
+    referral_id = Column(
+        String, ForeignKey("referrals.id", ondelete="CASCADE"), primary_key=True
+    )
+    user_id = Column(
+        String, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<ReferralUse(referral_id={self.referral_id}, user_id={self.user_id})>"
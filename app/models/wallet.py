@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, ForeignKey, Float
+from sqlalchemy import Column, String, DateTime, ForeignKey, Float, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy import func
 from app.database.client import Base
@@ -19,3 +19,16 @@ class Wallet(Base):
 
     def __repr__(self):
         return f"<Wallet(id={self.id}, balance={self.balance}, user_id={self.user_id})>"
+
+
+class SpareWallet(Base):
+    """A wallet generated ahead of signups, its private key encrypted with pgcrypto."""
+
+    __tablename__ = "spare_wallets"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    public_key = Column(String, nullable=False)
+    private_key = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+    def __repr__(self):
+        return f"<SpareWallet(id={self.id}, public_key={self.public_key})>"
@@ -1,37 +1,65 @@
 from fastapi import APIRouter, Request
-from app.dto import AgentHistoryRequest, AgentCallRequest
+from app.dto import AgentHistoryRequest, AgentHistoryPageRequest, AgentCallRequest
 from app.controllers.agent import AgentController
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from fastapi.exceptions import HTTPException
-from app.middleware.decorator import rate_limit
 from config import settings
 from fastapi import File, UploadFile
 from storage.aws_s3 import S3Storage
-from typing import List
+from typing import List, Optional
 import logging
 from uuid import uuid4
 from config import settings
-from app.middleware.auth import verify_token
-from app.models import User
-from fastapi import Depends
+from app.middleware.admission import admission
+from app.middleware.auth import Principal, verify_token
+from app.middleware.quota import acharge_llm_tokens, limit_llm_tokens, limit_requests
+from app.services.runs import run_log
+from app.utils.sse import TokenCoalescer, encode_event
+from agents.cancellation import stream_metrics
+from fastapi import Depends, Header
 from sqlalchemy.orm import Session
 from app.database import get_db
+import anyio
 import json
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["agent"])
 
+# Redis stream entry id, used as the SSE event id of detached runs
+STREAM_ID = re.compile(r"\d+-\d+")
+
 
 @router.post("/agent/history")
-def agent_history(
+async def agent_history(
     request: Request,
     body: AgentHistoryRequest,
-    user: User = Depends(verify_token),
+    user: Principal = Depends(verify_token),
+):
+    try:
+        agent_controller = AgentController(str(user.id), body.session_id)
+        return await agent_controller.aget_agent_history()
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/agent/history/page")
+async def agent_history_page(
+    request: Request,
+    body: AgentHistoryPageRequest,
+    user: Principal = Depends(verify_token),
 ):
     try:
         agent_controller = AgentController(str(user.id), body.session_id)
-        return agent_controller.get_agent_history()
+        return await agent_controller.aget_agent_history_page(body.cursor, body.limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -40,34 +68,171 @@ def agent_history(
 
 @router.post(
     "/agent/call",
+    dependencies=[Depends(limit_requests("agent_call"))],
 )
-@rate_limit(
-    max_requests=settings.RATE_LIMIT_MAX_REQUESTS, window=settings.RATE_LIMIT_WINDOW
-)
-def agent_call(
+async def agent_call(
     request: Request,
     body: AgentCallRequest,
-    user: User = Depends(verify_token),
+    user: Principal = Depends(limit_llm_tokens),
 ):
+    # Held by limit_llm_tokens, settled exactly once whether or not the run starts
+    reserved = request.state.llm_tokens_reserved
+    settled = False
+
+    async def settle(tokens_used: int):
+        nonlocal settled
+        if not settled:
+            settled = True
+            await acharge_llm_tokens(user, tokens_used, reserved)
+
     try:
+        if settings.AGENT_DETACHED_RUNS:
+            try:
+                return await detached_agent_call(body, user, reserved)
+            except BaseException:
+                await settle(0)
+                raise
 
-        def event_generator():
-            agent_controller = AgentController(str(user.id), body.session_id)
-            aggregated_response = ""
-            response = agent_controller.call_agent(body.message, body.images)
-            for chunk in response:
-                aggregated_response += chunk.content
-                data = {
-                    "v": chunk.content,
-                }
-                yield f"event: token\ndata: {json.dumps(data)}\n\n"
-            data = {
-                "v": aggregated_response,
-            }
-            yield f"event: end\ndata: {json.dumps(data)}\n\n"
-
-        return StreamingResponse(event_generator(), media_type="text/event-stream")
+        agent_controller = AgentController(str(user.id), body.session_id)
+        coalescer = TokenCoalescer.configure(
+            body.stream_interval_ms, body.stream_max_chars
+        )
+        # Rejects right away with 429/503 when the user or the process is saturated
+        try:
+            ticket = admission.acquire(user)
+        except HTTPException:
+            await settle(0)
+            raise
+
+        async def run_events():
+            stream_metrics.observe_start()
+            disconnected = False
+            try:
+                tokens = agent_controller.stream_tokens(body.message, body.images)
+                async for frame in coalescer.stream(tokens):
+                    yield frame
+            except (anyio.get_cancelled_exc_class(), GeneratorExit):
+                disconnected = True
+                raise
+            finally:
+                # Still charge when the client disconnected and the stream was cancelled
+                with anyio.CancelScope(shield=True):
+                    cancelled = disconnected and not coalescer.completed
+                    if cancelled:
+                        agent_controller.cancel()
+                        # The agent must be done with its memory and usage first
+                        if await agent_controller.wait_stopped(
+                            settings.AGENT_CANCEL_TIMEOUT
+                        ):
+                            await run_in_threadpool(
+                                agent_controller.save_cancelled_run, coalescer.text
+                            )
+                        else:
+                            logger.warning(
+                                "Cancelled agent run still busy after "
+                                f"{settings.AGENT_CANCEL_TIMEOUT}s, not saved"
+                            )
+                    tokens_used = agent_controller.llm_tokens_used()
+                    stream_metrics.observe_end(cancelled, tokens_used)
+                    await settle(tokens_used)
+
+        async def event_generator():
+            timed_out = False
+            try:
+                # Tell a queued client its position until the run is admitted
+                deadline = time.monotonic() + settings.AGENT_QUEUE_TIMEOUT
+                reported = None
+                position = admission.position(ticket)
+                while position:
+                    if position != reported:
+                        yield encode_event("queue", str(position))
+                        reported = position
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        timed_out = True
+                        yield encode_event("error", "The agent is busy, try again later")
+                        return
+                    position = await admission.wait(ticket, min(1.0, remaining)) or 0
+
+                async for frame in run_events():
+                    yield frame
+            finally:
+                with anyio.CancelScope(shield=True):
+                    # A cancelled agent keeps its thread and connections until
+                    # it notices, its slot is held until then, or until an
+                    # agent stuck in a tool or an upstream read is given up on
+                    if not await agent_controller.wait_stopped(
+                        settings.AGENT_CANCEL_TIMEOUT
+                    ):
+                        logger.warning(
+                            "Agent run still busy after "
+                            f"{settings.AGENT_CANCEL_TIMEOUT}s, releasing its slot"
+                        )
+                    admission.release(ticket, timed_out=timed_out)
+                    # The run never started, nothing was used
+                    await settle(0)
+
+        async def finish():
+            # Also when the client left before the stream started
+            admission.release(ticket)
+            await settle(0)
+
+        return StreamingResponse(
+            event_generator(),
+            media_type="text/event-stream",
+            background=BackgroundTask(finish),
+        )
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+async def detached_agent_call(body: AgentCallRequest, user: Principal, reserved: int):
+    """
+    Queue the run for the worker pool and follow its events.
+
+    The worker settles the `reserved` LLM tokens once the run is over.
+    """
+    run_id = await run_log.enqueue(
+        {
+            "user_id": str(user.id),
+            "session_id": body.session_id,
+            "tier": user.tier or "",
+            "llm_tokens_reserved": reserved,
+            "message": body.message,
+            "images": json.dumps(body.images),
+            "stream_interval_ms": (
+                body.stream_interval_ms if body.stream_interval_ms is not None else ""
+            ),
+            "stream_max_chars": body.stream_max_chars or "",
+        }
+    )
+
+    async def event_generator():
+        # Tells the client where to resume from if the connection drops
+        yield encode_event("run", run_id)
+        async for frame in run_log.events(run_id):
+            yield frame
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"X-Run-Id": run_id},
+    )
+
+
+@router.get("/agent/runs/{run_id}/events")
+async def agent_run_events(
+    run_id: str,
+    last_event_id: Optional[str] = Header(None),
+    user: Principal = Depends(verify_token),
+):
+    """Follow a detached run, from the start or after `Last-Event-ID`."""
+    if last_event_id is not None and not STREAM_ID.fullmatch(last_event_id):
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    if await run_log.owner(run_id) != str(user.id):
+        raise HTTPException(status_code=404, detail="Run not found")
+    return StreamingResponse(
+        run_log.events(run_id, last_event_id), media_type="text/event-stream"
+    )
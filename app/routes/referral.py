@@ -1,19 +1,38 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dto import UseRefCodeRequest
 from app.controllers.referral import ReferralController
-from app.database import get_db
-from app.middleware.auth import verify_token
-from app.models.user import User
+from app.database import get_async_db
+from app.middleware.auth import Principal, verify_token
 
 router = APIRouter(tags=["referral"])
 
 
 @router.post("/ref/use")
-def use_ref(
+async def use_ref(
     body: UseRefCodeRequest,
-    user: User = Depends(verify_token),
-    db: Session = Depends(get_db),
+    user: Principal = Depends(verify_token),
+    db: AsyncSession = Depends(get_async_db),
 ):
     ref_controller = ReferralController(db)
-    return ref_controller.use_ref(body, user)
+    return await ref_controller.use_ref(body, user)
+
+
+@router.get("/ref/leaderboard")
+async def get_leaderboard(
+    limit: int = Query(10, ge=1, le=100),
+    # It lists the usernames and avatars of other users
+    user: Principal = Depends(verify_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    ref_controller = ReferralController(db)
+    return await ref_controller.get_leaderboard(limit)
+
+
+@router.get("/ref/stats")
+async def get_stats(
+    user: Principal = Depends(verify_token),
+    db: AsyncSession = Depends(get_async_db),
+):
+    ref_controller = ReferralController(db)
+    return await ref_controller.get_stats(user)
@@ -20,5 +20,36 @@ class AgentService:
         )
         return response
 
+    async def acall_agent(
+        self,
+        message: str,
+        images: list[str] = [],
+        stream: bool = True,
+    ):
+        response = await self.agent.arun(
+            message=message,
+            images=images,
+            stream=stream,
+        )
+        return response
+
+    def llm_tokens_used(self) -> int:
+        return self.agent.llm_tokens_used()
+
+    def cancel(self):
+        self.agent.cancel()
+
+    def save_cancelled_run(self, content: str):
+        self.agent.save_cancelled_run(content)
+
     def get_history(self):
         return self.agent.get_history()
+
+    def get_history_page(self, cursor: str = None, limit: int = None):
+        return self.agent.get_history_page(cursor=cursor, limit=limit)
+
+    async def aget_history(self):
+        return await self.agent.aget_history()
+
+    async def aget_history_page(self, cursor: str = None, limit: int = None):
+        return await self.agent.aget_history_page(cursor=cursor, limit=limit)
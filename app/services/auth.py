@@ -1,9 +1,9 @@
 import base64
 import hashlib
 import secrets
-import requests
 from typing import Dict, Optional
 from app.utils.functions import create_jwt_token, generate_uuid
+from app.utils.requests import RETRYABLE_STATUS_CODES, get_session, retry_request
 from config import settings
 from log import logger
 from app.services.user import UserService
@@ -11,6 +11,16 @@ from sqlalchemy.orm import Session
 from app.database import get_db
 
 
+X_API_BASE_URL = "https://api.x.com"
+
+
+def _raise_for_retryable_status(response):
+    """Raise on the statuses retry_request may retry, return any other response."""
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        response.raise_for_status()
+    return response
+
+
 class AuthService:
     def __init__(self):
         self.x_client_id = settings.X_CLIENT_ID
@@ -39,7 +49,7 @@ class AuthService:
         """Handle the OAuth2 callback from X"""
         try:
             # Exchange authorization code for tokens
-            token_url = "https://api.x.com/2/oauth2/token"
+            token_url = f"{X_API_BASE_URL}/2/oauth2/token"
 
             auth_string = base64.b64encode(
                 f"{self.x_client_id}:{self.x_client_secret}".encode()
@@ -59,7 +69,16 @@ class AuthService:
             }
 
             # Get tokens
-            token_response = requests.post(token_url, headers=headers, data=data)
+            # Authorization codes are single use, only retry requests X never received
+            http = get_session(X_API_BASE_URL)
+
+            def _get_tokens():
+                # Other 4xx carry an `error` in their JSON, handled below
+                return _raise_for_retryable_status(
+                    http.post(token_url, headers=headers, data=data)
+                )
+
+            token_response = retry_request(_get_tokens, idempotent=False)()
             token_data = token_response.json()
             logger.debug(f"Token response: {token_data}")
 
@@ -68,7 +87,7 @@ class AuthService:
                 raise ValueError(f"Error getting tokens: {token_data['error']}")
 
             # Get user info using the access token
-            user_url = "https://api.x.com/2/users/me"
+            user_url = f"{X_API_BASE_URL}/2/users/me"
             user_headers = {
                 "Authorization": f"Bearer {token_data['access_token']}",
             }
@@ -77,7 +96,12 @@ class AuthService:
             logger.debug(f"Making user info request to: {user_url}")
             logger.debug(f"User headers: {user_headers}")
 
-            user_response = requests.get(user_url, headers=user_headers, params=params)
+            def _get_user():
+                return _raise_for_retryable_status(
+                    http.get(user_url, headers=user_headers, params=params)
+                )
+
+            user_response = retry_request(_get_user)()
             logger.debug(f"User response status: {user_response.status_code}")
             logger.debug(f"User response text: {user_response.text}")
 
@@ -1,3 +1,5 @@
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from app.models.referral import Referral
@@ -8,6 +10,65 @@ from app.utils.functions import generate_referral_code
 from log import logger
 
 
+# Adds a use of a referral and counts it, in one statement. The counter only
+# moves when the (referral_id, user_id) row is new, so concurrent uses never
+# lose an update or count a user twice.
+RECORD_USE = text(
+    """
+    WITH used AS (
+        INSERT INTO referral_uses (referral_id, user_id)
+        VALUES (:referral_id, :user_id)
+        ON CONFLICT DO NOTHING
+        RETURNING referral_id
+    )
+    UPDATE referrals
+    SET total_used = total_used + 1
+    FROM used
+    WHERE referrals.id = used.referral_id
+    RETURNING referrals.total_used
+    """
+)
+
+# The most used referrals, read in order from ix_referrals_total_used. Only
+# referrals with an owner are ranked, here and in REFERRAL_STATS, so both agree
+# on the rank of a referral.
+LEADERBOARD = text(
+    """
+    SELECT rank() OVER (ORDER BY r.total_used DESC) AS rank,
+           r.referral_code,
+           r.total_used,
+           u.username,
+           u.avatar
+    FROM referrals r
+    JOIN users u ON u.id = r.owner_id
+    WHERE r.total_used > 0
+    ORDER BY r.total_used DESC, r.id
+    LIMIT :limit
+    """
+)
+
+# The referral of a user, its number of uses and rank on the leaderboard
+REFERRAL_STATS = text(
+    """
+    SELECT r.referral_code,
+           r.total_used,
+           (
+               SELECT count(*) + 1
+               FROM referrals other
+               WHERE other.total_used > r.total_used
+                 AND other.owner_id IS NOT NULL
+           ) AS rank,
+           (
+               SELECT max(created_at)
+               FROM referral_uses
+               WHERE referral_id = r.id
+           ) AS last_used_at
+    FROM referrals r
+    WHERE r.owner_id = :user_id
+    """
+)
+
+
 class ReferralService:
     def __init__(self, db: Session):
         self.db = db
@@ -69,6 +130,28 @@ class ReferralService:
                 extra={"original_error": str(e)},
             )
 
+    def record_use(self, referral_id: str, user_id: str) -> bool:
+        """
+        Add a use of a referral and count it, in one statement.
+
+        Returns:
+            bool: False when the user already used this referral.
+        """
+        row = self.db.execute(
+            RECORD_USE, {"referral_id": referral_id, "user_id": user_id}
+        ).fetchone()
+        return row is not None
+
+    def get_leaderboard(self, limit: int = 10) -> list[dict]:
+        """The most used referrals, read in order from ix_referrals_total_used."""
+        rows = self.db.execute(LEADERBOARD, {"limit": limit}).mappings()
+        return [dict(row) for row in rows]
+
+    def get_stats(self, user_id: str) -> Optional[dict]:
+        """The referral of a user, its number of uses and rank on the leaderboard."""
+        row = self.db.execute(REFERRAL_STATS, {"user_id": user_id}).mappings().first()
+        return dict(row) if row else None
+
     def get_all_referrals(self) -> list[Referral]:
         """Lấy danh sách tất cả referral"""
         return self.db.query(Referral).all()
@@ -103,8 +186,8 @@ class ReferralService:
                     message=ErrorCode.REFERRAL_NOT_OWNER.name,
                     status_code=400,
                 )
-            # Kiểm tra user đã trong danh sách chưa
-            if user_id in (referral.referred_user_ids or []):
+            # Ghi nhận lượt sử dụng, mỗi user chỉ một lần cho mỗi mã
+            if not self.record_use(referral.id, user_id):
                 raise AppException(
                     error_code=ErrorCode.REFERRAL_ALREADY_USED.value,
                     message=ErrorCode.REFERRAL_ALREADY_USED.name,
@@ -113,7 +196,6 @@ class ReferralService:
 
             # Cập nhật thông tin
             user.used_ref_code = ref_code
-            referral.referred_user_ids = (referral.referred_user_ids or []) + [user_id]
 
             self.db.commit()
 
@@ -128,3 +210,102 @@ class ReferralService:
                 status_code=500,
                 extra={"original_error": str(e)},
             )
+
+
+class AsyncReferralService:
+    """ReferralService on an AsyncSession, for the async endpoints."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def get_referral_by_user_id(self, user_id: str) -> Optional[Referral]:
+        return await self.db.scalar(
+            select(Referral).where(Referral.owner_id == user_id).limit(1)
+        )
+
+    def create_referral(self, user_id: str) -> Referral:
+        """Add a referral with a new code for the user, it is sent on the next flush."""
+        referral_model = Referral(owner_id=user_id, referral_code=generate_referral_code())
+        self.db.add(referral_model)
+        return referral_model
+
+    async def record_use(self, referral_id: str, user_id: str) -> bool:
+        """
+        Add a use of a referral and count it, in one statement.
+
+        Returns:
+            bool: False when the user already used this referral.
+        """
+        result = await self.db.execute(
+            RECORD_USE, {"referral_id": referral_id, "user_id": user_id}
+        )
+        return result.fetchone() is not None
+
+    async def get_leaderboard(self, limit: int = 10) -> list[dict]:
+        """The most used referrals, read in order from ix_referrals_total_used."""
+        result = await self.db.execute(LEADERBOARD, {"limit": limit})
+        return [dict(row) for row in result.mappings()]
+
+    async def get_stats(self, user_id: str) -> Optional[dict]:
+        """The referral of a user, its number of uses and rank on the leaderboard."""
+        result = await self.db.execute(REFERRAL_STATS, {"user_id": user_id})
+        row = result.mappings().first()
+        return dict(row) if row else None
+
+    async def get_all_referrals(self) -> list[Referral]:
+        return list(await self.db.scalars(select(Referral)))
+
+    async def use_ref_code(self, user_id: str, ref_code: str) -> None:
+        """
+        Sử dụng referral code
+        """
+        try:
+            # Kiểm tra user
+            user: User = await self.db.get(User, user_id)
+            if not user:
+                raise AppException(
+                    error_code=ErrorCode.NOT_FOUND.value,
+                    message=ErrorCode.NOT_FOUND.name,
+                    status_code=404,
+                )
+            # Tìm referral code
+            referral: Referral = await self.db.scalar(
+                select(Referral).where(Referral.referral_code == ref_code).limit(1)
+            )
+            if not referral:
+                raise AppException(
+                    error_code=ErrorCode.REFERRAL_NOT_FOUND.value,
+                    message=ErrorCode.REFERRAL_NOT_FOUND.name,
+                    status_code=404,
+                )
+            # Check if user_id is owner of referral
+            if user_id == referral.owner_id:
+                raise AppException(
+                    error_code=ErrorCode.REFERRAL_NOT_OWNER.value,
+                    message=ErrorCode.REFERRAL_NOT_OWNER.name,
+                    status_code=400,
+                )
+            # Ghi nhận lượt sử dụng, mỗi user chỉ một lần cho mỗi mã
+            if not await self.record_use(referral.id, user_id):
+                raise AppException(
+                    error_code=ErrorCode.REFERRAL_ALREADY_USED.value,
+                    message=ErrorCode.REFERRAL_ALREADY_USED.name,
+                    status_code=400,
+                )
+
+            # Cập nhật thông tin
+            user.used_ref_code = ref_code
+
+            await self.db.commit()
+
+        except AppException:
+            await self.db.rollback()
+            raise
+        except Exception as e:
+            await self.db.rollback()
+            raise AppException(
+                error_code=ErrorCode.INTERNAL_ERROR.value,
+                message=ErrorCode.INTERNAL_ERROR.name,
+                status_code=500,
+                extra={"original_error": str(e)},
+            )
@@ -0,0 +1,216 @@
+import time
+from typing import AsyncIterator, Optional
+from uuid import uuid4
+
+from redis import ResponseError
+
+from app.middleware.redis import get_async_redis_client
+from app.utils.sse import encode_event
+from config import settings
+
+# Events after which a run produces nothing more
+FINAL_EVENTS = ("end", "error", "cancelled")
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class AgentRunLog:
+    """
+    Agent runs executed by the worker pool, with their events kept in Redis.
+
+    `enqueue` adds a job to the AGENT_JOB_STREAM stream, read by the
+    `agent-workers` consumer group. A worker appends the events of the run to
+    `agent:run:<id>:events`, whose entry ids are the SSE event ids, so any
+    number of readers can follow a run and resume from `Last-Event-ID`.
+
+    Readers keep `agent:run:<id>:reader` alive while they are connected. A run
+    nobody read for AGENT_RUN_ORPHAN_TIMEOUT seconds is cancelled by its worker.
+
+    Workers renew the jobs they run with `keep_claimed`. Jobs left pending by a
+    worker that stopped are taken over by another one with `claim_stale`, and
+    go to the `<AGENT_JOB_STREAM>:dead` stream after AGENT_JOB_MAX_DELIVERIES
+    deliveries.
+    """
+
+    group = "agent-workers"
+
+    @property
+    def jobs_key(self) -> str:
+        return settings.AGENT_JOB_STREAM
+
+    @property
+    def dead_letter_key(self) -> str:
+        return f"{settings.AGENT_JOB_STREAM}:dead"
+
+    @staticmethod
+    def run_key(run_id: str) -> str:
+        return f"agent:run:{run_id}"
+
+    @staticmethod
+    def events_key(run_id: str) -> str:
+        return f"agent:run:{run_id}:events"
+
+    @staticmethod
+    def reader_key(run_id: str) -> str:
+        return f"agent:run:{run_id}:reader"
+
+    async def ensure_group(self) -> None:
+        try:
+            await get_async_redis_client().xgroup_create(
+                self.jobs_key, self.group, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def enqueue(self, job: dict) -> str:
+        """
+        Queue a run for the workers.
+
+        Args:
+            job (dict): The fields of the run, `user_id` and `session_id` at least.
+
+        Returns:
+            str: The id of the run.
+        """
+        run_id = uuid4().hex
+        client = get_async_redis_client()
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                self.run_key(run_id),
+                mapping={
+                    "user_id": job["user_id"],
+                    "session_id": job["session_id"],
+                    "status": "queued",
+                },
+            )
+            pipe.expire(self.run_key(run_id), settings.AGENT_RUN_TTL)
+            # Counts as a reader until the client attaches to the stream
+            pipe.set(self.reader_key(run_id), 1, ex=settings.AGENT_RUN_ORPHAN_TIMEOUT)
+            pipe.xadd(self.jobs_key, {**job, "run_id": run_id})
+            await pipe.execute()
+        return run_id
+
+    async def owner(self, run_id: str) -> Optional[str]:
+        user_id = await get_async_redis_client().hget(self.run_key(run_id), "user_id")
+        return _text(user_id) if user_id is not None else None
+
+    async def status(self, run_id: str) -> Optional[str]:
+        status = await get_async_redis_client().hget(self.run_key(run_id), "status")
+        return _text(status) if status is not None else None
+
+    async def set_status(self, run_id: str, status: str) -> None:
+        await get_async_redis_client().hset(self.run_key(run_id), "status", status)
+
+    async def fail(self, run_id: str, message: str) -> None:
+        """End a run with an `error` event, its readers stop waiting."""
+        await self.append(run_id, "error", message)
+        await self.set_status(run_id, "failed")
+
+    async def keep_claimed(self, consumer: str, entry_ids: list) -> None:
+        """Reset the idle time of jobs `consumer` is running, so no one claims them."""
+        client = get_async_redis_client()
+        # Only the ones it still owns, a job claimed by another worker stays there
+        pending = await client.xpending_range(
+            self.jobs_key,
+            self.group,
+            min="-",
+            max="+",
+            count=len(entry_ids) + settings.AGENT_WORKER_CONCURRENCY,
+            consumername=consumer,
+        )
+        owned = [entry["message_id"] for entry in pending if entry["message_id"] in entry_ids]
+        if owned:
+            await client.xclaim(
+                self.jobs_key, self.group, consumer, 0, owned, justid=True
+            )
+
+    async def claim_stale(self, consumer: str, count: int) -> list:
+        """
+        Take over up to `count` jobs pending for AGENT_JOB_CLAIM_IDLE seconds.
+
+        Jobs already delivered AGENT_JOB_MAX_DELIVERIES times are dead-lettered
+        instead.
+
+        Returns:
+            list: The `(entry_id, fields)` of the jobs claimed.
+        """
+        client = get_async_redis_client()
+        min_idle = settings.AGENT_JOB_CLAIM_IDLE * 1000
+        pending = await client.xpending_range(
+            self.jobs_key, self.group, min="-", max="+", count=count, idle=min_idle
+        )
+        for entry in pending:
+            if entry["times_delivered"] >= settings.AGENT_JOB_MAX_DELIVERIES:
+                await self.dead_letter(
+                    entry["message_id"], f"delivered {entry['times_delivered']} times"
+                )
+        reply = await client.xautoclaim(
+            self.jobs_key, self.group, consumer, min_idle, start_id="0-0", count=count
+        )
+        # Entries deleted from the stream meanwhile come back without fields
+        return [(entry_id, fields) for entry_id, fields in reply[1] if fields]
+
+    async def dead_letter(self, entry_id, reason: str) -> None:
+        """Move a job to the dead-letter stream and fail its run."""
+        client = get_async_redis_client()
+        entries = await client.xrange(self.jobs_key, entry_id, entry_id)
+        fields = entries[0][1] if entries else {}
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.xadd(
+                self.dead_letter_key,
+                {**fields, "entry_id": entry_id, "reason": reason},
+            )
+            pipe.xack(self.jobs_key, self.group, entry_id)
+            await pipe.execute()
+        run_id = fields.get(b"run_id")
+        if run_id is not None:
+            await self.fail(_text(run_id), "The run could not be completed")
+
+    async def append(self, run_id: str, event: str, value: str) -> str:
+        """Add an event to the run, the returned entry id is its SSE id."""
+        client = get_async_redis_client()
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.xadd(self.events_key(run_id), {"event": event, "data": value})
+            pipe.expire(self.events_key(run_id), settings.AGENT_RUN_TTL)
+            entry_id, _ = await pipe.execute()
+        return _text(entry_id)
+
+    async def has_reader(self, run_id: str) -> bool:
+        return bool(await get_async_redis_client().exists(self.reader_key(run_id)))
+
+    async def events(
+        self, run_id: str, last_event_id: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Yield the SSE frames of a run after `last_event_id`, until its final event.
+
+        Gives up with an `error` frame when nothing was appended for
+        AGENT_RUN_READ_TIMEOUT seconds, e.g. when the worker running it died.
+        """
+        client = get_async_redis_client()
+        events_key = self.events_key(run_id)
+        last_id = last_event_id or "0-0"
+        last_seen = time.monotonic()
+        while True:
+            await client.set(
+                self.reader_key(run_id), 1, ex=settings.AGENT_RUN_ORPHAN_TIMEOUT
+            )
+            reply = await client.xread({events_key: last_id}, count=100, block=1000)
+            if not reply:
+                if time.monotonic() - last_seen > settings.AGENT_RUN_READ_TIMEOUT:
+                    yield encode_event("error", "The run stopped responding")
+                    return
+                continue
+            last_seen = time.monotonic()
+            for entry_id, fields in reply[0][1]:
+                last_id = _text(entry_id)
+                event = _text(fields[b"event"])
+                yield encode_event(event, _text(fields[b"data"]), event_id=last_id)
+                if event in FINAL_EVENTS:
+                    return
+
+
+run_log = AgentRunLog()
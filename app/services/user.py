@@ -1,10 +1,175 @@
+from typing import NamedTuple, Optional
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app.models.user import User
 from app.models.referral import Referral
+from app.services.referral import AsyncReferralService, ReferralService
 from app.dto import UserRequestDTO
 from app.core.exceptions import AppException, ErrorCode
-from sqlalchemy.exc import IntegrityError
-from app.utils.functions import generate_uuid
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from app.utils.functions import generate_referral_code, generate_uuid
+from config import settings
+from log import logger
+
+
+class LoginRecord(NamedTuple):
+    """A user with the wallet and referral a login responds with."""
+
+    id: str
+    email: str
+    username: str
+    avatar: Optional[str]
+    # True when the user was registered by this login
+    created: bool
+    # None when no wallet exists yet and none was spare
+    public_key: Optional[str]
+    wallet_claimed: bool
+    referral_code: Optional[str]
+    total_used: int
+
+
+# Finds the user by email or registers them, with their wallet and referral, in
+# one round trip. Data-modifying CTEs all see the snapshot taken before the
+# statement, so each step reads what the previous ones created from their
+# RETURNING. The `spare` step is one of the two below.
+_LOGIN_OR_REGISTER = """
+    WITH existing AS (
+        SELECT id, email, username, avatar
+        FROM users
+        WHERE email = :email
+    ),
+    used_referral AS (
+        SELECT id, referral_code
+        FROM referrals
+        WHERE referral_code = :ref_code
+          AND NOT EXISTS (SELECT 1 FROM existing)
+    ),
+    new_user AS (
+        INSERT INTO users (id, email, username, avatar, tier, used_ref_code)
+        SELECT :id, :email, :username, :avatar, 'free',
+               (SELECT referral_code FROM used_referral)
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        ON CONFLICT (email) DO NOTHING
+        RETURNING id, email, username, avatar
+    ),
+    account AS (
+        SELECT id, email, username, avatar, FALSE AS created FROM existing
+        UNION ALL
+        SELECT id, email, username, avatar, TRUE AS created FROM new_user
+    ),
+    referral_use AS (
+        INSERT INTO referral_uses (referral_id, user_id)
+        SELECT used_referral.id, new_user.id
+        FROM used_referral, new_user
+        ON CONFLICT DO NOTHING
+        RETURNING referral_id
+    ),
+    referred AS (
+        UPDATE referrals
+        SET total_used = total_used + 1
+        FROM referral_use
+        WHERE referrals.id = referral_use.referral_id
+        RETURNING referrals.id
+    ),
+    wallet AS (
+        SELECT w.public_key
+        FROM wallets w
+        JOIN account ON w.user_id = account.id
+        LIMIT 1
+    ),
+    spare AS ({spare}),
+    new_wallet AS (
+        INSERT INTO wallets (id, user_id, public_key, private_key, balance)
+        SELECT gen_random_uuid()::text, account.id, spare.public_key, spare.private_key, 0
+        FROM account, spare
+        RETURNING public_key
+    ),
+    referral AS (
+        SELECT r.referral_code, r.total_used
+        FROM referrals r
+        JOIN account ON r.owner_id = account.id
+    ),
+    new_referral AS (
+        INSERT INTO referrals (id, owner_id, referral_code)
+        SELECT gen_random_uuid()::text, account.id, :referral_code
+        FROM account
+        WHERE NOT EXISTS (SELECT 1 FROM referral)
+        ON CONFLICT DO NOTHING
+        RETURNING referral_code, total_used
+    )
+    SELECT account.id,
+           account.email,
+           account.username,
+           account.avatar,
+           account.created,
+           COALESCE((SELECT public_key FROM wallet), (SELECT public_key FROM new_wallet))
+               AS public_key,
+           EXISTS (SELECT 1 FROM new_wallet) AS wallet_claimed,
+           COALESCE(
+               (SELECT referral_code FROM referral),
+               (SELECT referral_code FROM new_referral)
+           ) AS referral_code,
+           COALESCE(
+               (SELECT total_used FROM referral),
+               (SELECT total_used FROM new_referral),
+               0
+           ) AS total_used
+    FROM account
+"""
+
+# New users take a spare wallet (see WalletReservoir) when one is left
+_CLAIM_SPARE = """
+        DELETE FROM spare_wallets
+        WHERE id = (
+            SELECT id FROM spare_wallets
+            WHERE EXISTS (SELECT 1 FROM account)
+              AND NOT EXISTS (SELECT 1 FROM wallet)
+            ORDER BY created_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING public_key, pgp_sym_decrypt(private_key, :wallet_key) AS private_key
+    """
+
+# Without a reservoir key nothing is claimed, and neither `spare_wallets` nor
+# pgcrypto has to exist
+_NO_SPARE = "SELECT NULL::text AS public_key, NULL::text AS private_key WHERE FALSE"
+
+LOGIN_OR_REGISTER = text(_LOGIN_OR_REGISTER.format(spare=_NO_SPARE))
+LOGIN_OR_REGISTER_CLAIMING = text(_LOGIN_OR_REGISTER.format(spare=_CLAIM_SPARE))
+
+
+def _login_params(
+    email: str,
+    username: str,
+    avatar: Optional[str],
+    ref_code: Optional[str],
+    id: Optional[str],
+) -> dict:
+    return {
+        "id": id or generate_uuid(),
+        "email": email,
+        "username": username,
+        "avatar": avatar or User.avatar.default.arg,
+        "ref_code": ref_code,
+        "referral_code": generate_referral_code(),
+        "wallet_key": settings.WALLET_RESERVOIR_KEY,
+    }
+
+
+def _claim_failed(e: Exception) -> None:
+    # The claim runs in a savepoint, the login goes on without it and
+    # AuthController._complete_login creates the wallet
+    logger.error(f"Could not claim a spare wallet at login: {e}")
+
+
+def _registration_failed() -> AppException:
+    return AppException(
+        error_code=ErrorCode.INTERNAL_ERROR,
+        message="Could not register the user",
+        status_code=500,
+    )
 
 
 class UserService:
@@ -23,10 +188,7 @@ class UserService:
             )
             # Generate user id
             id = generate_uuid() if id is None else id
-            # Append user id to referral
-            if referral:
-                referral.referred_user_ids = referral.referred_user_ids + [id]
-            else:
+            if not referral:
                 # If referral not found, set ref_code to None
                 ref_code = None
             user_data = user.model_dump()
@@ -38,9 +200,10 @@ class UserService:
             user_model = User(**user_data)
 
             self.db.add(user_model)
-            # add referral
+            # Count the use of the referral, the user row must exist first
             if referral:
-                self.db.add(referral)
+                self.db.flush()
+                ReferralService(self.db).record_use(referral.id, id)
             # self.db.commit()
 
             return user_model
@@ -56,6 +219,46 @@ class UserService:
                 extra={"original_error": str(e)},
             )
 
+    def login_or_register(
+        self,
+        email: str,
+        username: str,
+        avatar: Optional[str] = None,
+        ref_code: Optional[str] = None,
+        id: Optional[str] = None,
+    ) -> LoginRecord:
+        """
+        Get the user with this email, or register them, in one statement.
+
+        A new user gets their referral code and, when the wallet reservoir has
+        one, a wallet in the same statement. Nothing is committed.
+
+        Returns:
+            LoginRecord: The user, their wallet public key and referral. The
+                wallet or referral is None when it could not be created here.
+        """
+        params = _login_params(email, username, avatar, ref_code, id)
+        # A concurrent first login of the same email makes the insert a no-op
+        # that returns nothing, the second attempt sees the committed user
+        for _ in range(2):
+            row = self._login_or_register(params)
+            if row is not None:
+                return LoginRecord(*row)
+        raise _registration_failed()
+
+    def _login_or_register(self, params: dict):
+        if params["wallet_key"]:
+            # A savepoint, so a missing reservoir table or pgcrypto, or a bad
+            # key, leaves the transaction usable for the login without it
+            try:
+                with self.db.begin_nested():
+                    return self.db.execute(
+                        LOGIN_OR_REGISTER_CLAIMING, params
+                    ).fetchone()
+            except DBAPIError as e:
+                _claim_failed(e)
+        return self.db.execute(LOGIN_OR_REGISTER, params).fetchone()
+
     def get_user_by_username(self, username: str) -> User:
         return self.db.query(User).filter(User.username == username).first()
 
@@ -67,3 +270,83 @@ class UserService:
 
     def get_user_by_username(self, username: str) -> User:
         return self.db.query(User).filter(User.username == username).first()
+
+
+class AsyncUserService:
+    """UserService on an AsyncSession, for the async endpoints."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def create_user(
+        self, user: UserRequestDTO, ref_code: str = None, id: str = None
+    ) -> User:
+        try:
+            referral = None
+            if ref_code:
+                referral = await self.db.scalar(
+                    select(Referral).where(Referral.referral_code == ref_code).limit(1)
+                )
+            id = generate_uuid() if id is None else id
+            user_data = user.model_dump()
+            user_data["id"] = id
+            user_data["used_ref_code"] = ref_code if referral else None
+            user_data.pop("ref_code", None)
+
+            user_model = User(**user_data)
+
+            self.db.add(user_model)
+            # Count the use of the referral, the user row must exist first
+            if referral:
+                await self.db.flush()
+                await AsyncReferralService(self.db).record_use(referral.id, id)
+
+            return user_model
+        except IntegrityError as e:
+            await self.db.rollback()
+            raise e
+        except Exception as e:
+            await self.db.rollback()
+            raise AppException(
+                error_code=ErrorCode.INTERNAL_ERROR,
+                message=str(e),
+                status_code=500,
+                extra={"original_error": str(e)},
+            )
+
+    async def login_or_register(
+        self,
+        email: str,
+        username: str,
+        avatar: Optional[str] = None,
+        ref_code: Optional[str] = None,
+        id: Optional[str] = None,
+    ) -> LoginRecord:
+        """See `UserService.login_or_register`."""
+        params = _login_params(email, username, avatar, ref_code, id)
+        for _ in range(2):
+            row = await self._login_or_register(params)
+            if row is not None:
+                return LoginRecord(*row)
+        raise _registration_failed()
+
+    async def _login_or_register(self, params: dict):
+        if params["wallet_key"]:
+            try:
+                async with self.db.begin_nested():
+                    result = await self.db.execute(LOGIN_OR_REGISTER_CLAIMING, params)
+                    return result.fetchone()
+            except DBAPIError as e:
+                _claim_failed(e)
+        return (await self.db.execute(LOGIN_OR_REGISTER, params)).fetchone()
+
+    async def get_user_by_email(self, email: str) -> Optional[User]:
+        return await self.db.scalar(select(User).where(User.email == email).limit(1))
+
+    async def get_user_by_id(self, id: str) -> Optional[User]:
+        return await self.db.scalar(select(User).where(User.id == id).limit(1))
+
+    async def get_user_by_username(self, username: str) -> Optional[User]:
+        return await self.db.scalar(
+            select(User).where(User.username == username).limit(1)
+        )
@@ -1,10 +1,233 @@
+import threading
+from typing import NamedTuple, Optional
 from config import settings
-import requests
+from app.database.pool import pool
+from app.database.replicas import async_read_session, read_session, replica_router
+from app.utils.cache import TTLCache
+from app.utils.requests import (
+    async_retry_request,
+    get_async_client,
+    get_session,
+    retry_request,
+)
 from app.dto import WalletRequestDTO, WalletResponseDTO
 from app.models.wallet import Wallet
+from log import logger
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 
+class WalletKeys(NamedTuple):
+    public_key: str
+    private_key: str
+
+
+class WalletScope:
+    """Wallets already looked up while serving one request, misses included."""
+
+    __slots__ = ("wallets",)
+
+    def __init__(self):
+        self.wallets: dict[str, Optional[WalletKeys]] = {}
+
+    def __repr__(self) -> str:
+        return f"<WalletScope users={len(self.wallets)}>"
+
+
+class WalletCache:
+    """
+    Wallet keys by user_id, cached for a few seconds in the process and for the
+    whole request in a `WalletScope`.
+
+    Only found wallets are cached process-wide, so a wallet created by another
+    process is visible on the next lookup.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _load(self, user_id: str) -> Optional[WalletKeys]:
+        with replica_router.read_pool(user_id).connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT public_key, private_key FROM wallets WHERE user_id = %s LIMIT 1",
+                (user_id,),
+            )
+            row = cursor.fetchone()
+        return WalletKeys(*row) if row else None
+
+    def get(
+        self, user_id: str, scope: Optional[WalletScope] = None
+    ) -> Optional[WalletKeys]:
+        if scope is not None and user_id in scope.wallets:
+            return scope.wallets[user_id]
+        wallet = self.local.get(user_id)
+        if wallet is None:
+            wallet = self._load(user_id)
+            if wallet is not None:
+                self.local.set(user_id, wallet)
+        if scope is not None:
+            scope.wallets[user_id] = wallet
+        return wallet
+
+    def invalidate(self, user_id: str) -> None:
+        self.local.delete(user_id)
+
+
+wallet_cache = WalletCache(
+    maxsize=settings.WALLET_CACHE_MAX_SIZE, ttl=settings.WALLET_CACHE_TTL
+)
+
+
+class ReservoirMetrics:
+    """How often signups found a spare wallet, and how the reservoir was refilled."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.claimed = 0
+        # Wallets generated during a signup because none was spare
+        self.fallbacks = 0
+        self.generated = 0
+        self.generate_failures = 0
+        self.depth: Optional[int] = None
+
+    def observe_claim(self, claimed: bool) -> None:
+        with self._lock:
+            if claimed:
+                self.claimed += 1
+            else:
+                self.fallbacks += 1
+
+    def observe_refill(self, generated: int, failures: int) -> None:
+        with self._lock:
+            self.generated += generated
+            self.generate_failures += failures
+
+    def observe_depth(self, depth: int) -> None:
+        with self._lock:
+            self.depth = depth
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            claims = self.claimed + self.fallbacks
+            return {
+                "depth": self.depth,
+                "claimed": self.claimed,
+                "fallbacks": self.fallbacks,
+                "hit_rate": round(self.claimed / claims, 4) if claims else None,
+                "generated": self.generated,
+                "generate_failures": self.generate_failures,
+            }
+
+
+# Takes the oldest spare wallet no other transaction holds
+CLAIM_SPARE_WALLET = text(
+    """
+    DELETE FROM spare_wallets
+    WHERE id = (
+        SELECT id FROM spare_wallets
+        ORDER BY created_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING public_key, pgp_sym_decrypt(private_key, :key) AS private_key
+    """
+)
+
+
+class WalletReservoir:
+    """
+    Wallets generated ahead of signups, in the `spare_wallets` table.
+
+    A signup takes the oldest spare wallet inside its own transaction, skipping
+    the ones other signups hold, so a rolled back signup leaves it for the next
+    one. Private keys are encrypted with pgcrypto under WALLET_RESERVOIR_KEY
+    and only decrypted by the claim. The reservoir is refilled by
+    app.workers.wallets.
+    """
+
+    def __init__(self, key: Optional[str]):
+        self.key = key
+        self.metrics = ReservoirMetrics()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.key)
+
+    def claim(self, db: Session) -> Optional[dict]:
+        """
+        Take a spare wallet in the transaction of `db`.
+
+        Returns:
+            Optional[dict]: `public_key` and `private_key`, or None when the
+                reservoir is empty or disabled.
+        """
+        if not self.enabled:
+            return None
+        try:
+            # A savepoint, so a missing table or a bad key leaves the signup
+            # transaction usable for the fallback
+            with db.begin_nested():
+                row = db.execute(CLAIM_SPARE_WALLET, {"key": self.key}).fetchone()
+        except Exception as e:
+            logger.error(f"Could not claim a spare wallet: {e}")
+            row = None
+        return self._claimed(row)
+
+    async def aclaim(self, db: AsyncSession) -> Optional[dict]:
+        """Async variant of `claim`."""
+        if not self.enabled:
+            return None
+        try:
+            async with db.begin_nested():
+                result = await db.execute(CLAIM_SPARE_WALLET, {"key": self.key})
+                row = result.fetchone()
+        except Exception as e:
+            logger.error(f"Could not claim a spare wallet: {e}")
+            row = None
+        return self._claimed(row)
+
+    def _claimed(self, row) -> Optional[dict]:
+        self.metrics.observe_claim(row is not None)
+        if row is None:
+            return None
+        return {"public_key": row.public_key, "private_key": row.private_key}
+
+    def depth(self) -> int:
+        with pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT count(*) FROM spare_wallets")
+            depth = cursor.fetchone()[0]
+        self.metrics.observe_depth(depth)
+        return depth
+
+    def add(self, wallets: list[dict]) -> None:
+        with pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO spare_wallets (id, public_key, private_key)
+                VALUES (gen_random_uuid()::text, %s, pgp_sym_encrypt(%s, %s))
+                """,
+                [
+                    (wallet["public_key"], wallet["private_key"], self.key)
+                    for wallet in wallets
+                ],
+            )
+
+
+wallet_reservoir = WalletReservoir(settings.WALLET_RESERVOIR_KEY)
+
+
+def _wallet_keys(data: dict) -> dict:
+    data = data["data"]
+    return {
+        "private_key": data["privateKey"],
+        "public_key": data["address"],
+    }
+
+
 class WalletService:
     def __init__(self, db: Session):
         self.db = db
@@ -15,22 +238,71 @@ class WalletService:
         """
         Generate a new wallet in Solana
         """
-        response = requests.post(f"{self.base_url}/createAccount", headers=self.headers)
-        data = response.json()
-        data = data["data"]
-        data = {
-            "private_key": data["privateKey"],
-            "public_key": data["address"],
-        }
-        return data
+
+        def _create_account() -> dict:
+            response = get_session(self.base_url).post(
+                f"{self.base_url}/createAccount", headers=self.headers
+            )
+            response.raise_for_status()
+            return response.json()
+
+        # Creating an account only generates a keypair, safe to repeat
+        return _wallet_keys(retry_request(_create_account)())
 
     def create_wallet(self, user_id: str) -> Wallet:
-        created_wallet = self.generate_wallet()
+        # Generating a wallet calls the onchain service, only done when no
+        # spare one is left
+        created_wallet = wallet_reservoir.claim(self.db) or self.generate_wallet()
         wallet_model = Wallet(**created_wallet, user_id=user_id)
         self.db.add(wallet_model)
+        wallet_cache.invalidate(user_id)
+        replica_router.pin(user_id)
         # self.db.commit()
         return wallet_model
 
     def get_wallet_by_user_id(self, user_id: str) -> Wallet:
-        wallet = self.db.query(Wallet).filter(Wallet.user_id == user_id).first()
+        with read_session(user_id) as db:
+            wallet = db.query(Wallet).filter(Wallet.user_id == user_id).first()
         return wallet if wallet else None
+
+
+class AsyncWalletService:
+    """WalletService on an AsyncSession, for the async endpoints."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.base_url = settings.SERVICE_ONCHAIN_BASE_URL
+        self.headers = {"Content-Type": "application/json"}
+
+    async def generate_wallet(self) -> dict:
+        """
+        Generate a new wallet in Solana
+        """
+
+        async def _create_account() -> dict:
+            response = await get_async_client(self.base_url).post(
+                f"{self.base_url}/createAccount", headers=self.headers
+            )
+            response.raise_for_status()
+            return response.json()
+
+        # Creating an account only generates a keypair, safe to repeat
+        return _wallet_keys(await async_retry_request(_create_account)())
+
+    async def create_wallet(self, user_id: str) -> Wallet:
+        # Generating a wallet calls the onchain service, only done when no
+        # spare one is left
+        created_wallet = (
+            await wallet_reservoir.aclaim(self.db) or await self.generate_wallet()
+        )
+        wallet_model = Wallet(**created_wallet, user_id=user_id)
+        self.db.add(wallet_model)
+        wallet_cache.invalidate(user_id)
+        await replica_router.apin(user_id)
+        return wallet_model
+
+    async def get_wallet_by_user_id(self, user_id: str) -> Optional[Wallet]:
+        async with async_read_session(user_id) as db:
+            return await db.scalar(
+                select(Wallet).where(Wallet.user_id == user_id).limit(1)
+            )
@@ -0,0 +1,216 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+from app.middleware.redis import get_async_redis_client, get_redis_client
+from log import logger
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after a TTL."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result: Any = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._calls: dict[Hashable, "SingleFlight._Call"] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class ReadThroughCache:
+    """
+    Two-layer read-through cache for string values: an in-process TTL LRU in
+    front of an optional shared Redis layer.
+
+    Concurrent misses for the same key share one load, and hits and misses are
+    counted per endpoint.
+    """
+
+    def __init__(self, namespace: str, maxsize: int = 1024, use_redis: bool = True):
+        self.namespace = namespace
+        self.local = TTLCache(maxsize=maxsize)
+        self.use_redis = use_redis
+        self._redis = None
+        self._single_flight = SingleFlight()
+        self._stats: dict[str, dict[str, int]] = defaultdict(
+            lambda: {"local_hits": 0, "redis_hits": 0, "misses": 0, "bypasses": 0}
+        )
+        self._stats_lock = threading.Lock()
+
+    def _count(self, endpoint: str, counter: str) -> None:
+        with self._stats_lock:
+            self._stats[endpoint][counter] += 1
+
+    def _redis_client(self):
+        if self._redis is None:
+            self._redis = get_redis_client()
+        return self._redis
+
+    def _redis_get(self, key: str) -> Optional[str]:
+        if not self.use_redis:
+            return None
+        try:
+            value = self._redis_client().get(key)
+        except Exception as e:
+            logger.warning(f"[CACHE] Redis read failed for {key}: {e}")
+            return None
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _redis_set(self, key: str, value: str, ttl: float) -> None:
+        if not self.use_redis:
+            return
+        try:
+            self._redis_client().set(key, value, ex=max(1, int(ttl)))
+        except Exception as e:
+            logger.warning(f"[CACHE] Redis write failed for {key}: {e}")
+
+    def get_or_load(
+        self,
+        endpoint: str,
+        key: str,
+        loader: Callable[[], str],
+        ttl: float,
+        bypass: bool = False,
+    ) -> str:
+        """
+        Get a value from the cache or load and store it.
+
+        Args:
+            endpoint (str): Name the hit and miss counters are grouped under.
+            key (str): Cache key, unique within the endpoint.
+            loader (Callable[[], str]): Loads the value on a miss. Errors are not cached.
+            ttl (float): Seconds the loaded value stays fresh.
+            bypass (bool): Skip both layers and load a fresh value, which then
+                replaces the cached one.
+
+        Returns:
+            str: The cached or freshly loaded value.
+        """
+        cache_key = f"{self.namespace}:{endpoint}:{key}"
+        if bypass:
+            self._count(endpoint, "bypasses")
+        else:
+            value = self.local.get(cache_key, _MISSING)
+            if value is not _MISSING:
+                self._count(endpoint, "local_hits")
+                return value
+
+        def load() -> str:
+            if not bypass:
+                value = self._redis_get(cache_key)
+                if value is not None:
+                    self._count(endpoint, "redis_hits")
+                    self.local.set(cache_key, value, ttl)
+                    return value
+                self._count(endpoint, "misses")
+            value = loader()
+            self.local.set(cache_key, value, ttl)
+            self._redis_set(cache_key, value, ttl)
+            return value
+
+        if bypass:
+            return load()
+        return self._single_flight.do(cache_key, load)
+
+    def peek(self, endpoint: str, key: str) -> Optional[str]:
+        """Get a value from the local layer only, without blocking on Redis or the loader."""
+        value = self.local.get(f"{self.namespace}:{endpoint}:{key}")
+        if value is not None:
+            self._count(endpoint, "local_hits")
+        return value
+
+    def invalidate(self, endpoint: str, key: str) -> None:
+        cache_key = f"{self.namespace}:{endpoint}:{key}"
+        self.local.delete(cache_key)
+        if self.use_redis:
+            try:
+                self._redis_client().delete(cache_key)
+            except Exception as e:
+                logger.warning(f"[CACHE] Redis delete failed for {cache_key}: {e}")
+
+    def invalidate_local(self, endpoint: str, key: str) -> None:
+        """Drop a value from the local layer only, see `ainvalidate` for Redis."""
+        self.local.delete(f"{self.namespace}:{endpoint}:{key}")
+
+    async def ainvalidate(self, endpoint: str, key: str) -> None:
+        """Async variant of `invalidate`, for the event loop."""
+        cache_key = f"{self.namespace}:{endpoint}:{key}"
+        self.local.delete(cache_key)
+        if self.use_redis:
+            try:
+                await get_async_redis_client().delete(cache_key)
+            except Exception as e:
+                logger.warning(f"[CACHE] Redis delete failed for {cache_key}: {e}")
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        with self._stats_lock:
+            return {endpoint: dict(counters) for endpoint, counters in self._stats.items()}
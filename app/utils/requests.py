@@ -1,31 +1,245 @@
+import asyncio
+import random
+import threading
 import time
+from contextvars import ContextVar
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from phi.utils.log import logger
 
+from config import settings
+
+# Statuses worth another attempt, anything else is returned to the caller
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+# Statuses that guarantee the upstream did not act on the request
+REJECTED_STATUS_CODES = frozenset({429, 503})
+
+# Monotonic time at which the current retry_request call runs out of budget
+_deadline: ContextVar[Optional[float]] = ContextVar("http_deadline", default=None)
+
+_lock = threading.Lock()
+_sessions: dict[str, "PooledSession"] = {}
+_async_clients: dict[str, "PooledAsyncClient"] = {}
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The retry budget ran out before a request could be sent."""
+
+
+def _request_timeout(timeout: Optional[float]) -> Optional[float]:
+    """Shrink a request timeout to what is left of the current deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline exceeded before sending the request")
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class PooledSession(requests.Session):
+    """A `requests.Session` with a sized keep-alive pool and a default timeout."""
+
+    def __init__(self, timeout: float, pool_maxsize: int):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs["timeout"] = _request_timeout(kwargs.get("timeout") or self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+class PooledAsyncClient(httpx.AsyncClient):
+    """An `httpx.AsyncClient` whose requests respect the current deadline."""
+
+    async def request(self, method, url, **kwargs):
+        timeout = _request_timeout(settings.HTTP_TIMEOUT)
+        kwargs.setdefault("timeout", timeout)
+        return await super().request(method, url, **kwargs)
+
+
+def get_session(base_url: str) -> PooledSession:
+    """
+    Get the process-wide session for a base URL.
+
+    Sessions keep their connections alive between calls, so every caller of
+    the same upstream shares one connection pool.
+    """
+    session = _sessions.get(base_url)
+    if session is None:
+        with _lock:
+            session = _sessions.get(base_url)
+            if session is None:
+                session = _sessions[base_url] = PooledSession(
+                    timeout=settings.HTTP_TIMEOUT,
+                    pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+                )
+    return session
+
+
+def get_async_client(base_url: str) -> PooledAsyncClient:
+    """Get the process-wide async client for a base URL."""
+    client = _async_clients.get(base_url)
+    if client is None:
+        with _lock:
+            client = _async_clients.get(base_url)
+            if client is None:
+                client = _async_clients[base_url] = PooledAsyncClient(
+                    timeout=settings.HTTP_TIMEOUT,
+                    limits=httpx.Limits(
+                        max_connections=settings.HTTP_POOL_MAXSIZE,
+                        max_keepalive_connections=settings.HTTP_POOL_MAXSIZE,
+                    ),
+                )
+    return client
 
-def retry_request(func, retries=3, delay=5):
+
+async def close_clients():
+    """Close every pooled session and async client."""
+    with _lock:
+        sessions = list(_sessions.values())
+        async_clients = list(_async_clients.values())
+        _sessions.clear()
+        _async_clients.clear()
+    for session in sessions:
+        session.close()
+    for client in async_clients:
+        await client.aclose()
+
+
+def _status_code(exc: Exception) -> Optional[int]:
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _never_sent(exc: Exception) -> bool:
+    if isinstance(exc, (requests.exceptions.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def is_retryable(exc: Exception, idempotent: bool = True) -> bool:
+    """
+    Tell whether a failed request may be sent again.
+
+    Non-idempotent requests are only retried when the upstream cannot have
+    acted on them: the connection was never established or the request was
+    rejected with 429/503.
+    """
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    if isinstance(exc, (requests.HTTPError, httpx.HTTPStatusError)):
+        retryable = RETRYABLE_STATUS_CODES if idempotent else REJECTED_STATUS_CODES
+        return _status_code(exc) in retryable
+    if not idempotent:
+        return _never_sent(exc)
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, httpx.TransportError))
+
+
+def _backoff(attempt: int, delay: float, max_delay: float, exc: Exception) -> float:
+    """Full-jitter exponential backoff, or the upstream's Retry-After if it sent one."""
+    response = getattr(exc, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), max_delay)
+    return random.uniform(0, min(max_delay, delay * 2**attempt))
+
+
+def _start_deadline(deadline: Optional[float]):
+    current = _deadline.get()
+    new = time.monotonic() + deadline if deadline else None
+    if current is not None and (new is None or current < new):
+        new = current
+    return _deadline.set(new)
+
+
+def retry_request(
+    func,
+    retries=settings.HTTP_RETRIES,
+    delay=settings.HTTP_RETRY_BACKOFF,
+    max_delay=settings.HTTP_RETRY_MAX_BACKOFF,
+    deadline=settings.HTTP_RETRY_DEADLINE,
+    idempotent=True,
+):
     """
-    Retry a function call multiple times with delay between attempts.
+    Retry a function call multiple times with exponential backoff between attempts.
+
+    Only transport errors and retryable HTTP statuses are retried, other
+    exceptions are raised right away.
 
     Args:
         func: The function to retry
-        retries: Number of retry attempts
-        delay: Delay between retries in seconds
+        retries: Number of attempts
+        delay: Base delay of the backoff in seconds
+        max_delay: Upper bound of a single backoff in seconds
+        deadline: Overall budget in seconds for every attempt and backoff,
+            requests sent through pooled sessions time out when it runs out
+        idempotent: Whether the request may be repeated after the upstream
+            might have acted on it
 
     Returns:
         A wrapper function that implements the retry logic
     """
 
     def wrapper(*args, **kwargs):
-        last_exception = None
-        for i in range(retries):
-            try:
-                logger.debug(f"[RETRY] Attempt {i+1} of {retries}")
-                return func(*args, **kwargs)
-            except Exception as e:
-                last_exception = e
-                logger.error(f"[RETRY] Request failed: {e}")
-                if i < retries - 1:  # Don't sleep on the last iteration
-                    time.sleep(delay)
-        raise last_exception or Exception(f"Failed after {retries} retries")
+        token = _start_deadline(deadline)
+        try:
+            for i in range(retries):
+                try:
+                    logger.debug(f"[RETRY] Attempt {i+1} of {retries}")
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    logger.error(f"[RETRY] Request failed: {e}")
+                    if i == retries - 1 or not is_retryable(e, idempotent):
+                        raise
+                    sleep = _backoff(i, delay, max_delay, e)
+                    end = _deadline.get()
+                    if end is not None and time.monotonic() + sleep >= end:
+                        raise
+                    time.sleep(sleep)
+            raise Exception(f"Failed after {retries} retries")
+        finally:
+            _deadline.reset(token)
+
+    return wrapper
+
+
+def async_retry_request(
+    func,
+    retries=settings.HTTP_RETRIES,
+    delay=settings.HTTP_RETRY_BACKOFF,
+    max_delay=settings.HTTP_RETRY_MAX_BACKOFF,
+    deadline=settings.HTTP_RETRY_DEADLINE,
+    idempotent=True,
+):
+    """Async variant of `retry_request` for coroutine functions, backs off without blocking the event loop."""
+
+    async def wrapper(*args, **kwargs):
+        token = _start_deadline(deadline)
+        try:
+            for i in range(retries):
+                try:
+                    logger.debug(f"[RETRY] Attempt {i+1} of {retries}")
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    logger.error(f"[RETRY] Request failed: {e}")
+                    if i == retries - 1 or not is_retryable(e, idempotent):
+                        raise
+                    sleep = _backoff(i, delay, max_delay, e)
+                    end = _deadline.get()
+                    if end is not None and time.monotonic() + sleep >= end:
+                        raise
+                    await asyncio.sleep(sleep)
+            raise Exception(f"Failed after {retries} retries")
+        finally:
+            _deadline.reset(token)
 
     return wrapper
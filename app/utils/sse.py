@@ -0,0 +1,149 @@
+import asyncio
+import time
+from json.encoder import encode_basestring_ascii
+from typing import AsyncIterator, Optional, Tuple
+
+from config import settings
+
+# Marks the end of the source stream in the coalescing queue
+_DONE = object()
+
+
+def encode_event(event: str, value: str, event_id: Optional[str] = None) -> str:
+    """
+    Build an SSE frame whose data is `{"v": value}`.
+
+    Same output as `json.dumps({"v": value})` through the C string encoder,
+    without building a dict or going through the generic encoder.
+    """
+    frame = f'event: {event}\ndata: {{"v": {encode_basestring_ascii(value)}}}\n\n'
+    if event_id is not None:
+        return f"id: {event_id}\n{frame}"
+    return frame
+
+
+class _Failure:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class TokenCoalescer:
+    """
+    Turns a stream of model tokens into `token` SSE frames.
+
+    Tokens are buffered until `interval` seconds passed since the first one
+    of the frame or `max_chars` characters are pending, then sent together as
+    one frame. The full answer is kept as a list of parts and joined once.
+    An `interval` of 0 sends one frame per token.
+    """
+
+    def __init__(self, interval: float, max_chars: int):
+        self.interval = interval
+        self.max_chars = max_chars
+        self.parts: list[str] = []
+        # Index in `parts` of the first token not sent yet
+        self._pending_from = 0
+        self._pending_chars = 0
+        # True once the source was read to the end
+        self.completed = False
+
+    @classmethod
+    def configure(
+        cls, interval_ms: Optional[int] = None, max_chars: Optional[int] = None
+    ) -> "TokenCoalescer":
+        """Build a coalescer from client options, unset ones use the settings."""
+        if interval_ms is None:
+            interval_ms = settings.SSE_COALESCE_INTERVAL_MS
+        return cls(interval_ms / 1000, max_chars or settings.SSE_COALESCE_MAX_CHARS)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def add(self, token: str) -> bool:
+        """Buffer a token, return True when the frame should be sent now."""
+        self.parts.append(token)
+        self._pending_chars += len(token)
+        return self.interval <= 0 or self._pending_chars >= self.max_chars
+
+    def flush(self) -> str:
+        pending = "".join(self.parts[self._pending_from :])
+        self._pending_from = len(self.parts)
+        self._pending_chars = 0
+        return pending
+
+    @property
+    def has_pending(self) -> bool:
+        return self._pending_from < len(self.parts)
+
+    async def stream(self, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Yield coalesced `token` SSE frames for `tokens`, then the `end` frame."""
+        async for event, value in self.events(tokens):
+            yield encode_event(event, value)
+
+    async def events(
+        self, tokens: AsyncIterator[str]
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Yield `("token", text)` for each coalesced frame, then `("end", answer)`.
+
+        The source is read by its own task so a frame can be sent when its
+        interval runs out even while the next token is slow to come, e.g.
+        during a tool call. Closing this generator cancels that task without
+        waiting for it, a source blocked in a worker thread stops on its own.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def produce():
+            try:
+                async for token in tokens:
+                    queue.put_nowait(token)
+            except Exception as e:
+                queue.put_nowait(_Failure(e))
+            else:
+                self.completed = True
+                queue.put_nowait(_DONE)
+            finally:
+                aclose = getattr(tokens, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+        producer = asyncio.create_task(produce())
+        try:
+            deadline = None
+            while True:
+                if not queue.empty():
+                    item = queue.get_nowait()
+                elif deadline is None:
+                    item = await queue.get()
+                else:
+                    try:
+                        item = await asyncio.wait_for(
+                            queue.get(), max(deadline - time.monotonic(), 0)
+                        )
+                    except asyncio.TimeoutError:
+                        deadline = None
+                        yield "token", self.flush()
+                        continue
+
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                if not item:
+                    continue
+                if self.add(item) or (
+                    deadline is not None and time.monotonic() >= deadline
+                ):
+                    deadline = None
+                    yield "token", self.flush()
+                elif deadline is None:
+                    deadline = time.monotonic() + self.interval
+
+            if self.has_pending:
+                yield "token", self.flush()
+            yield "end", self.text
+        finally:
+            producer.cancel()
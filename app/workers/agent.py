@@ -0,0 +1,201 @@
+"""
+Worker pool running the agent turns queued by /agent/call.
+
+Each process runs up to AGENT_WORKER_CONCURRENCY runs at a time, apart from
+the API workers, and streams their events to Redis through `run_log`.
+
+    make worker
+"""
+
+import asyncio
+import json
+import signal
+import socket
+import time
+from typing import Optional
+from uuid import uuid4
+
+from agents.cancellation import RunCancelled, stream_metrics
+from app.controllers.agent import AgentController
+from app.database.pool import engine
+from app.middleware.auth import Principal
+from app.middleware.quota import acharge_llm_tokens
+from app.middleware.redis import get_async_redis_client, redis_manager
+from app.services.runs import run_log
+from app.utils.requests import close_clients
+from app.utils.sse import TokenCoalescer
+from config import settings
+from log import logger
+
+
+def _optional_int(value: bytes) -> Optional[int]:
+    return int(value) if value else None
+
+
+class AgentWorker:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.consumer = f"{socket.gethostname()}-{uuid4().hex[:8]}"
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks: set[asyncio.Task] = set()
+        # Entry ids of the jobs running here, renewed by keep_claimed
+        self.running: set[bytes] = set()
+        self.stopping = asyncio.Event()
+
+    async def watch_readers(self, run_id: str, controller: AgentController) -> None:
+        """Cancel the run once no reader followed it for the orphan timeout."""
+        while True:
+            await asyncio.sleep(1)
+            if not await run_log.has_reader(run_id):
+                logger.info(f"[WORKER] Run {run_id} has no reader left, cancelling")
+                controller.cancel()
+                return
+
+    async def execute(self, job: dict) -> None:
+        run_id = job["run_id"]
+        user = Principal(job["user_id"], None, None, job["tier"] or None)
+        controller = AgentController(job["user_id"], job["session_id"])
+        coalescer = TokenCoalescer.configure(
+            _optional_int(job["stream_interval_ms"]),
+            _optional_int(job["stream_max_chars"]),
+        )
+        await run_log.set_status(run_id, "running")
+        stream_metrics.observe_start()
+        watcher = asyncio.create_task(self.watch_readers(run_id, controller))
+        cancelled = False
+        try:
+            tokens = controller.stream_tokens(job["message"], json.loads(job["images"]))
+            async for event, value in coalescer.events(tokens):
+                await run_log.append(run_id, event, value)
+            await run_log.set_status(run_id, "done")
+        except RunCancelled:
+            cancelled = True
+            # The agent must be done with its memory and usage first
+            if await controller.wait_stopped(settings.AGENT_CANCEL_TIMEOUT):
+                await asyncio.to_thread(controller.save_cancelled_run, coalescer.text)
+            else:
+                logger.warning(f"[WORKER] Cancelled run {run_id} still busy, not saved")
+            await run_log.append(run_id, "cancelled", coalescer.text)
+            await run_log.set_status(run_id, "cancelled")
+        except Exception as e:
+            logger.error(f"[WORKER] Run {run_id} failed: {e}")
+            await run_log.append(run_id, "error", str(e))
+            await run_log.set_status(run_id, "failed")
+        finally:
+            watcher.cancel()
+            tokens_used = controller.llm_tokens_used()
+            stream_metrics.observe_end(cancelled, tokens_used)
+            await acharge_llm_tokens(
+                user, tokens_used, int(job.get("llm_tokens_reserved") or 0)
+            )
+
+    async def resume(self, entry_id: bytes, job: dict) -> bool:
+        """
+        Whether a job claimed from a stopped worker should run again.
+
+        Only runs that never started are retried, one that was interrupted may
+        have called tools that moved funds already.
+        """
+        status = await run_log.status(job["run_id"])
+        if status == "queued":
+            logger.info(f"[WORKER] Retrying run {job['run_id']} of a stopped worker")
+            return True
+        if status == "running":
+            logger.warning(f"[WORKER] Run {job['run_id']} was interrupted")
+            await run_log.dead_letter(entry_id, "interrupted")
+        # Otherwise it ended and only its acknowledgement was lost
+        return False
+
+    async def handle(self, entry_id: bytes, fields: dict, claimed: bool = False) -> None:
+        job = {key.decode(): value.decode() for key, value in fields.items()}
+        self.running.add(entry_id)
+        try:
+            if not claimed or await self.resume(entry_id, job):
+                await self.execute(job)
+        except Exception as e:
+            logger.error(f"[WORKER] Job {entry_id} failed: {e}")
+        finally:
+            self.running.discard(entry_id)
+            await get_async_redis_client().xack(
+                run_log.jobs_key, run_log.group, entry_id
+            )
+            self.slots.release()
+
+    async def keep_claimed(self) -> None:
+        """Renew the jobs running here, so other workers do not claim them."""
+        while True:
+            await asyncio.sleep(settings.AGENT_JOB_CLAIM_INTERVAL)
+            if self.running:
+                try:
+                    await run_log.keep_claimed(self.consumer, list(self.running))
+                except Exception as e:
+                    logger.error(f"[WORKER] Could not renew running jobs: {e}")
+
+    async def claim_stale(self, count: int) -> list:
+        try:
+            return await run_log.claim_stale(self.consumer, count)
+        except Exception as e:
+            logger.error(f"[WORKER] Could not claim stale jobs: {e}")
+            return []
+
+    async def run(self) -> None:
+        await run_log.ensure_group()
+        client = get_async_redis_client()
+        logger.info(
+            f"[WORKER] {self.consumer} running up to {self.concurrency} agent runs"
+        )
+        keeper = asyncio.create_task(self.keep_claimed())
+        next_claim = 0.0
+        while not self.stopping.is_set():
+            await self.slots.acquire()
+            # Take only as many jobs as there are free slots, the rest stay
+            # queued for the other workers
+            free = 1
+            while not self.slots.locked() and free < self.concurrency:
+                await self.slots.acquire()
+                free += 1
+            # Jobs of stopped workers first, then new ones
+            entries = []
+            claimed = False
+            if time.monotonic() >= next_claim:
+                next_claim = time.monotonic() + settings.AGENT_JOB_CLAIM_INTERVAL
+                entries = await self.claim_stale(free)
+                claimed = bool(entries)
+            if not entries:
+                reply = await client.xreadgroup(
+                    run_log.group,
+                    self.consumer,
+                    {run_log.jobs_key: ">"},
+                    count=free,
+                    block=1000,
+                )
+                entries = reply[0][1] if reply else []
+            for entry_id, fields in entries:
+                task = asyncio.create_task(self.handle(entry_id, fields, claimed))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            for _ in range(free - len(entries)):
+                self.slots.release()
+
+        if self.tasks:
+            logger.info(f"[WORKER] Waiting for {len(self.tasks)} runs to finish")
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        keeper.cancel()
+
+
+async def main() -> None:
+    await redis_manager.startup()
+    worker = AgentWorker(settings.AGENT_WORKER_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stopping.set)
+    try:
+        await worker.run()
+    finally:
+        await redis_manager.shutdown()
+        await close_clients()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
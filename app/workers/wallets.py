@@ -0,0 +1,101 @@
+"""
+Worker keeping the wallet reservoir filled for signups.
+
+Every WALLET_RESERVOIR_REFILL_INTERVAL seconds it checks the number of spare
+wallets, and once it is under WALLET_RESERVOIR_LOW_WATER generates wallets on
+the onchain service until there are WALLET_RESERVOIR_SIZE again. Any number of
+these workers can run, one refills at a time.
+
+    make wallet-worker
+"""
+
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from app.database.pool import engine
+from app.services.wallet import WalletService, wallet_reservoir
+from config import settings
+from log import logger
+
+# Key of the advisory lock held by the worker refilling
+REFILL_LOCK_KEY = 7_302_881
+
+
+class WalletRefiller:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.stopping = threading.Event()
+        # generate_wallet only calls the onchain service, it needs no session
+        self.wallet_service = WalletService(None)
+
+    def _generate(self, _) -> dict | None:
+        try:
+            return self.wallet_service.generate_wallet()
+        except Exception as e:
+            logger.error(f"[WALLETS] Could not generate a wallet: {e}")
+            return None
+
+    def refill(self, executor: ThreadPoolExecutor) -> int:
+        """Fill the reservoir back up when it is low, return the wallets added."""
+        depth = wallet_reservoir.depth()
+        if depth >= settings.WALLET_RESERVOIR_LOW_WATER:
+            return 0
+        missing = settings.WALLET_RESERVOIR_SIZE - depth
+        logger.info(f"[WALLETS] {depth} spare wallets left, generating {missing}")
+        added = 0
+        while added < missing and not self.stopping.is_set():
+            batch = min(self.concurrency, missing - added)
+            wallets = [w for w in executor.map(self._generate, range(batch)) if w]
+            wallet_reservoir.metrics.observe_refill(len(wallets), batch - len(wallets))
+            if not wallets:
+                # The onchain service is down, try again on the next round
+                break
+            wallet_reservoir.add(wallets)
+            added += len(wallets)
+        wallet_reservoir.depth()
+        return added
+
+    def run(self) -> None:
+        if not wallet_reservoir.enabled:
+            logger.error("[WALLETS] WALLET_RESERVOIR_KEY is not set, nothing to do")
+            return
+        logger.info(
+            f"[WALLETS] Keeping {settings.WALLET_RESERVOIR_SIZE} spare wallets, "
+            f"refilling under {settings.WALLET_RESERVOIR_LOW_WATER}"
+        )
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            while not self.stopping.is_set():
+                try:
+                    with engine.connect() as connection:
+                        locked = connection.execute(
+                            text("SELECT pg_try_advisory_lock(:key)"),
+                            {"key": REFILL_LOCK_KEY},
+                        ).scalar()
+                        if locked:
+                            try:
+                                self.refill(executor)
+                            finally:
+                                connection.execute(
+                                    text("SELECT pg_advisory_unlock(:key)"),
+                                    {"key": REFILL_LOCK_KEY},
+                                )
+                except Exception as e:
+                    logger.error(f"[WALLETS] Refill failed: {e}")
+                self.stopping.wait(settings.WALLET_RESERVOIR_REFILL_INTERVAL)
+
+
+def main() -> None:
+    refiller = WalletRefiller(settings.WALLET_RESERVOIR_REFILL_CONCURRENCY)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: refiller.stopping.set())
+    try:
+        refiller.run()
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
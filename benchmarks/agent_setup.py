@@ -0,0 +1,83 @@
+"""
+Benchmark per-request agent setup: the legacy path that rebuilt the model,
+toolkit and prompts on every call against the process-wide AgentFactory.
+
+Only construction and tool registration (`Agent.update_model`) are timed, no
+LLM or database calls are made.
+
+    make bench-agent-setup
+"""
+
+import statistics
+import time
+
+from phi.agent import Agent
+from phi.model.openai.like import OpenAILike
+
+from agents.factory import AgentFactory
+from config import settings
+from prompt_engineering.deepsynth import DeepSynthPromptEngineering
+from tools.image_analyzer import analyze_image
+from tools.onchain import OnchainTool
+from tools.search import search
+
+ITERATIONS = 200
+
+
+def legacy_setup(user_id: str, session_id: str) -> Agent:
+    agent = Agent(
+        name="DeepSynth",
+        model=OpenAILike(
+            id=settings.ATOMA_LLAMA_3_3_70B_INSTRUCT,
+            base_url=settings.ATOMA_BASE_URL,
+            api_key=settings.ATOMA_API_KEY,
+        ),
+        description=DeepSynthPromptEngineering().get_description(),
+        instructions=DeepSynthPromptEngineering().get_instructions(),
+        tools=[search, analyze_image, OnchainTool()],
+        markdown=True,
+        read_chat_history=True,
+        session_id=session_id,
+        num_history_responses=10,
+        add_chat_history_to_messages=True,
+        user_id=user_id,
+        add_datetime_to_instructions=True,
+        read_tool_call_history=True,
+        context={"user_id": user_id, "session_id": session_id},
+    )
+    agent.update_model()
+    # The legacy model built a new OpenAI client for every completion request
+    agent.model.get_client()
+    return agent
+
+
+def factory_setup(factory: AgentFactory, user_id: str, session_id: str) -> Agent:
+    agent = factory.create(user_id=user_id, session_id=session_id)
+    agent.update_model()
+    agent.model.get_client()
+    return agent
+
+
+def measure(name: str, setup) -> float:
+    timings = []
+    for i in range(ITERATIONS):
+        start = time.perf_counter()
+        setup(f"user-{i}", f"session-{i}")
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    p50 = statistics.median(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<10} p50={p50:8.3f}ms  p95={p95:8.3f}ms")
+    return p50
+
+
+if __name__ == "__main__":
+    factory = AgentFactory(storage=None)
+    # Warm up the factory so the one-time compilation is not counted per request
+    factory_setup(factory, "warmup", "warmup")
+
+    legacy = measure("legacy", legacy_setup)
+    pooled = measure(
+        "factory", lambda user_id, session_id: factory_setup(factory, user_id, session_id)
+    )
+    print(f"speedup    {legacy / pooled:.1f}x")
@@ -0,0 +1,138 @@
+"""
+Load benchmark for concurrent /agent/call streams in sync and async mode.
+
+A fake OpenAI-compatible upstream (in its own process) streams TOKENS chunks, one every
+TOKEN_DELAY seconds. The sync mode iterates `Agent.run(stream=True)` the way
+Starlette does for a sync StreamingResponse (one threadpool hop per chunk on
+the default 40-thread limiter); the async mode iterates `Agent.arun`.
+
+    make bench-agent-streams
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import time
+
+TOKENS = 30
+TOKEN_DELAY = 0.1
+CONCURRENCY = [40, 120, 240]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+PORT = free_port()
+os.environ["ATOMA_BASE_URL"] = f"http://127.0.0.1:{PORT}/v1"
+os.environ.setdefault("ATOMA_API_KEY", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+# phi builds a new TLS client per run to report telemetry, keep it out of the numbers
+os.environ.setdefault("PHI_TELEMETRY", "false")
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+
+from agents.factory import AgentFactory
+
+upstream = FastAPI()
+
+
+@upstream.post("/v1/chat/completions")
+async def chat_completions():
+    async def stream():
+        for i in range(TOKENS):
+            await asyncio.sleep(TOKEN_DELAY)
+            chunk = {
+                "id": "bench",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "bench",
+                "choices": [
+                    {"index": 0, "delta": {"content": f"t{i} "}, "finish_reason": None}
+                ],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def serve_upstream():
+    uvicorn.run(upstream, host="127.0.0.1", port=PORT, log_level="error", backlog=4096)
+
+
+def start_upstream() -> multiprocessing.Process:
+    process = multiprocessing.Process(target=serve_upstream, daemon=True)
+    process.start()
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", PORT)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+
+
+async def sync_stream(factory: AgentFactory, i: int) -> float:
+    start = time.perf_counter()
+    first_token = None
+    agent = factory.create(user_id=f"user-{i}", session_id=f"session-{i}")
+    async for _ in iterate_in_threadpool(agent.run("hello", stream=True)):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+    return first_token
+
+
+async def async_stream(factory: AgentFactory, i: int) -> float:
+    start = time.perf_counter()
+    first_token = None
+    agent = factory.create(
+        user_id=f"user-{i}", session_id=f"session-{i}", asynchronous=True
+    )
+    async for _ in await agent.arun("hello", stream=True):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+    return first_token
+
+
+async def run(mode: str, stream, factory: AgentFactory, concurrency: int):
+    start = time.perf_counter()
+    ttfts = sorted(
+        await asyncio.gather(*(stream(factory, i) for i in range(concurrency)))
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"{mode:<6} streams={concurrency:<5} wall={elapsed:7.2f}s "
+        f"streams/s={concurrency / elapsed:8.1f} "
+        f"ttft_p50={statistics.median(ttfts):6.2f}s "
+        f"ttft_p95={ttfts[int(len(ttfts) * 0.95) - 1]:6.2f}s"
+    )
+
+
+async def main():
+    factory = AgentFactory(storage=None)
+    # Compile the tools once up front, like the first request of a worker
+    factory.functions
+    ideal = TOKENS * TOKEN_DELAY
+    print(f"one stream takes ~{ideal:.2f}s upstream")
+    for concurrency in CONCURRENCY:
+        await run("sync", sync_stream, factory, concurrency)
+        await run("async", async_stream, factory, concurrency)
+
+
+if __name__ == "__main__":
+    # Per-request INFO logging would dominate the measurement
+    logging.disable(logging.WARNING)
+    upstream_process = start_upstream()
+    try:
+        asyncio.run(main())
+    finally:
+        upstream_process.terminate()
@@ -0,0 +1,225 @@
+"""
+Benchmark the throughput of the auth and history endpoints on the sync
+SQLAlchemy sessions they used before against the async sessions they use now.
+
+The legacy endpoints are rebuilt here as they were: `def` routes on a sync
+`Session`, run by FastAPI in its threadpool, and `/auth/login/x`, an
+`async def` route querying the sync session inline. The async side mounts the
+app's own routers. Both are driven in-process over ASGI by CONCURRENCY
+clients, and a ticker measures how late the event loop wakes up, which is the
+time requests spent blocking it.
+
+A throwaway user with a wallet, a referral and an agent session of RUNS runs
+is written to the database configured in POSTGRES_URL and removed afterwards.
+
+    make bench-async-db
+"""
+
+import asyncio
+import json
+import logging
+import statistics
+import time
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from agents.base import session_history, storage
+from app.database.client import Session as SyncSession, get_db
+from app.database.pool import async_engine, engine
+from app.dto import AgentHistoryPageRequest, LoginXRequest, SocialCallbackRequest
+from app.middleware.auth import Principal, verify_token
+from app.models import Referral, User, Wallet
+from app.routes.agent import router as agent_router
+from app.routes.auth import router as auth_router
+from app.services.user import UserService
+from app.utils.functions import (
+    create_jwt_token,
+    generate_referral_code,
+    generate_uuid,
+    verify_jwt_token,
+)
+
+CONCURRENCY = 64
+REQUESTS = 2000
+RUNS = 20
+TICK = 0.005
+
+
+def legacy_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/api/auth/callback/social")
+    def callback_social(body: SocialCallbackRequest, db: Session = Depends(get_db)):
+        login = UserService(db).login_or_register(
+            body.email, body.username, body.avatar, body.ref_code
+        )
+        db.commit()
+        return {
+            "access_token": create_jwt_token({"sub": login.id}),
+            "wallet": {"public_key": login.public_key},
+            "referral": {"code": login.referral_code, "total_used": login.total_used},
+        }
+
+    @app.post("/api/auth/login/x")
+    async def login_x(request: LoginXRequest, db: Session = Depends(get_db)):
+        claims = verify_jwt_token(request.token)
+        login = UserService(db).login_or_register(
+            claims["username"], claims["username"], id=claims["sub"]
+        )
+        db.commit()
+        return {
+            "token": create_jwt_token({"sub": login.id}),
+            "wallet": {"public_key": login.public_key},
+        }
+
+    @app.post("/api/agent/history/page")
+    def agent_history_page(
+        body: AgentHistoryPageRequest, user: Principal = Depends(verify_token)
+    ):
+        return session_history.get_runs(
+            str(user.id), body.session_id, cursor=body.cursor, limit=body.limit
+        )
+
+    return app
+
+
+def async_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(auth_router, prefix="/api")
+    app.include_router(agent_router, prefix="/api")
+    return app
+
+
+class LoopLag:
+    """How late a ticker sleeping TICK seconds wakes up, while requests run."""
+
+    def __init__(self):
+        self.lags: list[float] = []
+        self.task = None
+
+    async def _tick(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            self.lags.append((time.perf_counter() - start - TICK) * 1000)
+
+    def __enter__(self):
+        self.task = asyncio.get_running_loop().create_task(self._tick())
+        return self
+
+    def __exit__(self, *args):
+        self.task.cancel()
+
+
+async def measure(app: FastAPI, path: str, body: dict) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    timings = []
+    remaining = REQUESTS
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                response = await client.post(path, json=body)
+                timings.append((time.perf_counter() - start) * 1000)
+                response.raise_for_status()
+
+        # Warm up the pools and prepared statements
+        await asyncio.gather(*(client.post(path, json=body) for _ in range(CONCURRENCY)))
+        with LoopLag() as lag:
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+            elapsed = time.perf_counter() - start
+    timings.sort()
+    return {
+        "rps": len(timings) / elapsed,
+        "p50": statistics.median(timings),
+        "p95": timings[int(len(timings) * 0.95)],
+        "lag_max": max(lag.lags, default=0.0),
+    }
+
+
+def report(endpoint: str, name: str, result: dict):
+    print(
+        f"{endpoint:<24} {name:<6} {result['rps']:8.1f} req/s "
+        f"p50={result['p50']:.2f}ms p95={result['p95']:.2f}ms "
+        f"loop lag max={result['lag_max']:.2f}ms"
+    )
+
+
+def seed(user_id: str, session_id: str):
+    with SyncSession() as db:
+        db.add(User(id=user_id, email=user_id, username=user_id))
+        db.flush()
+        db.add(Wallet(user_id=user_id, public_key=f"bench-{user_id}"))
+        db.add(Referral(owner_id=user_id, referral_code=generate_referral_code()))
+        db.execute(
+            text(
+                f"INSERT INTO {session_history.table} (session_id, user_id, created_at) "
+                "VALUES (:session_id, :user_id, 0)"
+            ),
+            {"session_id": session_id, "user_id": user_id},
+        )
+        for seq in range(1, RUNS + 1):
+            db.execute(
+                text(
+                    f"INSERT INTO {session_history.runs_table} "
+                    "(run_id, session_id, user_id, seq, message, response) "
+                    "VALUES (:run_id, :session_id, :user_id, :seq, :message, :response)"
+                ),
+                {
+                    "run_id": generate_uuid(),
+                    "session_id": session_id,
+                    "user_id": user_id,
+                    "seq": seq,
+                    "message": json.dumps({"role": "user", "content": f"question {seq}"}),
+                    "response": json.dumps({"content": f"answer {seq}" * 50}),
+                },
+            )
+        db.commit()
+
+
+def cleanup(user_id: str, session_id: str):
+    storage.delete_session(session_id)
+    with SyncSession() as db:
+        db.query(Referral).filter(Referral.owner_id == user_id).delete()
+        db.query(Wallet).filter(Wallet.user_id == user_id).delete()
+        db.query(User).filter(User.id == user_id).delete()
+        db.commit()
+
+
+async def main():
+    # Per-request INFO logging would dominate the measurement
+    logging.disable(logging.WARNING)
+    user_id = f"{generate_uuid()}@bench.local"
+    session_id = generate_uuid()
+    seed(user_id, session_id)
+    endpoints = {
+        "/api/auth/callback/social": {"email": user_id, "username": user_id},
+        "/api/auth/login/x": {
+            "token": create_jwt_token({"sub": user_id, "username": user_id})
+        },
+        "/api/agent/history/page": {"session_id": session_id, "limit": 10},
+    }
+    principal = Principal(user_id, user_id, user_id, "free")
+    apps = {"sync": legacy_app(), "async": async_app()}
+    for app in apps.values():
+        app.dependency_overrides[verify_token] = lambda: principal
+    try:
+        for path, body in endpoints.items():
+            for name, app in apps.items():
+                report(path, name, await measure(app, path, body))
+    finally:
+        cleanup(user_id, session_id)
+        engine.dispose()
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+"""
+Benchmark the authentication overhead per request: the legacy `verify_token`
+that decoded the JWT and loaded the full ORM `User` on every call against the
+cached claims and principal lookups.
+
+A throwaway user is written to the database configured in POSTGRES_URL and
+removed afterwards. Redis is not used so only the in-process layers are timed.
+
+    make bench-auth
+"""
+
+import asyncio
+import statistics
+import time
+
+import jwt
+from fastapi.security import HTTPAuthorizationCredentials
+
+from app.database.client import Session
+from app.middleware import auth
+from app.models import User
+from app.utils.functions import create_jwt_token, generate_uuid
+from config import settings
+
+ITERATIONS = 2000
+
+
+async def legacy_verify_token(credentials: HTTPAuthorizationCredentials) -> User:
+    db = Session()
+    try:
+        payload = jwt.decode(
+            credentials.credentials,
+            settings.JWT_SECRET_KEY,
+            algorithms=[settings.JWT_ALGORITHM],
+        )
+        return db.query(User).filter(User.id == payload["sub"]).first()
+    finally:
+        db.close()
+
+
+async def measure(verify, credentials) -> list[float]:
+    timings = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        await verify(credentials)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name: str, timings: list[float]):
+    timings = sorted(timings)
+    print(
+        f"{name:<8} p50={statistics.median(timings):.3f}ms "
+        f"p95={timings[int(len(timings) * 0.95)]:.3f}ms "
+        f"mean={statistics.mean(timings):.3f}ms"
+    )
+
+
+async def main():
+    auth.principal_cache.use_redis = False
+    user_id = generate_uuid()
+    with Session() as db:
+        db.add(User(id=user_id, email=f"{user_id}@bench.local", username=user_id))
+        db.commit()
+    try:
+        token = create_jwt_token({"sub": user_id})
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+        report("legacy", await measure(legacy_verify_token, credentials))
+        report("cached", await measure(auth.verify_token, credentials))
+        print(f"principal cache: {auth.principal_cache.stats()}")
+    finally:
+        with Session() as db:
+            db.query(User).filter(User.id == user_id).delete()
+            db.commit()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+"""
+Benchmark the data path of a returning user's social login: the legacy queries
+for the user by email, their wallet and their referral, against the single
+`UserService.login_or_register` statement.
+
+A throwaway user with a wallet and referral is written to the database
+configured in POSTGRES_URL and removed afterwards. Each login runs in its own
+session and commits, as the endpoint does. The network latency to Postgres
+multiplies the difference, run it against a remote database to see it.
+
+    make bench-login
+"""
+
+import statistics
+import time
+
+from sqlalchemy import event
+
+from app.database.client import Session
+from app.database.pool import engine
+from app.models import Referral, User, Wallet
+from app.services.referral import ReferralService
+from app.services.user import UserService
+from app.services.wallet import WalletService
+from app.utils.functions import generate_referral_code, generate_uuid
+
+ITERATIONS = 500
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.observe)
+
+    def observe(self, *args):
+        self.count += 1
+
+
+def legacy_login(email: str):
+    with Session() as db:
+        user = UserService(db).get_user_by_email(email)
+        wallet = WalletService(db).get_wallet_by_user_id(user.id)
+        referral = ReferralService(db).get_referral_by_user_id(user.id)
+        db.commit()
+        return user.id, wallet.public_key, referral.referral_code, referral.total_used
+
+
+def single_login(email: str):
+    with Session() as db:
+        login = UserService(db).login_or_register(email, email)
+        db.commit()
+        return login.id, login.public_key, login.referral_code, login.total_used
+
+
+def measure(login, email: str, counter: StatementCounter) -> tuple[list[float], float]:
+    timings = []
+    counter.count = 0
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        login(email)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings, counter.count / ITERATIONS
+
+
+def report(name: str, timings: list[float], statements: float):
+    timings = sorted(timings)
+    print(
+        f"{name:<8} p50={statistics.median(timings):.3f}ms "
+        f"p95={timings[int(len(timings) * 0.95)]:.3f}ms "
+        f"mean={statistics.mean(timings):.3f}ms "
+        f"statements={statements:.1f}"
+    )
+
+
+def main():
+    user_id = generate_uuid()
+    email = f"{user_id}@bench.local"
+    with Session() as db:
+        db.add(User(id=user_id, email=email, username=user_id))
+        db.flush()
+        db.add(Wallet(user_id=user_id, public_key=f"bench-{user_id}"))
+        db.add(Referral(owner_id=user_id, referral_code=generate_referral_code()))
+        db.commit()
+    try:
+        assert legacy_login(email) == single_login(email)
+        counter = StatementCounter()
+        report("legacy", *measure(legacy_login, email, counter))
+        report("single", *measure(single_login, email, counter))
+    finally:
+        with Session() as db:
+            db.query(Referral).filter(Referral.owner_id == user_id).delete()
+            db.query(Wallet).filter(Wallet.user_id == user_id).delete()
+            db.query(User).filter(User.id == user_id).delete()
+            db.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Benchmark the HTTP middleware stack: the legacy `@app.middleware("http")`
+CORS and rate-limit header handlers against the pure ASGI `APIMiddleware`.
+
+Requests are driven straight through the ASGI interface, so the numbers are
+the middleware overhead on top of a bare app: per plain request, per
+preflight and per SSE chunk of a streamed response.
+
+    make bench-middleware
+"""
+
+import asyncio
+import statistics
+import time
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+
+from app.middleware.asgi import APIMiddleware
+from app.middleware.decorator import RateLimitResult
+from config import settings
+
+REQUESTS = 2000
+STREAMS = 20
+CHUNKS = 2000
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping(request: Request):
+        request.state.rate_limit = RateLimitResult(True, 60, 59, 0)
+        return {"message": "OK"}
+
+    @app.get("/stream")
+    async def stream():
+        async def events():
+            for i in range(CHUNKS):
+                yield f"data: {i}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def legacy_app() -> FastAPI:
+    app = build_app()
+
+    @app.middleware("http")
+    async def cors_handler(request: Request, call_next):
+        if request.method == "OPTIONS":
+            response = Response(
+                status_code=204,
+                headers={
+                    "Access-Control-Allow-Credentials": "true",
+                    "Access-Control-Allow-Origin": settings.origins,
+                    "Access-Control-Allow-Methods": "*",
+                    "Access-Control-Allow-Headers": "*",
+                },
+            )
+        else:
+            response = await call_next(request)
+            response.headers["Access-Control-Allow-Credentials"] = "true"
+            response.headers["Access-Control-Allow-Origin"] = settings.origins
+            response.headers["Access-Control-Allow-Methods"] = "*"
+            response.headers["Access-Control-Allow-Headers"] = "*"
+        return response
+
+    @app.middleware("http")
+    async def rate_limit_headers(request: Request, call_next):
+        response = await call_next(request)
+        result = getattr(request.state, "rate_limit", None)
+        if result is not None:
+            response.headers.update(result.headers)
+        return response
+
+    return app
+
+
+def asgi_app() -> FastAPI:
+    app = build_app()
+    app.add_middleware(APIMiddleware)
+    return app
+
+
+async def call(app, method: str, path: str) -> int:
+    """Run one request through the app and return the number of body messages."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"bench"), (b"origin", b"http://bench")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("bench", 80),
+    }
+    chunks = 0
+    received = False
+    finished = asyncio.Event()
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client stays connected until the response is over
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal chunks
+        if message["type"] == "http.response.body":
+            chunks += 1
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+    finished.set()
+    return chunks
+
+
+async def per_request_us(app, method: str, path: str, count: int) -> float:
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        await call(app, method, path)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e6
+
+
+async def per_chunk_us(app) -> float:
+    samples = []
+    for _ in range(STREAMS):
+        start = time.perf_counter()
+        chunks = await call(app, "GET", "/stream")
+        samples.append((time.perf_counter() - start) / chunks)
+    return statistics.median(samples) * 1e6
+
+
+async def main():
+    apps = {"bare": build_app(), "legacy": legacy_app(), "asgi": asgi_app()}
+    # Warm up routing and the lazily built middleware stacks
+    for app in apps.values():
+        await call(app, "GET", "/ping")
+
+    results = {}
+    for name, app in apps.items():
+        results[name] = (
+            await per_request_us(app, "GET", "/ping", REQUESTS),
+            await per_request_us(app, "OPTIONS", "/ping", REQUESTS),
+            await per_chunk_us(app),
+        )
+
+    bare_request, _, bare_chunk = results["bare"]
+    print(f"{'stack':<8} {'request':>10} {'overhead':>10} {'preflight':>10} {'chunk':>9} {'overhead':>9}")
+    for name, (request, preflight, chunk) in results.items():
+        print(
+            f"{name:<8} {request:>8.1f}us {request - bare_request:>8.1f}us "
+            f"{preflight:>8.1f}us {chunk:>7.2f}us {chunk - bare_chunk:>7.2f}us"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
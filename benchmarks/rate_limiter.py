@@ -0,0 +1,77 @@
+"""
+Benchmark the Redis rate limiter: the legacy two-round-trip implementation
+that built a new client per check against the atomic sliding-window script on
+the shared client.
+
+Reports checks per second from concurrent threads and how many requests of a
+same-second burst each implementation admits. Needs a Redis at REDIS_URI.
+
+    make bench-rate-limiter
+"""
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from app.middleware.decorator import rate_limiter
+from app.middleware.redis import get_redis_client
+from config import settings
+
+THREADS = 16
+CHECKS = 4000
+LIMIT = 1_000_000
+WINDOW = 60
+BURST = 50
+BURST_LIMIT = 10
+
+
+def legacy_is_rate_limited(key: str, max_requests: int, window: int) -> bool:
+    current = int(time.time())
+    redis_conn = redis.Redis.from_url(settings.REDIS_URI)
+    with redis_conn.pipeline() as pipe:
+        pipe.zremrangebyscore(key, 0, current - window)
+        pipe.zcard(key)
+        if pipe.execute()[1] < max_requests:
+            pipe.zadd(key, {current: current})
+            pipe.expire(key, window)
+            pipe.execute()
+            return False
+        return True
+
+
+def scripted_is_rate_limited(key: str, max_requests: int, window: int) -> bool:
+    return rate_limiter.is_rate_limited(key, max_requests, window)
+
+
+def throughput(check) -> float:
+    key = f"bench:rate_limit:{uuid.uuid4().hex}"
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        list(executor.map(lambda _: check(key, LIMIT, WINDOW), range(CHECKS)))
+    elapsed = time.perf_counter() - start
+    get_redis_client().delete(key)
+    return CHECKS / elapsed
+
+
+def burst_admitted(check) -> int:
+    key = f"bench:rate_limit:{uuid.uuid4().hex}"
+    admitted = sum(not check(key, BURST_LIMIT, WINDOW) for _ in range(BURST))
+    get_redis_client().delete(key)
+    return admitted
+
+
+def main():
+    for name, check in [
+        ("legacy", legacy_is_rate_limited),
+        ("scripted", scripted_is_rate_limited),
+    ]:
+        print(
+            f"{name:<9} {throughput(check):>8.0f} checks/s, "
+            f"admitted {burst_admitted(check)}/{BURST} of a burst limited to {BURST_LIMIT}"
+        )
+
+
+if __name__ == "__main__":
+    main()
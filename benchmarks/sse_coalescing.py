@@ -0,0 +1,66 @@
+"""
+Benchmark the /agent/call SSE output stage: one `json.dumps` frame per token
+with `+=` aggregation against `TokenCoalescer`.
+
+A fake model streams TOKENS tokens, one every TOKEN_DELAY seconds. Reports the
+frames and bytes sent per answer, each becoming a write on the socket, and the
+CPU time the output stage spends on a long answer.
+
+    make bench-sse
+"""
+
+import asyncio
+import json
+import time
+
+from app.utils.sse import TokenCoalescer
+
+TOKENS = 1000
+TOKEN_DELAY = 0.001
+LONG_ANSWER = 50_000
+INTERVAL = 0.03
+MAX_CHARS = 256
+
+
+async def model(count: int, delay: float):
+    for i in range(count):
+        if delay:
+            await asyncio.sleep(delay)
+        yield f"tok{i % 10} "
+
+
+async def legacy(tokens):
+    aggregated_response = ""
+    async for token in tokens:
+        aggregated_response += token
+        yield f"event: token\ndata: {json.dumps({'v': token})}\n\n"
+    yield f"event: end\ndata: {json.dumps({'v': aggregated_response})}\n\n"
+
+
+def coalesced(tokens):
+    return TokenCoalescer(INTERVAL, MAX_CHARS).stream(tokens)
+
+
+async def frames(stage, count: int, delay: float) -> tuple[int, int, float]:
+    sent = size = 0
+    start = time.perf_counter()
+    async for frame in stage(model(count, delay)):
+        sent += 1
+        size += len(frame)
+    return sent, size, time.perf_counter() - start
+
+
+async def main():
+    print(f"{TOKENS} tokens, one every {TOKEN_DELAY * 1000:.0f}ms")
+    for name, stage in (("legacy", legacy), ("coalesced", coalesced)):
+        sent, size, elapsed = await frames(stage, TOKENS, TOKEN_DELAY)
+        print(f"  {name:<10} {sent:>6} frames {size:>8} bytes {elapsed:>6.2f}s")
+
+    print(f"{LONG_ANSWER} tokens, no delay")
+    for name, stage in (("legacy", legacy), ("coalesced", coalesced)):
+        sent, size, elapsed = await frames(stage, LONG_ANSWER, 0)
+        print(f"  {name:<10} {sent:>6} frames {elapsed * 1e6 / LONG_ANSWER:>6.2f}us/token")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,45 @@
+import json
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
+def _tier_setting(name: str, default: dict) -> dict:
+    """A JSON object of values by tier, tiers it leaves out keep their default."""
+    return {**default, **json.loads(os.getenv(name, "{}"))}
+
+
 class Settings:
     POSTGRES_URL = os.getenv("POSTGRES_URL")
+    # Pools per process, size them for the worker count
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+    # Pool of the async engine, on top of the sync one
+    DB_ASYNC_POOL_SIZE = int(os.getenv("DB_ASYNC_POOL_SIZE", 10))
+    DB_ASYNC_MAX_OVERFLOW = int(os.getenv("DB_ASYNC_MAX_OVERFLOW", 20))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # in seconds
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # in seconds
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    # Read replicas, comma separated, read-only queries are routed to them
+    POSTGRES_REPLICA_URLS = [
+        url.strip()
+        for url in os.getenv("POSTGRES_REPLICA_URLS", "").split(",")
+        if url.strip()
+    ]
+    # Replicas further behind the primary than this are not read from
+    DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 5))  # in seconds
+    DB_REPLICA_LAG_CHECK_INTERVAL = float(
+        os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", 1)
+    )  # in seconds
+    # A user's reads stay on the primary this long after their own writes,
+    # keep it above DB_REPLICA_MAX_LAG
+    DB_READ_YOUR_WRITES_WINDOW = float(
+        os.getenv("DB_READ_YOUR_WRITES_WINDOW", 10)
+    )  # in seconds
+    DB_READ_YOUR_WRITES_USE_REDIS = (
+        os.getenv("DB_READ_YOUR_WRITES_USE_REDIS", "true").lower() == "true"
+    )
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     BASE_URL = os.getenv("BASE_URL")
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -17,6 +51,9 @@ class Settings:
     def origins(self):
         return os.getenv("ALLOWED_ORIGINS", "*")
 
+    # Seconds browsers may reuse a CORS preflight response
+    CORS_PREFLIGHT_MAX_AGE = int(os.getenv("CORS_PREFLIGHT_MAX_AGE", 600))
+
     X_CLIENT_ID = os.getenv("X_CLIENT_ID")
     X_CLIENT_SECRET = os.getenv("X_CLIENT_SECRET")
     X_REDIRECT_URI = os.getenv("X_REDIRECT_URI")
@@ -24,13 +61,53 @@ class Settings:
     JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
     JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
     JWT_EXPIRATION = int(os.getenv("JWT_EXPIRATION", 86400))  # in seconds
+    # Decoded tokens are cached until they expire
+    AUTH_CLAIMS_CACHE_MAX_SIZE = int(os.getenv("AUTH_CLAIMS_CACHE_MAX_SIZE", 10000))
+    AUTH_USER_CACHE_MAX_SIZE = int(os.getenv("AUTH_USER_CACHE_MAX_SIZE", 10000))
+    AUTH_USER_CACHE_TTL = int(os.getenv("AUTH_USER_CACHE_TTL", 60))  # in seconds
+    AUTH_USER_CACHE_USE_REDIS = (
+        os.getenv("AUTH_USER_CACHE_USE_REDIS", "true").lower() == "true"
+    )
 
     ############################
     #     Redis Settings      #
     ############################
     REDIS_URI = os.getenv("REDIS_URI")
+    # Per pool, the sync and the async client each have one
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+    REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))  # in seconds
+    REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))  # in seconds
+    REDIS_SOCKET_CONNECT_TIMEOUT = float(
+        os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 2)
+    )  # in seconds
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
     RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", 60))
     RATE_LIMIT_MAX_REQUESTS = int(os.getenv("RATE_LIMIT_MAX_REQUESTS", 5))
+    # Requests per RATE_LIMIT_WINDOW for authenticated users, by tier
+    RATE_LIMIT_TIER_REQUESTS = _tier_setting(
+        "RATE_LIMIT_TIER_REQUESTS", {"free": 5, "pro": 60}
+    )
+    # LLM tokens per LLM_TOKEN_QUOTA_WINDOW for /agent/call, by tier
+    LLM_TOKEN_TIER_QUOTAS = _tier_setting(
+        "LLM_TOKEN_TIER_QUOTAS", {"free": 200000, "pro": 2000000}
+    )
+    LLM_TOKEN_QUOTA_WINDOW = int(os.getenv("LLM_TOKEN_QUOTA_WINDOW", 86400))
+    # LLM tokens held from the quota while a run is going, settled to its usage
+    LLM_TOKEN_RESERVATION = int(os.getenv("LLM_TOKEN_RESERVATION", 8000))
+    # Share of a quota a worker leases from Redis at once, and for how long
+    RATE_LIMIT_LEASE_FRACTION = float(os.getenv("RATE_LIMIT_LEASE_FRACTION", 0.1))
+    RATE_LIMIT_LEASE_TTL = float(os.getenv("RATE_LIMIT_LEASE_TTL", 5))  # in seconds
+    RATE_LIMIT_MAX_LEASES = int(os.getenv("RATE_LIMIT_MAX_LEASES", 100000))
+    # Agent runs executing at once in one API process
+    AGENT_MAX_CONCURRENT_RUNS = int(os.getenv("AGENT_MAX_CONCURRENT_RUNS", 32))
+    # Agent runs executing or queued at once per user, by tier
+    AGENT_TIER_MAX_CONCURRENT_RUNS = _tier_setting(
+        "AGENT_TIER_MAX_CONCURRENT_RUNS", {"free": 1, "pro": 3}
+    )
+    # Queue order by tier, lower goes first
+    AGENT_TIER_PRIORITY = _tier_setting("AGENT_TIER_PRIORITY", {"pro": 0, "free": 1})
+    AGENT_MAX_QUEUED_RUNS = int(os.getenv("AGENT_MAX_QUEUED_RUNS", 128))
+    AGENT_QUEUE_TIMEOUT = float(os.getenv("AGENT_QUEUE_TIMEOUT", 60))  # in seconds
 
     ############################
     #     File Settings       #
@@ -41,8 +118,42 @@ class Settings:
     #     Service Settings    #
     ############################
     SEARXNG_HOST = os.getenv("SEARXNG_HOST")
+    SEARCH_MAX_DOCUMENTS = int(os.getenv("SEARCH_MAX_DOCUMENTS", 4))
+    SEARCH_MAX_WORKERS = int(os.getenv("SEARCH_MAX_WORKERS", 8))
+    SEARCH_FETCH_TIMEOUT = float(os.getenv("SEARCH_FETCH_TIMEOUT", 5))  # in seconds
+    SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", 10))  # in seconds
     SERVICE_ONCHAIN_BASE_URL = os.getenv("SERVICE_ONCHAIN_BASE_URL")
     SUI_SCAN_BASE_URL = os.getenv("SUI_SCAN_BASE_URL", "https://suiscan.xyz/testnet")
+    # Outbound HTTP through app.utils.requests
+    HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 32))  # connections per base URL
+    HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))  # in seconds
+    HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+    HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", 0.5))  # in seconds
+    HTTP_RETRY_MAX_BACKOFF = float(os.getenv("HTTP_RETRY_MAX_BACKOFF", 4))  # in seconds
+    HTTP_RETRY_DEADLINE = float(os.getenv("HTTP_RETRY_DEADLINE", 20))  # in seconds
+    ONCHAIN_CACHE_MAX_SIZE = int(os.getenv("ONCHAIN_CACHE_MAX_SIZE", 2048))
+    ONCHAIN_CACHE_USE_REDIS = (
+        os.getenv("ONCHAIN_CACHE_USE_REDIS", "true").lower() == "true"
+    )
+    # TTLs in seconds
+    ONCHAIN_CACHE_TTL_TOKEN = int(os.getenv("ONCHAIN_CACHE_TTL_TOKEN", 3600))
+    ONCHAIN_CACHE_TTL_POOL = int(os.getenv("ONCHAIN_CACHE_TTL_POOL", 30))
+    ONCHAIN_CACHE_TTL_APR = int(os.getenv("ONCHAIN_CACHE_TTL_APR", 300))
+    WALLET_CACHE_MAX_SIZE = int(os.getenv("WALLET_CACHE_MAX_SIZE", 4096))
+    WALLET_CACHE_TTL = int(os.getenv("WALLET_CACHE_TTL", 60))  # in seconds
+    # Spare wallets generated ahead of signups by `make wallet-worker`, their
+    # private keys encrypted with this key. Without it signups create wallets
+    # on demand.
+    WALLET_RESERVOIR_KEY = os.getenv("WALLET_RESERVOIR_KEY")
+    WALLET_RESERVOIR_SIZE = int(os.getenv("WALLET_RESERVOIR_SIZE", 200))
+    # The worker refills the reservoir once fewer wallets than this are left
+    WALLET_RESERVOIR_LOW_WATER = int(os.getenv("WALLET_RESERVOIR_LOW_WATER", 50))
+    WALLET_RESERVOIR_REFILL_INTERVAL = float(
+        os.getenv("WALLET_RESERVOIR_REFILL_INTERVAL", 5)
+    )  # in seconds
+    WALLET_RESERVOIR_REFILL_CONCURRENCY = int(
+        os.getenv("WALLET_RESERVOIR_REFILL_CONCURRENCY", 4)
+    )
 
     #############################
     #     Prompt Engineering    #
@@ -62,6 +173,53 @@ class Settings:
         "ATOMA_LLAMA_3_3_70B_INSTRUCT", "meta-llama/Llama-3.3-70B-Instruct"
     )
     ATOMA_DEEPSEEK_R1 = os.getenv("ATOMA_DEEPSEEK_R1", "deepseek-ai/DeepSeek-R1")
+    LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 100))
+    LLM_ASYNC_HTTP_MAX_CONNECTIONS = int(
+        os.getenv("LLM_ASYNC_HTTP_MAX_CONNECTIONS", 1000)
+    )
+    LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+        os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+    )
+    LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", 600))  # in seconds
+    TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", 32))
+    TOOL_CALL_TIMEOUT = float(os.getenv("TOOL_CALL_TIMEOUT", 60))  # in seconds
+    # Seconds a tool call may wait for a free tool worker before giving up
+    TOOL_QUEUE_TIMEOUT = float(os.getenv("TOOL_QUEUE_TIMEOUT", 30))
+    # Runs of a session loaded into the agent's prompt
+    AGENT_HISTORY_RUNS = int(os.getenv("AGENT_HISTORY_RUNS", 10))
+    # Tokens of history sent with each turn, older runs go to the session summary
+    AGENT_HISTORY_TOKEN_BUDGET = int(os.getenv("AGENT_HISTORY_TOKEN_BUDGET", 6000))
+    # Tool outputs of past runs are cut to this many tokens
+    AGENT_HISTORY_TOOL_OUTPUT_TOKENS = int(
+        os.getenv("AGENT_HISTORY_TOOL_OUTPUT_TOKENS", 400)
+    )
+    # Runs folded into the session summary per turn at most, the oldest first
+    AGENT_SUMMARY_BATCH_RUNS = int(os.getenv("AGENT_SUMMARY_BATCH_RUNS", 5))
+    # Seconds a cancelled run is waited for to stop before its partial answer
+    # is saved, and before its admission slot is released anyway. A run still
+    # busy after that is not saved
+    AGENT_CANCEL_TIMEOUT = float(os.getenv("AGENT_CANCEL_TIMEOUT", 10))
+    # Serve /agent/call on the event loop instead of the threadpool
+    AGENT_ASYNC_MODE = os.getenv("AGENT_ASYNC_MODE", "true").lower() == "true"
+    # /agent/call sends the tokens of up to this many ms or chars in one frame
+    SSE_COALESCE_INTERVAL_MS = int(os.getenv("SSE_COALESCE_INTERVAL_MS", 30))
+    SSE_COALESCE_MAX_CHARS = int(os.getenv("SSE_COALESCE_MAX_CHARS", 256))
+    # Run /agent/call turns on the worker pool (make worker) instead of in the request
+    AGENT_DETACHED_RUNS = os.getenv("AGENT_DETACHED_RUNS", "false").lower() == "true"
+    AGENT_JOB_STREAM = os.getenv("AGENT_JOB_STREAM", "agent:jobs")
+    AGENT_WORKER_CONCURRENCY = int(os.getenv("AGENT_WORKER_CONCURRENCY", 16))
+    # Seconds the events of a run can be read back
+    AGENT_RUN_TTL = int(os.getenv("AGENT_RUN_TTL", 3600))
+    # Seconds a run keeps going without any reader before it is cancelled
+    AGENT_RUN_ORPHAN_TIMEOUT = int(os.getenv("AGENT_RUN_ORPHAN_TIMEOUT", 30))
+    # Seconds a reader waits for the next event before giving up on the run
+    AGENT_RUN_READ_TIMEOUT = int(os.getenv("AGENT_RUN_READ_TIMEOUT", 300))
+    # Seconds a job stays pending, not renewed by its worker, before another
+    # worker claims it. Workers renew their jobs every AGENT_JOB_CLAIM_INTERVAL.
+    AGENT_JOB_CLAIM_IDLE = int(os.getenv("AGENT_JOB_CLAIM_IDLE", 60))
+    AGENT_JOB_CLAIM_INTERVAL = int(os.getenv("AGENT_JOB_CLAIM_INTERVAL", 15))
+    # Jobs delivered this many times go to the dead-letter stream
+    AGENT_JOB_MAX_DELIVERIES = int(os.getenv("AGENT_JOB_MAX_DELIVERIES", 3))
 
     #############################
     #     AWS Settings          #
@@ -1,4 +1,2 @@
-from psycopg_pool import ConnectionPool
-from config import settings
-
-pool = ConnectionPool(settings.POSTGRES_URL)
+# Raw psycopg access goes through the shared engine pool
+from app.database.pool import pool
@@ -1,18 +1,29 @@
 import requests
 from config import settings
-from pool import pool
 import time
 import json
 from phi.agent import Agent
 from phi.tools import Toolkit
 from phi.utils.log import logger
-from app.utils.requests import retry_request
+from app.utils.requests import get_session, retry_request
+from app.utils.cache import ReadThroughCache
+from app.services.wallet import WalletScope, wallet_cache
 from log import logger
 import re
 
+# Near-static lookups shared by every agent in the process (and across
+# processes through Redis)
+onchain_cache = ReadThroughCache(
+    namespace="onchain",
+    maxsize=settings.ONCHAIN_CACHE_MAX_SIZE,
+    use_redis=settings.ONCHAIN_CACHE_USE_REDIS,
+)
+
 
 class OnchainTool(Toolkit):
     base_url = settings.SERVICE_ONCHAIN_BASE_URL
+    # Tools that move funds, never run them concurrently with each other
+    sequential_tools = ["swap_token", "transfer_token", "add_liquidity_to_pool"]
 
     def __init__(self):
         super().__init__(name="onchain_tools")
@@ -26,18 +37,17 @@ class OnchainTool(Toolkit):
         self.register(self.get_apr_by_token)
         self.register(self.add_liquidity_to_pool)
 
-    def _extract_wallet(self, user_id: str) -> dict | None:
-        with pool.connection() as connection:
-            cursor = connection.cursor()
-            cursor.execute("SELECT * FROM wallets WHERE user_id = %s", (user_id,))
-            wallet = cursor.fetchone()
-            if wallet is None:
-                return None
-            data = {
-                "private_key": wallet[4],
-                "public_key": wallet[3],
-            }
-            return data
+    @property
+    def http(self) -> requests.Session:
+        return get_session(self.base_url)
+
+    def _extract_wallet(
+        self, user_id: str, scope: WalletScope | None = None
+    ) -> dict | None:
+        wallet = wallet_cache.get(user_id, scope)
+        if wallet is None:
+            return None
+        return wallet._asdict()
 
     def check_balance_all_tokens(self, agent: Agent) -> str:
         """
@@ -49,14 +59,14 @@ class OnchainTool(Toolkit):
         logger.info(f"[TOOLS] Checking balance of all tokens for user: {user_id}")
         if user_id is None:
             return "User does not exist"
-        wallet = self._extract_wallet(user_id)
+        wallet = self._extract_wallet(user_id, agent.context.get("wallet_scope"))
         if wallet is None:
             return "User does not have a wallet"
         public_key: str = wallet["public_key"]
         logger.info(f"[TOOLS] Public key: {public_key}")
 
         def get_balances(address: str) -> dict:
-            res = requests.get(
+            res = self.http.get(
                 f"{self.base_url}/allTokens",
                 params={"address": address},
             )
@@ -64,7 +74,7 @@ class OnchainTool(Toolkit):
             res.raise_for_status()
             return res.text
 
-        return retry_request(get_balances, retries=3, delay=5)(public_key)
+        return retry_request(get_balances)(public_key)
 
     def check_balance(self, agent: Agent, token_address: str) -> str:
         """
@@ -75,21 +85,21 @@ class OnchainTool(Toolkit):
             str: Balance of the user in the token.
         """
         user_id = agent.context["user_id"]
-        wallet = self._extract_wallet(user_id)
+        wallet = self._extract_wallet(user_id, agent.context.get("wallet_scope"))
         if wallet is None:
             logger.error(f"[TOOLS] User {user_id} does not have a wallet")
             return "User does not have a wallet"
         public_key = wallet["public_key"]
 
         def get_balance(public_key: str, token_address: str) -> str:
-            res = requests.get(
+            res = self.http.get(
                 f"{self.base_url}/balance",
                 params={"address": public_key, "coinType": token_address},
             )
             res.raise_for_status()
             return str(res.json().get("data", None))  # Return balance as string
 
-        return retry_request(get_balance, retries=3, delay=5)(public_key, token_address)
+        return retry_request(get_balance)(public_key, token_address)
 
     def get_pool_info_by_symbols(self, coinA: str, coinB: str) -> str:
         """
@@ -102,7 +112,7 @@ class OnchainTool(Toolkit):
         """
 
         def _fetch_pool_info(coinA: str, coinB: str) -> str:
-            res = requests.get(
+            res = self.http.get(
                 f"{self.base_url}/getPool",
                 params={"coinA": coinA, "coinB": coinB},
             )
@@ -131,7 +141,12 @@ class OnchainTool(Toolkit):
                 }
             )
 
-        return retry_request(_fetch_pool_info, retries=3, delay=5)(coinA, coinB)
+        return onchain_cache.get_or_load(
+            "getPool",
+            f"{coinA}:{coinB}",
+            lambda: retry_request(_fetch_pool_info)(coinA, coinB),
+            ttl=settings.ONCHAIN_CACHE_TTL_POOL,
+        )
 
     def get_pool_info_by_id_to_swap(self, pool_id: str) -> str:
         """
@@ -141,16 +156,24 @@ class OnchainTool(Toolkit):
         Returns:
             str: Pool info of the token.
         """
+        return self._get_pool_info_by_id(pool_id)
 
+    def _get_pool_info_by_id(self, pool_id: str, bypass_cache: bool = False) -> str:
         def _fetch_pool_info(pool_id: str) -> str:
-            res = requests.get(
+            res = self.http.get(
                 f"{self.base_url}/poolInfo",
                 params={"poolId": pool_id},
             )
             res.raise_for_status()
             return res.text
 
-        return retry_request(_fetch_pool_info, retries=3, delay=5)(pool_id)
+        return onchain_cache.get_or_load(
+            "poolInfo",
+            pool_id,
+            lambda: retry_request(_fetch_pool_info)(pool_id),
+            ttl=settings.ONCHAIN_CACHE_TTL_POOL,
+            bypass=bypass_cache,
+        )
 
     def get_token_address_by_symbol(self, symbol: str) -> str:
         """
@@ -162,14 +185,19 @@ class OnchainTool(Toolkit):
         """
 
         def _fetch_token_info(symbol: str) -> str:
-            res = requests.get(
+            res = self.http.get(
                 f"{self.base_url}/tokensByName",
                 params={"name": symbol},
             )
             res.raise_for_status()
             return res.text
 
-        return retry_request(_fetch_token_info, retries=3, delay=5)(symbol)
+        return onchain_cache.get_or_load(
+            "tokensByName",
+            symbol,
+            lambda: retry_request(_fetch_token_info)(symbol),
+            ttl=settings.ONCHAIN_CACHE_TTL_TOKEN,
+        )
 
     def swap_token(
         self,
@@ -193,11 +221,12 @@ class OnchainTool(Toolkit):
         """
         user_id = agent.context["user_id"]
         logger.info(f"[TOOLS] Swapping token for user: {user_id}")
-        wallet = self._extract_wallet(user_id)
+        wallet = self._extract_wallet(user_id, agent.context.get("wallet_scope"))
         if wallet is None:
             logger.error(f"[TOOLS] User {user_id} does not have a wallet")
             return "User does not have a wallet"
-        pool_info = self.get_pool_info_by_id_to_swap(pool_id=pool_id)
+        # Reserves must be current to pick the swap direction
+        pool_info = self._get_pool_info_by_id(pool_id, bypass_cache=True)
         pool_info = json.loads(pool_info).get("data", None)
         if pool_info is None:
             logger.error(f"[TOOLS] Failed to get pool info for {pool_id}")
@@ -245,7 +274,7 @@ class OnchainTool(Toolkit):
                 "aToB": a_to_b,
                 "privateKey": private_key,
             }
-            response = requests.post(
+            response = self.http.post(
                 f"{self.base_url}/swap",
                 json=body,
             )
@@ -271,7 +300,7 @@ class OnchainTool(Toolkit):
                     f"[TOOLS] Failed to swap token for user: {user_id}, error: {res}"
                 )
 
-        return retry_request(_swap_token, retries=3, delay=5)(
+        return retry_request(_swap_token, idempotent=False)(
             private_key,
             pool_id,
             input_amount,
@@ -295,7 +324,7 @@ class OnchainTool(Toolkit):
             str: Transaction hash or error message.
         """
         user_id = agent.context["user_id"]
-        wallet = self._extract_wallet(user_id)
+        wallet = self._extract_wallet(user_id, agent.context.get("wallet_scope"))
         if wallet is None:
             logger.error(f"[TOOLS] User {user_id} does not have a wallet")
             return "User does not have a wallet"
@@ -316,7 +345,7 @@ class OnchainTool(Toolkit):
                 "privateKey": private_key,
             }
             logger.info(f"Body: {body}")
-            response = requests.post(f"{self.base_url}/transfer", json=body)
+            response = self.http.post(f"{self.base_url}/transfer", json=body)
             logger.info(f"Response: {response}")
             data = response.json()
             if data["status"] is True:
@@ -328,7 +357,7 @@ class OnchainTool(Toolkit):
                 logger.error(response.text)
                 raise Exception(f"[TOOLS] Failed to transfer token for user: {user_id}")
 
-        return retry_request(_transfer_token, retries=3, delay=5)(
+        return retry_request(_transfer_token, idempotent=False)(
             private_key,
             receiver_address,
             amount,
@@ -345,14 +374,19 @@ class OnchainTool(Toolkit):
         """
 
         def _fetch_apr(token_address: str) -> str:
-            res = requests.get(
+            res = self.http.get(
                 f"{self.base_url}/getAPRByToken",
                 params={"token": token_address},
             )
             res.raise_for_status()
             return res.text
 
-        return retry_request(_fetch_apr, retries=3, delay=5)(token_address)
+        return onchain_cache.get_or_load(
+            "getAPRByToken",
+            token_address,
+            lambda: retry_request(_fetch_apr)(token_address),
+            ttl=settings.ONCHAIN_CACHE_TTL_APR,
+        )
 
     def create_pool(self, coin_a: str, coin_b: str) -> str:
         """
@@ -375,7 +409,7 @@ class OnchainTool(Toolkit):
             str: Transaction hash or error message.
         """
         user_id = agent.context["user_id"]
-        wallet = self._extract_wallet(user_id)
+        wallet = self._extract_wallet(user_id, agent.context.get("wallet_scope"))
         if wallet is None:
             logger.error(f"[TOOLS] User {user_id} does not have a wallet")
             return "User does not have a wallet"
@@ -390,7 +424,7 @@ class OnchainTool(Toolkit):
                 "privateKey": private_key,
             }
             logger.info(f"Body: {body}")
-            response = requests.post(f"{self.base_url}/addLiquidity", json=body)
+            response = self.http.post(f"{self.base_url}/addLiquidity", json=body)
             logger.info(f"Response: {response.text}")
             data = response.json()
             if data["status"] is True:
@@ -401,7 +435,7 @@ class OnchainTool(Toolkit):
             else:
                 raise Exception(f"{data}")
 
-        return retry_request(_add_liquidity, retries=3, delay=5)(
+        return retry_request(_add_liquidity, idempotent=False)(
             private_key,
             pool_id,
             amount,
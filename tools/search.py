@@ -1,12 +1,59 @@
-import trafilatura, os, json
+import trafilatura, os, json, time
+import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
 from phi.tools.searxng import Searxng
 from config import settings
+from log import logger
+
+# Shared keep-alive pool for fetching result pages
+http_client = httpx.Client(
+    follow_redirects=True,
+    timeout=settings.SEARCH_FETCH_TIMEOUT,
+    limits=httpx.Limits(
+        max_connections=settings.SEARCH_MAX_WORKERS * 4,
+        max_keepalive_connections=settings.SEARCH_MAX_WORKERS,
+    ),
+    headers={"User-Agent": "Mozilla/5.0 (compatible; DeepSynth/0.1)"},
+)
+# Fetches and extractions for every search run here
+search_executor = ThreadPoolExecutor(
+    max_workers=settings.SEARCH_MAX_WORKERS, thread_name_prefix="search"
+)
+
+
+def fetch_and_extract(url):
+    """
+    Download a page and extract its main text.
+
+    A page that cannot be fetched or extracted, whatever the reason, yields no
+    text rather than failing the whole search.
+
+    Returns:
+        tuple: The text (or None), the fetch time and the extract time in seconds.
+    """
+    start = time.perf_counter()
+    try:
+        response = http_client.get(url)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.debug(f"[SEARCH] Failed to fetch {url}: {e}")
+        return None, time.perf_counter() - start, 0.0
+    except Exception as e:
+        # e.g. httpx.InvalidURL, which is not an HTTPError
+        logger.warning(f"[SEARCH] Failed to fetch {url}: {e}")
+        return None, time.perf_counter() - start, 0.0
+    fetched = time.perf_counter()
+    try:
+        text = trafilatura.extract(response.content)
+    except Exception as e:
+        logger.warning(f"[SEARCH] Failed to extract {url}: {e}")
+        text = None
+    return text if text else None, fetched - start, time.perf_counter() - fetched
 
 
 def extract_text_from_link(url):
-    downloaded = trafilatura.fetch_url(url)
-    text = trafilatura.extract(downloaded)
-    return text if text else None
+    text, _, _ = fetch_and_extract(url)
+    return text
 
 
 def search(query: str, max_results: int):
@@ -19,22 +66,51 @@ def search(query: str, max_results: int):
     Returns:
         The results of the search.
     """
+    started = time.perf_counter()
     search_tools = Searxng(host=settings.SEARXNG_HOST, news=True)
     search_results = json.loads(search_tools.search(query, max_results=max_results))
     urls = [result["url"] for result in search_results["results"]]
-    docs = []
-    for url in urls:
-        if len(docs) > 3:
-            break
-        if extract_text_from_link(url):
-            docs.append(extract_text_from_link(url))
+    searched = time.perf_counter()
+
+    # Fetch every result in parallel and keep the first documents that arrive,
+    # ordered by search rank
+    futures = {
+        search_executor.submit(fetch_and_extract, url): rank
+        for rank, url in enumerate(urls)
+    }
+    docs = {}
+    fetch_time = extract_time = 0.0
+    try:
+        for future in as_completed(futures, timeout=settings.SEARCH_DEADLINE):
+            text, fetch_elapsed, extract_elapsed = future.result()
+            fetch_time = max(fetch_time, fetch_elapsed)
+            extract_time = max(extract_time, extract_elapsed)
+            if text:
+                docs[futures[future]] = text
+            if len(docs) >= settings.SEARCH_MAX_DOCUMENTS:
+                break
+    except TimeoutError:
+        logger.warning(
+            f"[SEARCH] Deadline of {settings.SEARCH_DEADLINE}s reached with {len(docs)} documents"
+        )
+    for future in futures:
+        future.cancel()
+    retrieved = time.perf_counter()
+
     texts = ""
-    for index, doc in enumerate(docs):
+    for index, rank in enumerate(sorted(docs)):
         texts += (
             "============== Document "
             + str(index + 1)
             + " ==============\n"
-            + doc
+            + docs[rank]
             + "\n\n"
         )
+    logger.info(
+        f"[SEARCH] {len(docs)}/{len(urls)} documents, "
+        f"search={searched - started:.2f}s "
+        f"retrieve={retrieved - searched:.2f}s "
+        f"(slowest fetch={fetch_time:.2f}s, slowest extract={extract_time:.2f}s) "
+        f"total={retrieved - started:.2f}s"
+    )
     return texts